@@ -0,0 +1,140 @@
+"""
+Benchmark how quickly a new machine-learning-client replica comes up.
+
+For each of --runs fresh interpreters it measures:
+
+- import time: `import main` in a new process, less the bare interpreter
+  start, plus the slowest imports from `python -X importtime`;
+- time to first request: from launching `python main.py` until /healthz
+  answers, i.e. until the replica can take traffic;
+- time to ready: until /readyz answers 200 (Mongo reachable, indexes in
+  place). This needs a MongoDB: pass --mongo-uri, or it is skipped.
+
+    python benchmarks/bench_ml_startup.py --runs 5
+    python benchmarks/bench_ml_startup.py --runs 5 --mongo-uri mongodb://localhost:27017
+
+Exits 1 if the median time to first request exceeds --max-first-request.
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+ML_CLIENT = Path(__file__).resolve().parent.parent / "machine-learning-client"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def child_env(mongo_uri, port=None):
+    env = dict(os.environ, MONGO_URI=mongo_uri or "mongodb://127.0.0.1:1",
+               MONGO_DBNAME=os.environ.get("MONGO_DBNAME", "bench_ml_startup"),
+               FLASK_ENV="production", LIFECYCLE_INTERVAL_SECONDS="0",
+               OCR_PROVIDER="replay", PYTHONDONTWRITEBYTECODE="1")
+    if port:
+        env["ML_CLIENT_PORT"] = str(port)
+    return env
+
+
+def timed_run(args, env):
+    started = time.perf_counter()
+    subprocess.run(args, cwd=ML_CLIENT, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - started
+
+
+def slowest_imports(env, top):
+    """main's direct imports by cumulative time (microseconds), from -X importtime."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"],
+                            cwd=ML_CLIENT, env=env, capture_output=True, text=True, check=True)
+    rows, children = [], []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        # a module is listed after everything it imports
+        if depth == 1:
+            children.append((int(cumulative), name.strip()))
+        elif depth == 0:
+            if name.strip() == "main":
+                rows = children
+            children = []
+    return sorted(rows, reverse=True)[:top]
+
+
+def wait_for(url, deadline, status=200):
+    while time.perf_counter() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == status:
+                    return time.perf_counter()
+        except (urllib.error.URLError, ConnectionError):
+            pass
+        time.sleep(0.005)
+    return None
+
+
+def startup_run(mongo_uri, timeout):
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "main.py"], cwd=ML_CLIENT,
+                              env=child_env(mongo_uri, port),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = started + timeout
+        first = wait_for(f"http://127.0.0.1:{port}/healthz", deadline)
+        ready = wait_for(f"http://127.0.0.1:{port}/readyz", deadline) if mongo_uri else None
+    finally:
+        server.terminate()
+        server.wait()
+    if first is None:
+        raise RuntimeError(f"main.py did not answer /healthz within {timeout}s")
+    return first - started, (ready - started if ready else None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--mongo-uri", help="MongoDB for the time-to-ready measurement")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--top", type=int, default=8, help="slowest imports to list")
+    parser.add_argument("--max-first-request", type=float,
+                        help="fail if the median seconds to first request exceed this")
+    args = parser.parse_args()
+
+    env = child_env(args.mongo_uri)
+    bare = [timed_run([sys.executable, "-c", "pass"], env) for _ in range(args.runs)]
+    imports = [timed_run([sys.executable, "-c", "import main"], env) for _ in range(args.runs)]
+    import_seconds = statistics.median(imports) - statistics.median(bare)
+    print(f"import main: {import_seconds * 1000:.0f} ms "
+          f"(interpreter start {statistics.median(bare) * 1000:.0f} ms not included)")
+    for cumulative, name in slowest_imports(env, args.top):
+        print(f"  {name:<32} {cumulative / 1000:>8.1f} ms")
+
+    runs = [startup_run(args.mongo_uri, args.timeout) for _ in range(args.runs)]
+    first = statistics.median(run[0] for run in runs)
+    print(f"time to first request: {first * 1000:.0f} ms median over {args.runs} runs")
+    if args.mongo_uri:
+        ready = [run[1] for run in runs if run[1] is not None]
+        print(f"time to ready: {statistics.median(ready) * 1000:.0f} ms"
+              if ready else "time to ready: never ready")
+
+    if args.max_first_request is not None and first > args.max_first_request:
+        print(f"REGRESSION: first request after {first:.3f}s > {args.max_first_request}s",
+              file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
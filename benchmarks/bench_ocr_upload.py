@@ -0,0 +1,93 @@
+"""
+Compare the old temp-file OCR upload path with the streamed multipart body.
+
+A local HTTP server stands in for the Mindee API and simply drains the
+request body, so the numbers measure only the client side: peak Python
+memory (tracemalloc) and wall-clock latency per upload.
+
+    python benchmarks/bench_ocr_upload.py --sizes 1 4 12 --repeat 5
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "machine-learning-client"))
+
+from multipart_stream import MultipartFileStream  # noqa: E402
+
+
+class DrainHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        remaining = int(self.headers.get("Content-Length", 0))
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, 64 * 1024)))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, *args):
+        pass
+
+
+def file_based(url, source, workdir):
+    """The previous perform_ocr: load the blob, write it to disk, re-open and post it."""
+    image_data = source.read()
+    file_path = os.path.join(workdir, "receipt.jpg")
+    with open(file_path, "wb") as f:
+        f.write(image_data)
+    with open(file_path, "rb") as myfile:
+        requests.post(url, files={"document": myfile})
+
+
+def streamed(url, source, workdir):
+    body = MultipartFileStream("document", "receipt.jpg", source, content_type="image/jpeg")
+    requests.post(url, data=body, headers={"Content-Type": body.content_type})
+
+
+def measure(path, url, image, repeat, workdir):
+    latencies, peaks = [], []
+    for _ in range(repeat):
+        source = io.BytesIO(image)  # stands in for a GridFS GridOut
+        tracemalloc.start()
+        start = time.perf_counter()
+        path(url, source, workdir)
+        latencies.append(time.perf_counter() - start)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return statistics.median(latencies), max(peaks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 4, 12],
+                        help="image sizes in MB")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), DrainHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/predict"
+
+    print(f"{'size':>8} {'path':>8} {'median ms':>10} {'peak MB':>9}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in args.sizes:
+            image = os.urandom(int(size * 1024 * 1024))
+            for name, path in (("file", file_based), ("stream", streamed)):
+                latency, peak = measure(path, url, image, args.repeat, workdir)
+                print(f"{size:>6.1f}MB {name:>8} {latency * 1000:>10.1f} {peak / 2**20:>9.2f}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
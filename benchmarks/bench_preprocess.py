@@ -0,0 +1,80 @@
+"""
+Measure what image preprocessing saves per receipt.
+
+Builds phone-photo-like inputs by placing the sample receipt on a noisy
+background at typical camera resolutions, runs the preprocessing pipeline
+and reports bytes before/after and the time it takes. If tesseract is
+installed the OCR latency on the original and the compact image is
+compared too.
+
+    python benchmarks/bench_preprocess.py --resolutions 4032x3024 3264x2448 --repeat 3
+"""
+import argparse
+import io
+import shutil
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+ML_CLIENT = Path(__file__).resolve().parent.parent / "machine-learning-client"
+sys.path.insert(0, str(ML_CLIENT))
+
+from preprocess import preprocess_image  # noqa: E402
+
+
+def phone_photo(width, height, seed=0):
+    """The sample receipt photographed on a dark table, as camera JPEG bytes."""
+    rng = np.random.default_rng(seed)
+    table = Image.fromarray((rng.random((width, height, 3)) * 60 + 30).astype(np.uint8))
+    receipt = Image.open(ML_CLIENT / "RestaurantReceipt1.png").convert("RGB")
+    scale = 0.7 * min(height / receipt.width, width / receipt.height)
+    receipt = receipt.resize((int(receipt.width * scale), int(receipt.height * scale)))
+    table.paste(receipt, ((height - receipt.width) // 2, (width - receipt.height) // 2))
+    out = io.BytesIO()
+    table.save(out, format="JPEG", quality=92)
+    return out.getvalue()
+
+
+def ocr_seconds(image_bytes):
+    import pytesseract
+    start = time.perf_counter()
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        pytesseract.image_to_string(image.convert("L"), config="--psm 6")
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--resolutions", nargs="+", default=["4032x3024", "3264x2448", "1920x1080"])
+    parser.add_argument("--max-long-edge", type=int, default=1600)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    with_ocr = shutil.which("tesseract") is not None
+
+    header = f"{'resolution':>11} {'original':>10} {'compact':>9} {'saved':>6} {'prep ms':>8}"
+    if with_ocr:
+        header += f" {'ocr orig ms':>11} {'ocr compact ms':>14}"
+    print(header)
+    for resolution in args.resolutions:
+        height, width = (int(v) for v in resolution.split("x"))
+        photo = phone_photo(width, height)
+        runs = []
+        for _ in range(args.repeat):
+            compact, info = preprocess_image(photo, max_long_edge=args.max_long_edge)
+            runs.append(info["seconds"])
+        saved = 1 - len(compact) / len(photo)
+        line = (f"{resolution:>11} {len(photo) / 1024:>8.0f}KB {len(compact) / 1024:>7.0f}KB "
+                f"{saved:>6.0%} {statistics.median(runs) * 1000:>8.1f}")
+        if with_ocr:
+            line += f" {ocr_seconds(photo) * 1000:>11.0f} {ocr_seconds(compact) * 1000:>14.0f}"
+        print(line)
+    if not with_ocr:
+        print("(tesseract not installed: OCR latency comparison skipped)")
+
+
+if __name__ == "__main__":
+    main()
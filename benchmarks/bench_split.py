@@ -0,0 +1,87 @@
+"""
+Benchmark the split engine against the old calculate_bill loop.
+
+Builds a large group receipt (200+ items, 50 people, every item shared by a
+few people) and times both implementations on the same inputs.
+
+    python benchmarks/bench_split.py --items 240 --people 50 --repeat 20
+"""
+import argparse
+import random
+import statistics
+import sys
+import time
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "web-app"))
+
+import split_engine  # noqa: E402
+
+
+def legacy_split(names, items, allocations, item_counts, subtotal, tax, tip_percentage):
+    """The float loop calculate_bill used before split_engine."""
+    tip_percentage = float(tip_percentage) / 100
+    appetizer_total = sum(item['amount'] for item in items if item.get('is_appetizer', False))
+    payments = {name: 0 for name in names}
+    for name in payments:
+        payments[name] += appetizer_total / len(names)
+    for item_id, users in allocations.items():
+        item = next((item for item in items if str(item['_id']) == item_id), None)
+        if item:
+            cost_per_user = item['amount'] / item_counts.get(item_id, 1)
+            for user in users:
+                payments[user] += cost_per_user
+    total_with_tax = subtotal + tax
+    total_with_tip = total_with_tax * (1 + tip_percentage)
+    for name, payment in payments.items():
+        share = payment / subtotal
+        payments[name] = round(payment + (total_with_tax - subtotal) * share
+                               + (total_with_tip - total_with_tax) * share, 2)
+    return payments
+
+
+def make_receipt(num_items, num_people, seed=0):
+    rng = random.Random(seed)
+    names = [f"person{i}" for i in range(num_people)]
+    items = [{"_id": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+              "amount": round(rng.uniform(1, 60), 2),
+              "is_appetizer": i < num_items // 20} for i in range(num_items)]
+    allocations = {str(item["_id"]): rng.sample(names, rng.randint(1, 4))
+                   for item in items if not item["is_appetizer"]}
+    item_counts = {item_id: len(users) for item_id, users in allocations.items()}
+    subtotal = round(sum(item["amount"] for item in items), 2)
+    return dict(names=names, items=items, allocations=allocations, item_counts=item_counts,
+                subtotal=subtotal, tax=round(subtotal * 0.08875, 2), tip_percentage="18")
+
+
+def time_it(func, receipt, repeat):
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(**receipt)
+        runs.append(time.perf_counter() - start)
+    return statistics.median(runs), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--items", type=int, default=240)
+    parser.add_argument("--people", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    receipt = make_receipt(args.items, args.people)
+    legacy_time, legacy = time_it(legacy_split, receipt, args.repeat)
+    engine_time, cents = time_it(split_engine.split_bill, receipt, args.repeat)
+
+    expected = round((receipt["subtotal"] + receipt["tax"]) * 1.18 * 100)
+    print(f"{args.items} items, {args.people} people, median of {args.repeat} runs")
+    print(f"legacy loop : {legacy_time * 1000:8.2f} ms, "
+          f"total off by {round(sum(legacy.values()) * 100) - expected:+d} cents")
+    print(f"split_engine: {engine_time * 1000:8.2f} ms, "
+          f"total off by {sum(cents.values()) - expected:+d} cents")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+"""
+Benchmark the whole split workflow through the web app's routes.
+
+Each simulated user uploads the sample receipt, waits on /job_status while a
+stub OCR worker replays response1.json after --ml-latency seconds, enters
+the people, picks appetizers, allocates every item and calculates the bill:
+
+    upload -> numofpeople -> submit_people -> select_appetizers
+           -> allocateitems -> enter_tip -> calculate_bill
+
+Runs on mongomock by default or on a real MongoDB with --mongo-uri (use a
+scratch database). Reports workflow throughput and p50/p95/p99 latency per
+route and, with --allocations, the peak memory each route allocates.
+
+As a regression gate, save a baseline and compare later runs against it:
+
+    python benchmarks/bench_workflow.py --workflows 200 --output baseline.json
+    python benchmarks/bench_workflow.py --workflows 200 --baseline baseline.json --max-regression 0.25
+
+The gate exits 1 when throughput drops, or a route's p95 grows, by more than
+--max-regression (a fraction) relative to the baseline.
+
+mongomock does not implement array filters, so on mongomock the appetizer
+write is emulated with a whole-array $set; time that route on a real MongoDB.
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import re
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+WEB_APP = ROOT / "web-app"
+ML_CLIENT = ROOT / "machine-learning-client"
+sys.path.insert(0, str(WEB_APP))
+
+NAMES = ["Alice", "Bob", "Carol", "Dan"]
+
+
+def replayed_receipt(path):
+    """Receipt fields from a recorded Asprise response, as the ML client saves them."""
+    receipt = json.loads(Path(path).read_text())["receipts"][0]
+    return {
+        "receipt_name": receipt["merchant_name"],
+        "currency": receipt["currency"],
+        "items": [{"description": item["description"], "amount": item["amount"],
+                   "quantity": item["qty"]} for item in receipt["items"]],
+        "total": receipt["total"],
+        "tax": receipt["tax"],
+        "tip": receipt["tip"],
+        "subtotal": receipt["subtotal"],
+    }
+
+
+class StubOcrWorker(threading.Thread):
+    """Claims queued OCR jobs like the ML client does and 'reads' each in ml_latency seconds."""
+
+    def __init__(self, db, receipt_data, ml_latency):
+        super().__init__(daemon=True)
+        self.db = db
+        self.receipt_data = receipt_data
+        self.ml_latency = ml_latency
+        self.stop = threading.Event()
+
+    def stage(self, job_id, stage, **fields):
+        now = datetime.now(timezone.utc)
+        self.db.ocr_jobs.update_one({"_id": job_id},
+                                    {"$set": dict(fields, stage=stage, updated_at=now),
+                                     "$push": {"stages": {"stage": stage, "at": now}}})
+
+    def run(self):
+        while not self.stop.is_set():
+            job = self.db.ocr_jobs.find_one_and_update({"status": "queued"},
+                                                       {"$set": {"status": "running"}})
+            if job is None:
+                time.sleep(0.002)
+                continue
+            self.stage(job["_id"], "ocr_running")
+            time.sleep(self.ml_latency)
+            receipt_data = dict(self.receipt_data,
+                                items=[dict(item, _id=str(uuid.uuid4()))
+                                       for item in self.receipt_data["items"]])
+            self.db.receipts.update_one({"_id": job["receipt_id"]}, {"$set": receipt_data})
+            self.stage(job["_id"], "parsed")
+            self.stage(job["_id"], "ready", status="done")
+
+
+def emulate_set_appetizers(db, receipt_id, appetizer_ids):
+    """receipt_store.set_appetizers without array filters, for mongomock."""
+    from bson import ObjectId
+    receipt = db.receipts.find_one({"_id": ObjectId(receipt_id)}, {"items": 1})
+    items = [dict(item, is_appetizer=item["_id"] in appetizer_ids) for item in receipt["items"]]
+    db.receipts.update_one({"_id": ObjectId(receipt_id)}, {"$set": {"items": items}})
+
+
+class Timings:
+    def __init__(self, allocations):
+        self.latency = defaultdict(list)
+        self.peak_bytes = defaultdict(list)
+        self.allocations = allocations
+        self.lock = threading.Lock()
+
+    def call(self, route, fn, *args, **kwargs):
+        if self.allocations:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        response = fn(*args, **kwargs)
+        elapsed = time.perf_counter() - started
+        if response.status_code >= 400:
+            raise RuntimeError(f"{route} returned {response.status_code}")
+        with self.lock:
+            self.latency[route].append(elapsed)
+            if self.allocations:
+                self.peak_bytes[route].append(tracemalloc.get_traced_memory()[1] - baseline)
+        return response
+
+
+def workflow(client, timings, image, poll_seconds):
+    upload = timings.call("POST /upload", client.post, "/upload",
+                          data={"image": (io.BytesIO(image), "receipt.png")},
+                          content_type="multipart/form-data")
+    receipt_id = upload.headers["Location"].rstrip("/").rsplit("/", 1)[-1]
+    timings.call("GET /numofpeople", client.get, f"/numofpeople/{receipt_id}")
+
+    ready_started = time.perf_counter()
+    while True:
+        job = timings.call("GET /job_status", client.get, f"/job_status/{receipt_id}").get_json()
+        if job["status"] == "done":
+            break
+        if job["status"] == "failed":
+            raise RuntimeError(job["last_error"])
+        time.sleep(poll_seconds)
+    with timings.lock:
+        timings.latency["(time to OCR ready)"].append(time.perf_counter() - ready_started)
+
+    timings.call("POST /submit_people", client.post, f"/submit_people/{receipt_id}",
+                 data={"count": str(len(NAMES)), "names": ", ".join(NAMES)})
+    page = timings.call("GET /select_appetizers", client.get, f"/select_appetizers/{receipt_id}")
+    item_ids = re.findall(r'name="appetizers" value="([^"]+)"', page.get_data(as_text=True))
+    timings.call("POST /select_appetizers", client.post, f"/select_appetizers/{receipt_id}",
+                 data={"appetizers": item_ids[:1]})
+
+    timings.call("GET /allocateitems", client.get, f"/allocateitems/{receipt_id}")
+    # everyone shares the first item, the rest go round the table
+    allocations = {f"item_{item_id}": (NAMES if i == 0 else [NAMES[i % len(NAMES)]])
+                   for i, item_id in enumerate(item_ids[1:])}
+    timings.call("POST /allocateitems", client.post, f"/allocateitems/{receipt_id}",
+                 data=allocations)
+    timings.call("GET /enter_tip", client.get, f"/enter_tip/{receipt_id}")
+    timings.call("POST /calculate_bill", client.post, f"/calculate_bill/{receipt_id}",
+                 data={"tip_percentage": "18"})
+
+
+def percentile(values, pct):
+    return statistics.quantiles(values, n=100, method="inclusive")[pct - 1] \
+        if len(values) > 1 else values[0]
+
+
+def summarize(timings, workflows, elapsed):
+    routes = {}
+    for route, values in timings.latency.items():
+        routes[route] = {"count": len(values),
+                         "p50_ms": round(percentile(values, 50) * 1000, 3),
+                         "p95_ms": round(percentile(values, 95) * 1000, 3),
+                         "p99_ms": round(percentile(values, 99) * 1000, 3)}
+        if timings.peak_bytes.get(route):
+            routes[route]["peak_kb"] = round(statistics.median(timings.peak_bytes[route]) / 1024, 1)
+    return {"workflows": workflows, "elapsed_seconds": round(elapsed, 3),
+            "workflows_per_second": round(workflows / elapsed, 2), "routes": routes}
+
+
+def regressions(result, baseline, max_regression):
+    """What got worse than the baseline by more than max_regression."""
+    found = []
+    if result["workflows_per_second"] < baseline["workflows_per_second"] * (1 - max_regression):
+        found.append(f"throughput {baseline['workflows_per_second']} -> "
+                     f"{result['workflows_per_second']} workflows/s")
+    for route, before in baseline["routes"].items():
+        after = result["routes"].get(route)
+        if after and after["p95_ms"] > before["p95_ms"] * (1 + max_regression):
+            found.append(f"{route} p95 {before['p95_ms']} -> {after['p95_ms']} ms")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workflows", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=1, help="users running at once")
+    parser.add_argument("--ml-latency", type=float, default=0.0,
+                        help="seconds the stub OCR worker takes per receipt")
+    parser.add_argument("--poll-seconds", type=float, default=0.005)
+    parser.add_argument("--mongo-uri", help="real MongoDB to use instead of mongomock")
+    parser.add_argument("--replay-file", default=str(ML_CLIENT / "response1.json"))
+    parser.add_argument("--image", default=str(ML_CLIENT / "RestaurantReceipt1.png"))
+    parser.add_argument("--allocations", action="store_true",
+                        help="trace peak memory per route (slower; compare with care)")
+    parser.add_argument("--output", help="write the results as JSON here")
+    parser.add_argument("--baseline", help="results JSON to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    args = parser.parse_args()
+
+    os.environ.setdefault("MONGO_DBNAME", f"bench_{uuid.uuid4().hex[:8]}")
+    if args.mongo_uri:
+        os.environ["MONGO_URI"] = args.mongo_uri
+    logging.disable(logging.INFO)  # the app logs every request at DEBUG
+    import app as web_app
+    import receipt_store
+
+    if not args.mongo_uri:
+        import mongomock
+        import mongomock.gridfs
+        mongomock.gridfs.enable_gridfs_integration()
+        web_app.db = mongomock.MongoClient()[os.environ["MONGO_DBNAME"]]
+        receipt_store.set_appetizers = emulate_set_appetizers
+    db = web_app.db
+    web_app.app.config["TESTING"] = True
+
+    worker = StubOcrWorker(db, replayed_receipt(args.replay_file), args.ml_latency)
+    worker.start()
+    image = Path(args.image).read_bytes()
+    timings = Timings(args.allocations)
+    if args.allocations:
+        tracemalloc.start()
+
+    def run_one(_):
+        with web_app.app.test_client() as client:
+            workflow(client, timings, image, args.poll_seconds)
+
+    started = time.perf_counter()
+    try:
+        if args.concurrency > 1:
+            with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                list(pool.map(run_one, range(args.workflows)))
+        else:
+            for n in range(args.workflows):
+                run_one(n)
+    finally:
+        worker.stop.set()
+        if args.mongo_uri:
+            db.client.drop_database(db.name)
+    result = summarize(timings, args.workflows, time.perf_counter() - started)
+
+    print(f"{result['workflows']} workflows in {result['elapsed_seconds']}s: "
+          f"{result['workflows_per_second']} workflows/s "
+          f"({'MongoDB' if args.mongo_uri else 'mongomock'}, ML latency {args.ml_latency:g}s)")
+    header = f"{'route':<28} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+    print(header + (f" {'peak KB':>8}" if args.allocations else ""))
+    for route, stats in result["routes"].items():
+        line = (f"{route:<28} {stats['count']:>6} {stats['p50_ms']:>8.2f} "
+                f"{stats['p95_ms']:>8.2f} {stats['p99_ms']:>8.2f}")
+        if "peak_kb" in stats:
+            line += f" {stats['peak_kb']:>8.1f}"
+        print(line)
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(result, indent=2))
+    if args.baseline:
+        found = regressions(result, json.loads(Path(args.baseline).read_text()),
+                            args.max_regression)
+        for problem in found:
+            print(f"REGRESSION: {problem}", file=sys.stderr)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+"""
+Load-test the web app in its sync (WSGI) and async (ASGI) serving modes.
+
+Start the same app both ways against the same database, e.g.
+
+    cd web-app
+    gunicorn --workers 2 --threads 8 --bind :8001 app:app                    # sync
+    gunicorn --worker-class gevent --workers 2 --bind :8002 app:app          # sync, gevent
+    uvicorn asgi:application --workers 2 --port 8003                         # async
+
+then point the load test at each and compare:
+
+    python benchmarks/load_test.py --seed --concurrency 200 --duration 20 \
+        sync=http://localhost:8001 gevent=http://localhost:8002 async=http://localhost:8003
+
+--scenario reads hits the JSON lookups the receipt pages make. --scenario
+waits holds long-polls open on a job that never finishes, which is where a
+thread per connection runs out first. --seed inserts the receipts and jobs
+it needs using MONGO_URI/MONGO_DBNAME; otherwise pass --receipt-id.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from datetime import datetime, timezone
+
+import httpx
+
+
+def seed(finished):
+    """A receipt with an OCR job for the test to read; returns its id."""
+    import pymongo
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    db = pymongo.MongoClient(os.getenv("MONGO_URI"))[os.getenv("MONGO_DBNAME")]
+    receipt_id = db.receipts.insert_one({
+        "receipt_name": "Load test", "currency": "USD", "total": 42.0,
+        "items": [{"description": f"Item {i}", "amount": 2.1, "quantity": 1} for i in range(20)],
+    }).inserted_id
+    now = datetime.now(timezone.utc)
+    stages = ["stored", "queued"] + (["ocr_running", "parsed", "ready"] if finished else [])
+    db.ocr_jobs.insert_one({"receipt_id": receipt_id, "status": "done" if finished else "queued",
+                            "stage": stages[-1], "attempts": 0, "last_error": None,
+                            "stages": [{"stage": stage, "at": now} for stage in stages],
+                            "run_after": now.replace(year=now.year + 1),  # never picked up
+                            "created_at": now, "updated_at": now})
+    return str(receipt_id)
+
+
+def paths(scenario, receipt_id):
+    if scenario == "waits":
+        return [f"/job_status/{receipt_id}?wait=2&after=99"]
+    return [f"/job_status/{receipt_id}", f"/receipt_items/{receipt_id}",
+            f"/progress/{receipt_id}"]
+
+
+async def run(base_url, targets, concurrency, duration):
+    latencies, errors = [], 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        deadline = time.perf_counter() + duration
+
+        async def user(n):
+            nonlocal errors
+            i = n
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    response = await client.get(targets[i % len(targets)])
+                    ok = response.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                if ok:
+                    latencies.append(time.perf_counter() - started)
+                else:
+                    errors += 1
+                i += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user(n) for n in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return latencies, errors, elapsed
+
+
+def percentile(values, pct):
+    return statistics.quantiles(values, n=100)[pct - 1] if len(values) > 1 else values[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("servers", nargs="+", help="name=url of each serving mode to test")
+    parser.add_argument("--scenario", choices=["reads", "waits"], default="reads")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=15)
+    parser.add_argument("--receipt-id")
+    parser.add_argument("--seed", action="store_true", help="insert a test receipt and job first")
+    args = parser.parse_args()
+
+    receipt_id = args.receipt_id or (seed(args.scenario == "reads") if args.seed else None)
+    if receipt_id is None:
+        parser.error("pass --receipt-id or --seed")
+    targets = paths(args.scenario, receipt_id)
+
+    print(f"{args.scenario}: {args.concurrency} concurrent clients for {args.duration:g}s")
+    print(f"{'mode':>10} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for server in args.servers:
+        name, _, url = server.partition("=")
+        latencies, errors, elapsed = asyncio.run(
+            run(url or name, targets, args.concurrency, args.duration))
+        if not latencies:
+            print(f"{name:>10} {'-':>8} {'-':>8} {'-':>8} {errors:>7}")
+            continue
+        print(f"{name:>10} {len(latencies) / elapsed:>8.1f} "
+              f"{percentile(latencies, 50) * 1000:>8.1f} {percentile(latencies, 99) * 1000:>8.1f} "
+              f"{errors:>7}")
+
+
+if __name__ == "__main__":
+    main()
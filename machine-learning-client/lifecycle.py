@@ -0,0 +1,201 @@
+"""
+Lifecycle housekeeping for stored receipts, run periodically by the ML client.
+
+- archive_finished_images: once a receipt's split has been calculated and it
+  hasn't changed for a while, its images (the original, any further pages
+  and the compact OCR derivative) are gzipped into ARCHIVE_DIR/<year>/<month>/
+  and removed from GridFS. The receipt keeps a note of where each one went,
+  so the hot collections only hold what open sessions still need. A
+  multi-page receipt keeps its pages in order, each pointing at its
+  archived_images entry instead of a GridFS file.
+- sweep_orphan_images: GridFS files no receipt points at any more. Drafts
+  deleted by the web app's TTL index leave their images behind, as does a
+  failed upload or an archive pass that stopped part-way.
+- sweep_temp_files: receipt_*.jpg files older versions of perform_ocr wrote
+  next to main.py and never removed.
+
+Unfinished drafts themselves are expired by the web app's draft_expires_at
+TTL index (web-app/schema.py); OCR jobs expire here via ensure_indexes.
+"""
+import gzip
+import logging
+import mimetypes
+import os
+import shutil
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import gridfs
+import pymongo
+
+logger = logging.getLogger(__name__)
+
+TEMP_FILE_PATTERN = "receipt_*.jpg"
+
+
+def ensure_indexes(db, job_ttl_seconds):
+    # receipts with an image still in GridFS, by last change; archived ones drop out
+    db.receipts.create_index('updated_at', name='archivable',
+                             partialFilterExpression={'image_id': {'$exists': True}})
+    # the orphan sweep checks each old file against the receipts pointing at it
+    db.receipts.create_index('image_id', sparse=True)
+    db.receipts.create_index('compact_image_id', sparse=True)
+    db.receipts.create_index('pages.image_id', sparse=True)
+    db.ocr_jobs.create_index('created_at', name='job_ttl', expireAfterSeconds=job_ttl_seconds)
+
+
+def archive_path(archive_dir, receipt, kind, grid_out):
+    created = receipt['_id'].generation_time
+    suffix = Path(grid_out.filename or '').suffix or '.bin'
+    return Path(archive_dir) / f"{created:%Y}" / f"{created:%m}" / \
+        f"{receipt['_id']}-{kind}{suffix}.gz"
+
+
+def content_type(grid_out):
+    """
+    A GridFS file's content type, from its metadata. Files stored before it
+    was kept there are guessed from their filename.
+    """
+    stored = (grid_out.metadata or {}).get('content_type')
+    return stored or mimetypes.guess_type(grid_out.filename or '')[0]
+
+
+def archive_file(grid_out, path):
+    """Gzip a GridFS file to path (atomically); returns what the receipt records about it."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial = path.with_name(path.name + '.partial')
+    with gzip.open(partial, 'wb', compresslevel=6) as out:
+        shutil.copyfileobj(grid_out, out, 255 * 1024)
+    os.replace(partial, path)
+    return {'path': str(path), 'filename': grid_out.filename,
+            'content_type': content_type(grid_out), 'bytes': grid_out.length,
+            'archived_bytes': path.stat().st_size}
+
+
+def archive_finished_images(db, archive_dir, older_than_seconds, batch_size=100, now=None):
+    """
+    Move the images of receipts that were split and left alone for
+    older_than_seconds out of GridFS into archive_dir. Returns how many
+    receipts were archived.
+    """
+    now = now or datetime.now(timezone.utc)
+    fs = gridfs.GridFS(db)
+    archived = 0
+    receipts = db.receipts.find(
+        {'image_id': {'$exists': True},
+         'updated_at': {'$lt': now - timedelta(seconds=older_than_seconds)},
+         'payments': {'$exists': True},
+         'draft_expires_at': {'$exists': False}},
+        {'image_id': 1, 'compact_image_id': 1, 'pages': 1}).limit(batch_size)
+    for receipt in receipts:
+        entries, file_ids = {}, []
+        images = [('original', receipt['image_id']), ('compact', receipt.get('compact_image_id'))]
+        # the first page of a multi-page receipt is its image_id
+        images += [(f'page{number}', page['image_id'])
+                   for number, page in enumerate(receipt.get('pages', [])[1:], 2)]
+        try:
+            for kind, file_id in images:
+                if file_id is None:
+                    continue
+                grid_out = fs.get(file_id)
+                entries[kind] = archive_file(grid_out,
+                                             archive_path(archive_dir, receipt, kind, grid_out))
+                file_ids.append(file_id)
+        except OSError as e:
+            # a full or unwritable archive disk; leave this receipt in GridFS for the next pass
+            logger.error("Could not archive images of receipt %s: %s", receipt['_id'], str(e))
+            remove_archived(entries)
+            continue
+        archived_fields = {'archived_images': entries, 'archived_at': now}
+        if receipt.get('pages'):
+            archived_fields['pages'] = archived_pages(receipt['pages'])
+        # only if the images are still the ones just copied
+        result = db.receipts.update_one(
+            {'_id': receipt['_id'], 'image_id': receipt['image_id']},
+            {'$set': archived_fields, '$unset': {'image_id': '', 'compact_image_id': ''}})
+        if result.modified_count:
+            for file_id in file_ids:
+                fs.delete(file_id)
+            archived += 1
+        else:
+            # changed meanwhile: GridFS still has the images, so the copies aren't needed
+            remove_archived(entries)
+    return archived
+
+
+def remove_archived(entries):
+    """Delete the archive files written for entries."""
+    for entry in entries.values():
+        Path(entry['path']).unlink(missing_ok=True)
+
+
+def archived_pages(pages):
+    """The pages of an archived receipt, in order, naming their archived_images entries."""
+    return [{'image_sha256': page.get('image_sha256'),
+             'archived': 'original' if number == 1 else f'page{number}'}
+            for number, page in enumerate(pages, 1)]
+
+
+def open_archived_image(entry):
+    """A readable binary stream of an archived image, from its archived_images entry."""
+    return gzip.open(entry['path'], 'rb')
+
+
+def sweep_orphan_images(db, grace_seconds, batch_size=500, now=None):
+    """Delete GridFS files older than grace_seconds that no receipt refers to."""
+    now = now or datetime.now(timezone.utc)
+    fs = gridfs.GridFS(db)
+    cutoff = now - timedelta(seconds=grace_seconds)
+    deleted = 0
+    batch = []
+    for grid_file in db.fs.files.find({'uploadDate': {'$lt': cutoff}}, {'_id': 1}):
+        batch.append(grid_file['_id'])
+        if len(batch) == batch_size:
+            deleted += _delete_unreferenced(db, fs, batch)
+            batch = []
+    if batch:
+        deleted += _delete_unreferenced(db, fs, batch)
+    return deleted
+
+
+def _delete_unreferenced(db, fs, file_ids):
+    referenced = set()
+    for receipt in db.receipts.find({'$or': [{'image_id': {'$in': file_ids}},
+                                             {'compact_image_id': {'$in': file_ids}},
+                                             {'pages.image_id': {'$in': file_ids}}]},
+                                    {'image_id': 1, 'compact_image_id': 1, 'pages.image_id': 1}):
+        referenced.update((receipt.get('image_id'), receipt.get('compact_image_id')))
+        referenced.update(page.get('image_id') for page in receipt.get('pages', []))
+    orphans = [file_id for file_id in file_ids if file_id not in referenced]
+    for file_id in orphans:
+        fs.delete(file_id)
+    return len(orphans)
+
+
+def sweep_temp_files(directory, grace_seconds, pattern=TEMP_FILE_PATTERN, now=None):
+    """Remove leftover OCR temp files older than grace_seconds; returns how many."""
+    cutoff = (now or time.time()) - grace_seconds
+    removed = 0
+    for path in Path(directory).glob(pattern):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+                removed += 1
+        except FileNotFoundError:
+            pass  # another worker got there first
+    return removed
+
+
+def run_once(db, archive_dir, archive_after_seconds, orphan_grace_seconds, temp_dir,
+             temp_grace_seconds):
+    """One housekeeping pass; returns counts for the log."""
+    stats = {}
+    try:
+        stats['archived_receipts'] = archive_finished_images(db, archive_dir,
+                                                             archive_after_seconds)
+        stats['orphan_images'] = sweep_orphan_images(db, orphan_grace_seconds)
+    except pymongo.errors.PyMongoError as e:
+        stats['error'] = str(e)
+    stats['temp_files'] = sweep_temp_files(temp_dir, temp_grace_seconds)
+    return stats
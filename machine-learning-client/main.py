@@ -1,13 +1,38 @@
-import json
+"""
+The machine-learning-client service: OCR jobs for uploaded receipts.
+
+create_app() builds the Flask app and start_workers() starts the OCR worker
+pool. Nothing connects to Mongo or loads an OCR provider at import time:
+the database is connected on first use (get_db), index creation runs in the
+background, and each provider is created, with its dependencies, when a job
+first needs it. A new replica answers /healthz as soon as it is listening and
+/readyz once Mongo answers and its indexes are in place.
+
+Every OCR call goes through the ocr_scheduler, which rations the provider's
+quota, reads interactive uploads before batch ones and falls back or defers
+jobs when the quota is used up.
+"""
+import concurrent.futures
+import io
 import logging
 import os
+import random
+import re
+import threading
+from datetime import datetime, timedelta, timezone
 
 from bson import ObjectId
 from dotenv import load_dotenv
-from flask import Flask, jsonify, request
-from mindee import Client, PredictResponse, product
+from flask import Blueprint, Flask, jsonify, request
+import gridfs
 import pymongo
-import requests
+
+import lifecycle
+import metrics
+import ocr_providers
+import ocr_scheduler
+import receipt_model
+from ocr_cache import OcrResultCache, stream_hash
 
 
 logging.basicConfig(level=logging.DEBUG)
@@ -17,19 +42,139 @@ logger = logging.getLogger(__name__)
 # if you do not yet have a file named .env, make one based on the templatpip e in env.example
 load_dotenv()  # take environment variables from .env.
 
-# instantiate the app
-app = Flask(__name__)
-app.secret_key = 'a_unique_and_secret_key'
-# # turn on debugging if in development mode
-if os.getenv("FLASK_ENV", "development") == "development":
-#     # turn on debugging, if in development
-    app.debug = True  # debug mnode
+# OCR job queue settings
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", 2))
+OCR_JOB_MAX_ATTEMPTS = int(os.getenv("OCR_JOB_MAX_ATTEMPTS", 5))
+OCR_JOB_BACKOFF_SECONDS = float(os.getenv("OCR_JOB_BACKOFF_SECONDS", 2))
+OCR_JOB_MAX_BACKOFF_SECONDS = float(os.getenv("OCR_JOB_MAX_BACKOFF_SECONDS", 300))
+OCR_JOB_POLL_SECONDS = float(os.getenv("OCR_JOB_POLL_SECONDS", 1))
+OCR_JOB_LEASE_SECONDS = float(os.getenv("OCR_JOB_LEASE_SECONDS", 300))
+
+# shrink images (grayscale, crop, downscale) before OCR; the original is kept too
+OCR_PREPROCESS = os.getenv("OCR_PREPROCESS", "1") == "1"
+OCR_MAX_LONG_EDGE = int(os.getenv("OCR_MAX_LONG_EDGE", 1600))
+
+# pages of multi-page receipts read at once, across all jobs
+OCR_PAGE_CONCURRENCY = int(os.getenv("OCR_PAGE_CONCURRENCY", 4))
+
+# housekeeping: archive finished receipts' images, sweep orphaned blobs and temp files
+LIFECYCLE_INTERVAL_SECONDS = float(os.getenv("LIFECYCLE_INTERVAL_SECONDS", 3600))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "/archive")
+ARCHIVE_AFTER_SECONDS = int(os.getenv("ARCHIVE_AFTER_SECONDS", 30 * 24 * 3600))
+ORPHAN_GRACE_SECONDS = int(os.getenv("ORPHAN_GRACE_SECONDS", 24 * 3600))
+OCR_TEMP_DIR = os.getenv("OCR_TEMP_DIR", os.path.dirname(os.path.abspath(__file__)))
+OCR_JOB_TTL_SECONDS = int(os.getenv("OCR_JOB_TTL_SECONDS", 30 * 24 * 3600))
+
+# which OcrProvider reads receipts: mindee, replay or local
+OCR_PROVIDER = os.getenv("OCR_PROVIDER", "mindee")
+# the provider's request quota, shared by all replicas; 0 for none
+OCR_QUOTA_REQUESTS = int(os.getenv("OCR_QUOTA_REQUESTS", 0))
+OCR_QUOTA_PERIOD_SECONDS = float(os.getenv("OCR_QUOTA_PERIOD_SECONDS", 3600))
+# quota batch jobs leave for interactive uploads
+OCR_QUOTA_INTERACTIVE_RESERVE = int(os.getenv("OCR_QUOTA_INTERACTIVE_RESERVE", 1))
+# reads receipts when the quota is used up; unset to defer them until it refills
+OCR_FALLBACK_PROVIDER = os.getenv("OCR_FALLBACK_PROVIDER") or None
+
+# readiness: how long /readyz waits for Mongo, and how often startup retries the indexes
+READY_TIMEOUT_SECONDS = float(os.getenv("READY_TIMEOUT_SECONDS", 2))
+BOOTSTRAP_RETRY_SECONDS = float(os.getenv("BOOTSTRAP_RETRY_SECONDS", 5))
+PORT = int(os.getenv("ML_CLIENT_PORT", 5002))
+
+_db = None
+_ocr_cache = None
+_scheduler = None
+_page_pool = None
+_connect_lock = threading.Lock()
+# set once start_workers has created the indexes
+indexes_ready = threading.Event()
+
+
+def get_db():
+    """The database, connected on first use rather than at import time."""
+    global _db, _ocr_cache, _scheduler
+    with _connect_lock:
+        if _db is None:
+            cxn = pymongo.MongoClient(os.getenv("MONGO_URI"),
+                                      event_listeners=[metrics.MongoCommandMetrics()])
+            _db = cxn[os.getenv("MONGO_DBNAME")]
+            # parsed OCR results, so re-uploads of the same receipt skip the Mindee API
+            _ocr_cache = OcrResultCache(
+                _db.ocr_cache,
+                max_entries=int(os.getenv("OCR_CACHE_SIZE", 256)),
+                ttl_seconds=int(os.getenv("OCR_CACHE_TTL_SECONDS", 7 * 24 * 3600)))
+            _scheduler = ocr_scheduler.OcrScheduler(
+                _db.ocr_quota, OCR_PROVIDER, capacity=OCR_QUOTA_REQUESTS,
+                period_seconds=OCR_QUOTA_PERIOD_SECONDS, reserve=OCR_QUOTA_INTERACTIVE_RESERVE,
+                fallback=OCR_FALLBACK_PROVIDER)
+        return _db
+
+
+def get_ocr_cache():
+    get_db()
+    return _ocr_cache
+
+
+def get_scheduler():
+    get_db()
+    return _scheduler
+
+
+def page_pool():
+    """Threads reading the pages of multi-page receipts, started on first use."""
+    global _page_pool
+    with _connect_lock:
+        if _page_pool is None:
+            _page_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=OCR_PAGE_CONCURRENCY, thread_name_prefix="ocr-page")
+        return _page_pool
+
+
+def get_provider(name=None):
+    """The configured OCR provider, created on first use."""
+    return ocr_providers.get_provider(name or OCR_PROVIDER)
+
+
+bp = Blueprint('ml', __name__)
+
+
+class ReceiptNotFound(LookupError):
+    """The receipt to read is gone, e.g. a draft expired while its job was queued."""
+
+
+def create_app():
+    """The service's Flask app; importing this module does no other setup."""
+    app = Flask(__name__)
+    app.secret_key = 'a_unique_and_secret_key'
+    # turn on debugging if in development mode
+    if os.getenv("FLASK_ENV", "development") == "development":
+        app.debug = True
+    # per-route latency, Mongo timings and OCR durations at /metrics
+    metrics.install(app)
+    app.register_blueprint(bp)
+    return app
+
+
+@bp.route('/healthz', methods=['GET'])
+def healthz():
+    """Liveness: the process is up and serving."""
+    return jsonify({'status': 'ok'}), 200
+
 
-# connect to the database
-cxn = pymongo.MongoClient(os.getenv("MONGO_URI"))
-db = cxn[os.getenv("MONGO_DBNAME")]  # store a reference to the database
+@bp.route('/readyz', methods=['GET'])
+def readyz():
+    """Readiness: Mongo answers and the indexes are in place, so jobs can run."""
+    status = {'indexes': indexes_ready.is_set(), 'provider': OCR_PROVIDER,
+              'loaded_providers': ocr_providers.loaded_providers()}
+    try:
+        with pymongo.timeout(READY_TIMEOUT_SECONDS):
+            get_db().command('ping')
+        status['mongo'] = 'ok'
+    except pymongo.errors.PyMongoError as e:
+        status['mongo'] = str(e)
+    ready = status['indexes'] and status['mongo'] == 'ok'
+    return jsonify(dict(status, ready=ready)), 200 if ready else 503
 
-@app.route('/predict', methods=['POST'])
+@bp.route('/predict', methods=['POST'])
 def pretdict_endpoint():
     # Get the image data from the request
     request_data = request.get_json()  # Extract JSON data from the request
@@ -37,67 +182,356 @@ def pretdict_endpoint():
         return jsonify({'error': 'Object_ID not found in request data'}), 400
     
     Object_ID = ObjectId(request_data['Object_ID']) 
-    logging.debug('OBJECT_ID MESSAGE:', Object_ID)
-    #image = db.receipts.find_one({"_id": Object_ID})['image']
-
-    # Here, you would add the code to perform OCR on the image
-    # For now, let's assume you have a function called perform_ocr that does this
-    
-    # Uncomment next line to perform OCR
-    data = perform_ocr(Object_ID)
-    logging.debug("data after ocr: %s", data) # debug
-    print("data after ocr: %s", data)
-    #data = json.load(open("response1.json", "r"))
-
-    # Connect to your collection (replace 'mycollection' with your collection name)
-    collection = db['receipts']
-
-    # Prepare the data to be inserted into the database
-    # line_items = data['document']['inference']['pages'][0]['prediction']['line_items']
-    receipt = data['document']['inference']['pages'][0]['prediction']
-    logging.debug('OCR Json Keys:', data['document']['inference']['pages'][0]['prediction'].keys()) # debug
-    print('OCR Json Keys:', data['document']['inference']['pages'][0]['prediction'].keys())
-    receipt_data = {
-        'receipt_name': receipt['supplier_name']['raw_value'],
-        'currency': receipt['locale']['currency'],
-        'items': [{'description': item['description'], 'amount': item['total_amount'], 'quantity': item['quantity']} for item in receipt['line_items']],
-        'total': receipt['total_amount']['value'],
-        'tax': receipt['total_tax']['value'],
-        'tip': receipt['tip']['value'],
-        'subtotal': receipt['total_net']['value'],
-    }
-    logging.debug(receipt_data)
-    print("receipt_data: %s", receipt_data)
-
-    # Update the document with given ObjectId
-    collection.update_one({'_id': Object_ID}, {'$set': receipt_data})
-    inserted_id = Object_ID
+    logger.debug("OBJECT_ID MESSAGE: %s", Object_ID)
+    lane = request_data.get('lane', 'interactive')
+    if lane not in ocr_scheduler.LANES:
+        return jsonify({'error': f'lane must be one of {list(ocr_scheduler.LANES)}'}), 400
+    try:
+        inserted_id = process_receipt(Object_ID, lane=lane)
+    except ocr_scheduler.Deferred as e:
+        return jsonify({'_id': str(Object_ID), 'status': 'deferred',
+                        'retry_after': round(e.retry_after)}), 202
+    except ocr_scheduler.OverCapacity as e:
+        return jsonify({'_id': str(Object_ID), 'error': str(e)}), 422
+    except ReceiptNotFound as e:
+        return jsonify({'_id': str(Object_ID), 'error': str(e)}), 404
 
     # Return the inserted_id as a JSON response
     return jsonify({'_id': str(inserted_id)})
 
-def perform_ocr(Object_ID):
-    logging.debug("starting perform_ocr function with mindee api...") # debug
-    url = "https://api.mindee.net/v1/products/mindee/expense_receipts/v5/predict"
-    api_key = os.getenv("OCR_API_KEY")  # Get the API key from environment variable
+def process_receipt(Object_ID, report=None, lane='interactive'):
+    """
+    Run OCR on a stored receipt image and save the parsed fields on it.
+    report, if given, is called with each progress stage as it is reached.
+    Provider calls go through the OCR scheduler for lane, so this raises
+    ocr_scheduler.Deferred when the quota is used up and there's no fallback,
+    and ocr_scheduler.OverCapacity for more pages than the lane's quota holds.
+    Raises ReceiptNotFound if the receipt was deleted while its job waited.
+    """
+    provider = get_scheduler().provider_for(lane)
+    db, ocr_cache = get_db(), get_ocr_cache()
+    receipt = db.receipts.find_one({"_id": Object_ID},
+                                   {"image_id": 1, "image_sha256": 1, "compact_image_id": 1,
+                                    "pages": 1, "archived_images": 1})
+    if receipt is None:
+        raise ReceiptNotFound(f"Receipt {Object_ID} no longer exists")
+    image_sha256 = receipt.get('image_sha256')
+    # results are cached per provider so a replayed receipt never stands in for a real one
+    key = f"{provider.name}:{image_sha256}"
+    receipt_data = ocr_cache.get(key) if image_sha256 else None
+    if receipt_data is not None:
+        logger.debug("OCR cache hit for %s", key)
+    elif len(receipt.get('pages', ())) > 1:
+        receipt_data = extract_pages(provider, Object_ID, receipt['pages'],
+                                     receipt.get('archived_images'))
+        ocr_cache.put(f"{provider.used}:{image_sha256}", receipt_data)
+    else:
+        with open_image(Object_ID, receipt) as image_file:
+            if image_sha256 is None:
+                image_sha256 = stream_hash(image_file)
+                key = f"{provider.name}:{image_sha256}"
+                receipt_data = ocr_cache.get(key)
+            if receipt_data is None:
+                image = compact_image(Object_ID, receipt, image_file)
+                receipt_data = provider.extract(Object_ID, image)
+                # keyed by who read it, so a fallback result never stands in for the provider's
+                ocr_cache.put(f"{provider.used}:{image_sha256}", receipt_data)
+    # parsed once here: amounts in cents, and ids for the items the split refers to
+    parsed = receipt_model.Receipt.from_ocr(receipt_data)
+    if report:
+        report('parsed')
 
-    # Fetch the image data from the database
-    image_data = db.receipts.find_one({"_id": Object_ID})['image']
-    file_path = f"receipt_{Object_ID}.jpg"  # Set the file path to save the image
-    logging.debug("file path: %s", file_path) # debug
+    # Update the document with given ObjectId, indexing it for the history search
+    tokens = search_tokens(*parsed.search_texts())
+    db.receipts.update_one({'_id': Object_ID},
+                           {'$set': parsed.to_bson(),
+                            '$addToSet': {'search_tokens': {'$each': tokens}},
+                            '$currentDate': {'updated_at': True}})
+    return Object_ID
 
-    # Save the image data to a file
-    with open(file_path, "wb") as f:
-        f.write(image_data)
-    
-    # Parse the file with the Mindee API
-    with open(file_path, "rb") as myfile:
-        files = {"document": myfile}
-        headers = {"Authorization": "Token " + api_key}
-        response = requests.post(url, files=files, headers=headers)
-        print("Type of response: ", type(response))
-        print("response.text: %s", response.text)
-        return response.json()
+def search_tokens(*texts):
+    """Lowercase word tokens for the history search; matches web-app/receipt_store.py."""
+    tokens = set()
+    for text in texts:
+        if text:
+            tokens.update(re.findall(r"[a-z0-9]+", str(text).lower()))
+    return sorted(tokens)
+
+def compact_image(Object_ID, receipt, image_file):
+    """
+    The preprocessed copy of a receipt image to send to OCR. It is saved in
+    GridFS next to the original the first time, so retries reuse it.
+    """
+    db = get_db()
+    fs = gridfs.GridFS(db)
+    if receipt.get('compact_image_id'):
+        return fs.get(receipt['compact_image_id'])
+    if not OCR_PREPROCESS:
+        return image_file
+
+    image_bytes = image_file.read()
+    compact, info = shrink_image(Object_ID, image_bytes)
+    if compact is None:
+        return io.BytesIO(image_bytes)
+    if 'archived_images' in receipt:
+        # don't put a derivative back in GridFS the archive pass won't see
+        return io.BytesIO(compact)
+
+    compact_id = fs.put(compact, filename=f"receipt_{Object_ID}_compact.jpg",
+                        metadata={"derived_from": receipt.get('image_id'),
+                                  "content_type": "image/jpeg"})
+    db.receipts.update_one({'_id': Object_ID},
+                           {'$set': {'compact_image_id': compact_id, 'preprocess': info}})
+    return io.BytesIO(compact)
+
+def shrink_image(Object_ID, image_bytes):
+    """The preprocessed image and its info, or (None, None) if it didn't come out smaller."""
+    try:
+        from preprocess import preprocess_image
+        compact, info = preprocess_image(image_bytes, max_long_edge=OCR_MAX_LONG_EDGE)
+    except Exception as e:  # not an image Pillow can read, e.g. a PDF; OCR the original
+        logger.warning("Could not preprocess image for %s: %s", Object_ID, str(e))
+        return None, None
+    logger.debug("Preprocessed %s: %s", Object_ID, info)
+    if len(compact) >= len(image_bytes):
+        return None, None
+    return compact, info
+
+def extract_pages(provider, Object_ID, pages, archived_images=None):
+    """
+    OCR the pages of a multi-page receipt in parallel, OCR_PAGE_CONCURRENCY
+    at a time, and merge them. Page images are shrunk in memory; unlike a
+    single image's, the compact copies aren't kept.
+
+    Each page's result is cached as soon as it is read, so a receipt deferred
+    part-way only reads its remaining pages next time, and their quota is
+    taken up front. A quota refusal on any page sends every page to the
+    fallback provider, so one receipt is never read by two providers.
+    archived_images are the receipt's, for pages the lifecycle housekeeper archived.
+    """
+    results = cached_pages(provider.name, pages)
+    provider.prepay(results.count(None))
+    if provider.used != provider.name:
+        results = cached_pages(provider.used, pages)
+    try:
+        read_pages(provider, Object_ID, pages, results, archived_images)
+    except ocr_scheduler.Deferred:
+        if not provider.use_fallback():
+            raise
+        results = cached_pages(provider.used, pages)
+        read_pages(provider, Object_ID, pages, results, archived_images)
+    return merge_pages(results)
+
+def cached_pages(provider_name, pages):
+    """The cached OCR result of each page read by provider_name, None where there is none."""
+    ocr_cache = get_ocr_cache()
+    return [ocr_cache.get(f"{provider_name}:{page['image_sha256']}")
+            if page.get('image_sha256') else None for page in pages]
+
+def read_pages(provider, Object_ID, pages, results, archived_images=None):
+    """Fill in the missing results; every page is finished (and cached) before an error is raised."""
+    futures = {number: page_pool().submit(extract_page, provider, Object_ID, page, archived_images)
+               for number, page in enumerate(pages) if results[number] is None}
+    concurrent.futures.wait(futures.values())
+    for number, future in futures.items():
+        results[number] = future.result()
+
+def extract_page(provider, Object_ID, page, archived_images=None):
+    with open_page(page, archived_images) as image_file:
+        image = image_file
+        if OCR_PREPROCESS:
+            image_bytes = image_file.read()
+            compact, _ = shrink_image(Object_ID, image_bytes)
+            image = io.BytesIO(compact or image_bytes)
+        receipt_data = provider.extract(Object_ID, image)
+    if page.get('image_sha256'):
+        get_ocr_cache().put(f"{provider.used}:{page['image_sha256']}", receipt_data)
+    return receipt_data
+
+def open_page(page, archived_images):
+    """File-like view of one page's image, in GridFS or, once archived, in the archive."""
+    if 'image_id' in page:
+        return gridfs.GridFS(get_db()).get(page['image_id'])
+    return lifecycle.open_archived_image(archived_images[page['archived']])
+
+def merge_pages(pages):
+    """
+    One receipt from its pages' OCR results, in page order: every page's
+    items, the merchant and currency from the first page that has them and
+    the totals from the last (they are printed at the end).
+    """
+    merged = {'items': [item for page in pages for item in page.get('items') or []]}
+    for field in ('receipt_name', 'currency'):
+        merged[field] = next((page[field] for page in pages if page.get(field) is not None), None)
+    for field in ('total', 'tax', 'tip', 'subtotal'):
+        merged[field] = next((page[field] for page in reversed(pages)
+                              if page.get(field) is not None), None)
+    if merged['subtotal'] is None:
+        merged['subtotal'] = round(sum(item.get('amount') or 0 for item in merged['items']), 2)
+    return merged
+
+def open_image(Object_ID, receipt):
+    """File-like view of a receipt image; GridFS files are read chunk by chunk."""
+    if 'image_id' in receipt:
+        return gridfs.GridFS(get_db()).get(receipt['image_id'])
+    if 'archived_images' in receipt:
+        # moved out of GridFS by the lifecycle housekeeper
+        return lifecycle.open_archived_image(receipt['archived_images']['original'])
+    # receipts uploaded before GridFS kept the bytes inline
+    return io.BytesIO(get_db().receipts.find_one({"_id": Object_ID}, {"image": 1})['image'])
+
+@bp.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify(get_ocr_cache().stats()), 200
+
+@bp.route('/scheduler_stats', methods=['GET'])
+def scheduler_stats():
+    """The OCR quota left, the queue in each lane and where calls have gone."""
+    return jsonify(get_scheduler().stats(get_db())), 200
+
+def claim_job():
+    """
+    Atomically take the oldest runnable job, or one whose worker died
+    mid-run. Interactive jobs go before batch jobs (see ocr_scheduler).
+    """
+    now = datetime.now(timezone.utc)
+    return get_db().ocr_jobs.find_one_and_update(
+        {'$or': [
+            {'status': 'queued', 'run_after': {'$lte': now}},
+            {'status': 'running', 'lease_expires_at': {'$lte': now}},
+        ]},
+        {'$set': {'status': 'running',
+                  'stage': 'ocr_running',
+                  'lease_expires_at': now + timedelta(seconds=OCR_JOB_LEASE_SECONDS),
+                  'updated_at': now},
+         '$push': {'stages': {'stage': 'ocr_running', 'at': now}},
+         '$inc': {'attempts': 1}},
+        sort=[('priority', pymongo.ASCENDING), ('created_at', pymongo.ASCENDING)],
+        return_document=pymongo.ReturnDocument.AFTER,
+    )
+
+def retry_delay(attempts):
+    """Exponential backoff with jitter so failed jobs don't retry in lockstep."""
+    delay = min(OCR_JOB_BACKOFF_SECONDS * 2 ** (attempts - 1), OCR_JOB_MAX_BACKOFF_SECONDS)
+    return delay * random.uniform(0.5, 1.0)
+
+def stage_update(stage, now, **fields):
+    """Job update recording a progress stage; the web app streams these to the browser."""
+    return {'$set': dict(fields, stage=stage, updated_at=now),
+            '$push': {'stages': {'stage': stage, 'at': now}}}
+
+def run_job(job):
+    lane = ocr_scheduler.lane(job)
+    if job.get('run_after'):
+        waited = datetime.now(timezone.utc) - ocr_scheduler.as_utc(job['run_after'])
+        metrics.OCR_QUEUE_WAIT_SECONDS.labels(lane).observe(max(waited.total_seconds(), 0))
+
+    def report(stage):
+        get_db().ocr_jobs.update_one({'_id': job['_id']},
+                               stage_update(stage, datetime.now(timezone.utc)))
+    try:
+        process_receipt(job['receipt_id'], report=report, lane=lane)
+    except ocr_scheduler.Deferred as e:
+        # waiting for quota isn't a failed attempt; the job keeps its place in its lane
+        logger.info("OCR job %s deferred for %.0fs", job['_id'], e.retry_after)
+        now = datetime.now(timezone.utc)
+        update = stage_update('deferred', now, status='queued', last_error=str(e),
+                              run_after=now + timedelta(seconds=e.retry_after))
+        update['$inc'] = {'attempts': -1}
+        update['$unset'] = {'lease_expires_at': ''}
+        get_db().ocr_jobs.update_one({'_id': job['_id']}, update)
+        metrics.OCR_JOBS.labels('deferred').inc()
+        return
+    except (ocr_scheduler.OverCapacity, ReceiptNotFound) as e:
+        # no retry can fit it in the quota or bring the receipt back; fail it now
+        logger.error("OCR job %s failed: %s", job['_id'], str(e))
+        update = stage_update('failed', datetime.now(timezone.utc), status='failed',
+                              last_error=str(e))
+        update['$unset'] = {'lease_expires_at': ''}
+        get_db().ocr_jobs.update_one({'_id': job['_id']}, update)
+        metrics.OCR_JOBS.labels('failed').inc()
+        return
+    except Exception as e:  # any OCR or parsing failure is retried
+        logger.exception("OCR job %s failed (attempt %d)", job['_id'], job['attempts'])
+        now = datetime.now(timezone.utc)
+        if job['attempts'] >= OCR_JOB_MAX_ATTEMPTS:
+            update = stage_update('failed', now, status='failed', last_error=str(e))
+        else:
+            update = stage_update('retrying', now, status='queued', last_error=str(e),
+                                  run_after=now + timedelta(seconds=retry_delay(job['attempts'])))
+        update['$unset'] = {'lease_expires_at': ''}
+        get_db().ocr_jobs.update_one({'_id': job['_id']}, update)
+        metrics.OCR_JOBS.labels(update['$set']['stage']).inc()
+        return
+    metrics.OCR_JOBS.labels('ready').inc()
+    update = stage_update('ready', datetime.now(timezone.utc), status='done', last_error=None)
+    update['$unset'] = {'lease_expires_at': ''}
+    get_db().ocr_jobs.update_one({'_id': job['_id']}, update)
+
+def ocr_worker(stop_event):
+    while not stop_event.is_set():
+        try:
+            get_scheduler().observe_queue(get_db())
+            job = claim_job()
+        except pymongo.errors.PyMongoError as e:
+            logger.error("Could not claim OCR job: %s", str(e))
+            job = None
+        if job is None:
+            stop_event.wait(OCR_JOB_POLL_SECONDS)
+            continue
+        run_job(job)
+
+def lifecycle_worker(stop_event):
+    while not stop_event.wait(LIFECYCLE_INTERVAL_SECONDS):
+        try:
+            stats = lifecycle.run_once(get_db(), ARCHIVE_DIR, ARCHIVE_AFTER_SECONDS,
+                                       ORPHAN_GRACE_SECONDS, OCR_TEMP_DIR, ORPHAN_GRACE_SECONDS)
+        except Exception:  # e.g. an unreadable temp dir; the next pass tries again
+            logger.exception("Lifecycle pass failed")
+            continue
+        logger.info("Lifecycle pass: %s", stats)
+
+def ensure_indexes():
+    db = get_db()
+    get_ocr_cache().ensure_indexes()
+    db.ocr_jobs.create_index([('status', pymongo.ASCENDING), ('run_after', pymongo.ASCENDING)])
+    # claim_job: runnable jobs, interactive lane first, oldest first
+    db.ocr_jobs.create_index([('status', pymongo.ASCENDING), ('priority', pymongo.ASCENDING),
+                              ('created_at', pymongo.ASCENDING)])
+    db.ocr_jobs.create_index('updated_at')  # the web app's progress poller scans by it
+    lifecycle.ensure_indexes(db, OCR_JOB_TTL_SECONDS)
+
+def bootstrap(stop_event):
+    """Create the indexes, retrying until Mongo is reachable, then mark the service ready."""
+    while not stop_event.is_set():
+        try:
+            ensure_indexes()
+        except pymongo.errors.PyMongoError as e:
+            logger.error("Could not create indexes, retrying: %s", str(e))
+            stop_event.wait(BOOTSTRAP_RETRY_SECONDS)
+            continue
+        indexes_ready.set()
+        return
+
+def start_workers(count=OCR_WORKERS):
+    """
+    Start the OCR worker pool and the lifecycle housekeeper as daemon threads.
+    Index creation runs in the background too, so the HTTP server can start
+    listening straight away.
+    """
+    stop_event = threading.Event()
+    threading.Thread(target=bootstrap, args=(stop_event,), name="bootstrap",
+                     daemon=True).start()
+    for i in range(count):
+        threading.Thread(target=ocr_worker, args=(stop_event,), name=f"ocr-worker-{i}",
+                         daemon=True).start()
+    if LIFECYCLE_INTERVAL_SECONDS > 0:
+        threading.Thread(target=lifecycle_worker, args=(stop_event,), name="lifecycle",
+                         daemon=True).start()
+    return stop_event
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5002)  # Run the app
\ No newline at end of file
+    app = create_app()
+    start_workers()
+    # the reloader would start a second copy of the worker pool
+    app.run(host='0.0.0.0', port=PORT, use_reloader=False)  # Run the app
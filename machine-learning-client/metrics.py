@@ -0,0 +1,148 @@
+"""
+Prometheus metrics for the machine-learning-client, served at /metrics.
+
+The request and Mongo metrics match the web app's (its metrics.py is the
+same module): install(app) times every request by route template and
+MongoCommandMetrics times every Mongo command. observe_ocr times each
+provider call and records the size of the image sent, and OCR_JOBS counts
+how queued jobs end. The OCR scheduler's metrics show where each call went,
+the quota left, how many jobs are queued in each lane and how long they
+waited. A few counter and histogram updates per event, cheap enough to
+leave on in production.
+"""
+import contextlib
+import os
+import threading
+import time
+
+from flask import Response, g, request
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge,
+                               Histogram, REGISTRY, generate_latest, multiprocess)
+from pymongo import monitoring
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+MONGO_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 5)
+
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Request latency by route",
+                            ["method", "route"], buckets=LATENCY_BUCKETS)
+REQUESTS = Counter("http_requests_total", "Requests by route and status",
+                   ["method", "route", "status"])
+REQUEST_ERRORS = Counter("http_request_errors_total",
+                         "Requests that failed with a 5xx or an unhandled exception",
+                         ["method", "route"])
+REQUEST_BYTES = Histogram("http_request_size_bytes", "Request body size by route",
+                          ["route"], buckets=SIZE_BUCKETS)
+RESPONSE_BYTES = Histogram("http_response_size_bytes", "Response body size by route",
+                           ["route"], buckets=SIZE_BUCKETS)
+MONGO_SECONDS = Histogram("mongo_command_duration_seconds", "Mongo command latency",
+                          ["command", "collection"], buckets=MONGO_BUCKETS)
+MONGO_FAILURES = Counter("mongo_command_failures_total", "Mongo commands that failed",
+                         ["command", "collection"])
+OCR_SECONDS = Histogram("ocr_duration_seconds", "OCR provider calls",
+                        ["provider", "outcome"], buckets=LATENCY_BUCKETS)
+OCR_IMAGE_BYTES = Histogram("ocr_image_size_bytes", "Size of the images sent to OCR",
+                            ["provider"], buckets=SIZE_BUCKETS)
+OCR_JOBS = Counter("ocr_jobs_total", "OCR jobs by how the attempt ended", ["outcome"])
+OCR_SCHEDULED = Counter("ocr_scheduled_calls_total",
+                        "OCR calls by lane and where they went: provider, fallback or deferred",
+                        ["lane", "route"])
+OCR_QUOTA_TOKENS = Gauge("ocr_quota_tokens", "Provider requests left in the quota bucket",
+                         ["provider"])
+OCR_QUEUE_DEPTH = Gauge("ocr_queue_depth", "Queued OCR jobs by lane", ["lane"])
+OCR_QUEUE_WAIT_SECONDS = Histogram("ocr_queue_wait_seconds",
+                                   "How long runnable OCR jobs waited for a worker, by lane",
+                                   ["lane"], buckets=LATENCY_BUCKETS + (60, 300, 900, 3600))
+
+
+def route_label():
+    """The matched route template, e.g. /numofpeople/<receipt_id>."""
+    rule = request.url_rule
+    return rule.rule if rule is not None else "unmatched"
+
+
+def observe_request(method, route, status, seconds, request_bytes, response_bytes):
+    REQUEST_SECONDS.labels(method, route).observe(seconds)
+    REQUESTS.labels(method, route, str(status)).inc()
+    if status >= 500:
+        REQUEST_ERRORS.labels(method, route).inc()
+    if request_bytes is not None:
+        REQUEST_BYTES.labels(route).observe(request_bytes)
+    if response_bytes is not None:
+        RESPONSE_BYTES.labels(route).observe(response_bytes)
+
+
+def metrics_view():
+    registry = REGISTRY
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def install(app):
+    """Time every request to app and add the /metrics route."""
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record(response):
+        started = g.pop("metrics_started", None)
+        if started is not None:
+            # never buffer a streamed response (progress events) just to measure it
+            observe_request(request.method, route_label(), response.status_code,
+                            time.perf_counter() - started, request.content_length,
+                            None if response.is_streamed else response.content_length)
+        return response
+
+    @app.teardown_request
+    def record_exception(exc):
+        # after_request is skipped when a view raises; count those here
+        if exc is not None and g.pop("metrics_started", None) is not None:
+            REQUEST_ERRORS.labels(request.method, route_label()).inc()
+
+    app.add_url_rule("/metrics", "metrics", metrics_view)
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Times every command a MongoClient sends; pass it in event_listeners."""
+
+    def __init__(self):
+        # (connection, request id) -> collection, between started and finished
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):  # getMore names its cursor, not the collection
+            collection = event.command.get("collection", "")
+        with self._lock:
+            self._collections[(event.connection_id, event.request_id)] = collection
+
+    def _collection(self, event):
+        with self._lock:
+            return self._collections.pop((event.connection_id, event.request_id), "")
+
+    def succeeded(self, event):
+        MONGO_SECONDS.labels(event.command_name, self._collection(event)) \
+            .observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        collection = self._collection(event)
+        MONGO_SECONDS.labels(event.command_name, collection).observe(event.duration_micros / 1e6)
+        MONGO_FAILURES.labels(event.command_name, collection).inc()
+
+
+@contextlib.contextmanager
+def observe_ocr(provider, image_bytes):
+    """Time one OCR provider call on an image of image_bytes bytes."""
+    OCR_IMAGE_BYTES.labels(provider).observe(image_bytes)
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        OCR_SECONDS.labels(provider, outcome).observe(time.perf_counter() - started)
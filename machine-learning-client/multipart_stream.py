@@ -0,0 +1,46 @@
+import os
+import uuid
+
+
+class MultipartFileStream:
+    """
+    A multipart/form-data request body holding a single file part.
+
+    The file is read chunk by chunk while the request is being sent, so only
+    one chunk is in memory at a time and nothing is written to disk. The total
+    length is known up front, which lets requests send a Content-Length header
+    instead of falling back to chunked transfer encoding.
+    """
+
+    def __init__(self, field_name, filename, fileobj,
+                 content_type="application/octet-stream", chunk_size=64 * 1024):
+        self.boundary = uuid.uuid4().hex
+        self._head = (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field_name}"; filename="{filename}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode()
+        self._tail = f"\r\n--{self.boundary}--\r\n".encode()
+        self._file = fileobj
+        self._chunk_size = chunk_size
+        self._file_length = _remaining_length(fileobj)
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return len(self._head) + self._file_length + len(self._tail)
+
+    def __iter__(self):
+        yield self._head
+        for chunk in iter(lambda: self._file.read(self._chunk_size), b""):
+            yield chunk
+        yield self._tail
+
+
+def _remaining_length(fileobj):
+    position = fileobj.tell()
+    end = fileobj.seek(0, os.SEEK_END)
+    fileobj.seek(position)
+    return end - position
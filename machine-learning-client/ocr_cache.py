@@ -0,0 +1,110 @@
+import copy
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+
+def stream_hash(image_file, chunk_size=255 * 1024):
+    """
+    Content hash used as the cache key for an image. The file is hashed chunk
+    by chunk and left rewound for the next reader.
+    """
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: image_file.read(chunk_size), b""):
+        digest.update(chunk)
+    image_file.seek(0)
+    return digest.hexdigest()
+
+
+class OcrResultCache:
+    """
+    Parsed OCR results keyed by image hash.
+
+    Recent entries are kept in memory with LRU eviction, and every entry is
+    also written to a Mongo collection whose TTL index expires it, so results
+    survive restarts and are shared between ML client replicas. Both copies
+    expire ttl_seconds after the result was stored: memory entries keep the
+    time they were stored, and Mongo documents the TTL monitor hasn't
+    removed yet are treated as gone.
+    """
+
+    def __init__(self, collection, max_entries=256, ttl_seconds=7 * 24 * 3600):
+        self.collection = collection
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.mongo_hits = 0
+        self.misses = 0
+
+    def ensure_indexes(self):
+        """
+        The TTL index on created_at. When OCR_CACHE_TTL_SECONDS has changed
+        since it was made, its expiry is changed in place with collMod:
+        create_index would fail with IndexOptionsConflict.
+        """
+        existing = self.collection.index_information().get("created_at_1")
+        if existing is not None and existing.get("expireAfterSeconds") != self.ttl_seconds:
+            self.collection.database.command(
+                "collMod", self.collection.name,
+                index={"keyPattern": {"created_at": 1}, "expireAfterSeconds": self.ttl_seconds})
+            return
+        self.collection.create_index("created_at", expireAfterSeconds=self.ttl_seconds)
+
+    def _expired(self, created_at):
+        if created_at.tzinfo is None:  # Mongo hands back naive UTC
+            created_at = created_at.replace(tzinfo=timezone.utc)
+        return (datetime.now(timezone.utc) - created_at).total_seconds() >= self.ttl_seconds
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                receipt_data, created_at = entry
+                if not self._expired(created_at):
+                    self._entries.move_to_end(key)
+                    self.memory_hits += 1
+                    return copy.deepcopy(receipt_data)
+                del self._entries[key]
+
+        doc = self.collection.find_one({"_id": key}, {"receipt_data": 1, "created_at": 1})
+        with self._lock:
+            if doc is None or self._expired(doc["created_at"]):
+                self.misses += 1
+                return None
+            self.mongo_hits += 1
+            self._remember(key, doc["receipt_data"], doc["created_at"])
+        return copy.deepcopy(doc["receipt_data"])
+
+    def put(self, key, receipt_data):
+        receipt_data = copy.deepcopy(receipt_data)
+        created_at = datetime.now(timezone.utc)
+        with self._lock:
+            self._remember(key, receipt_data, created_at)
+        self.collection.replace_one(
+            {"_id": key},
+            {"receipt_data": receipt_data, "created_at": created_at},
+            upsert=True,
+        )
+
+    def _remember(self, key, receipt_data, created_at):
+        self._entries[key] = (receipt_data, created_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            hits = self.memory_hits + self.mongo_hits
+            lookups = hits + self.misses
+            return {
+                "hits": hits,
+                "memory_hits": self.memory_hits,
+                "mongo_hits": self.mongo_hits,
+                "misses": self.misses,
+                "hit_ratio": hits / lookups if lookups else 0.0,
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+            }
@@ -0,0 +1,249 @@
+"""
+OCR providers: turn a receipt image into the receipt fields the web app uses.
+
+A provider is only created when a job first needs it (get_provider), and the
+heavy dependencies each one uses are imported then as well: requests for
+Mindee, Pillow and pytesseract (inside the process pool) for local OCR. A
+replica that serves the replay provider never loads either, and none of
+them slow down the service coming up.
+"""
+import io
+import json
+import logging
+import os
+import re
+import threading
+
+from multipart_stream import MultipartFileStream
+
+logger = logging.getLogger(__name__)
+
+MINDEE_URL = "https://api.mindee.net/v1/products/mindee/expense_receipts/v5/predict"
+
+
+class QuotaExceeded(Exception):
+    """The provider refused a request because the API key is out of quota."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"OCR quota exceeded, retry after {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class OcrProvider:
+    """
+    Turns a receipt image into the receipt fields the web app uses:
+    receipt_name, currency, items (description, amount, quantity), total,
+    tax, tip and subtotal.
+    """
+    name = None
+
+    def extract(self, Object_ID, image_file):
+        raise NotImplementedError
+
+
+class MindeeProvider(OcrProvider):
+    """The Mindee expense receipts API; rate limited on the free key."""
+    name = "mindee"
+
+    def __init__(self):
+        import requests
+        self.session = requests.Session()
+
+    def extract(self, Object_ID, image_file):
+        data = perform_ocr(self.session, Object_ID, image_file)
+        logger.debug("data after ocr: %s", data)
+        return parse_ocr_response(data)
+
+
+def perform_ocr(session, Object_ID, image_file):
+    logger.debug("starting perform_ocr function with mindee api...")
+    api_key = os.getenv("OCR_API_KEY")  # Get the API key from environment variable
+
+    # Stream the image from Mongo straight into the request body, no temp file
+    metadata = getattr(image_file, "metadata", None) or {}
+    body = MultipartFileStream("document", f"receipt_{Object_ID}.jpg", image_file,
+                               content_type=metadata.get("content_type") or "image/jpeg")
+    headers = {"Authorization": "Token " + api_key, "Content-Type": body.content_type}
+    response = session.post(MINDEE_URL, data=body, headers=headers)
+    logger.debug("response.text: %s", response.text)
+    if response.status_code == 429:
+        raise QuotaExceeded(retry_after_seconds(response.headers.get("Retry-After")))
+    return response.json()
+
+
+def retry_after_seconds(header, default=60):
+    """Seconds from a Retry-After header given in seconds; default if missing or a date."""
+    try:
+        return max(float(header), 0)
+    except (TypeError, ValueError):
+        return default
+
+
+def stream_size(image_file):
+    """Bytes in a seekable image stream, leaving its position where it was."""
+    position = image_file.tell()
+    image_file.seek(0, io.SEEK_END)
+    size = image_file.tell()
+    image_file.seek(position)
+    return size
+
+
+class ReplayProvider(OcrProvider):
+    """
+    Serves a recorded OCR response for every image, for offline development
+    and load tests. Both Mindee and Asprise (response1.json) recordings work.
+    """
+    name = "replay"
+
+    def __init__(self, path=None):
+        path = path or os.getenv("OCR_REPLAY_FILE",
+                                 os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                              "response1.json"))
+        with open(path, "r") as f:
+            data = json.load(f)
+        if 'document' in data:
+            self.receipt_data = parse_ocr_response(data)
+        else:
+            self.receipt_data = parse_asprise_response(data)
+
+    def extract(self, Object_ID, image_file):
+        return json.loads(json.dumps(self.receipt_data))  # a fresh copy per receipt
+
+
+class LocalOcrProvider(OcrProvider):
+    """
+    Tesseract OCR on this machine plus a line-item parser, with no API quota.
+    Recognition runs in a process pool sized to the CPU count, so throughput
+    scales with cores; run at least that many OCR_WORKERS to keep it busy.
+    """
+    name = "local"
+
+    def __init__(self, processes=None):
+        self.processes = processes or int(os.getenv("LOCAL_OCR_PROCESSES", 0)) or os.cpu_count()
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                from concurrent.futures import ProcessPoolExecutor
+                self._pool = ProcessPoolExecutor(max_workers=self.processes)
+            return self._pool
+
+    def extract(self, Object_ID, image_file):
+        text = self.pool.submit(local_ocr, image_file.read()).result()
+        logger.debug("local ocr text for %s: %s", Object_ID, text)
+        return parse_receipt_text(text)
+
+
+OCR_PROVIDERS = {
+    MindeeProvider.name: MindeeProvider,
+    ReplayProvider.name: ReplayProvider,
+    LocalOcrProvider.name: LocalOcrProvider,
+}
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def get_provider(name):
+    """The named OCR provider, created on first use."""
+    with _providers_lock:
+        if name not in _providers:
+            if name not in OCR_PROVIDERS:
+                raise ValueError(f"Unknown OCR_PROVIDER {name!r}, expected one of {sorted(OCR_PROVIDERS)}")
+            _providers[name] = OCR_PROVIDERS[name]()
+        return _providers[name]
+
+
+def loaded_providers():
+    with _providers_lock:
+        return sorted(_providers)
+
+
+def parse_ocr_response(data):
+    """Pull the fields the web app needs out of a Mindee receipt prediction."""
+    receipt = data['document']['inference']['pages'][0]['prediction']
+    logger.debug("OCR Json Keys: %s", receipt.keys())
+    receipt_data = {
+        'receipt_name': receipt['supplier_name']['raw_value'],
+        'currency': receipt['locale']['currency'],
+        'items': [{'description': item['description'], 'amount': item['total_amount'], 'quantity': item['quantity']} for item in receipt['line_items']],
+        'total': receipt['total_amount']['value'],
+        'tax': receipt['total_tax']['value'],
+        'tip': receipt['tip']['value'],
+        'subtotal': receipt['total_net']['value'],
+    }
+    logger.debug("receipt_data: %s", receipt_data)
+    return receipt_data
+
+
+def parse_asprise_response(data):
+    """The same fields from an Asprise receipt OCR response, like response1.json."""
+    receipt = data['receipts'][0]
+    return {
+        'receipt_name': receipt['merchant_name'],
+        'currency': receipt['currency'],
+        'items': [{'description': item['description'], 'amount': item['amount'], 'quantity': item['qty']} for item in receipt['items']],
+        'total': receipt['total'],
+        'tax': receipt['tax'],
+        'tip': receipt['tip'],
+        'subtotal': receipt['subtotal'],
+    }
+
+
+def local_ocr(image_bytes):
+    """Recognise the text on a receipt image. Runs inside the local OCR process pool."""
+    try:
+        from PIL import Image
+        import pytesseract
+    except ImportError as e:
+        raise RuntimeError("The local OCR provider needs Pillow, pytesseract and tesseract-ocr") from e
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        # --psm 6 reads the receipt as one block so each printed row stays on one line
+        return pytesseract.image_to_string(image.convert("L"), config="--psm 6")
+
+
+_AMOUNT = r"\$?\s*(-?\d+(?:[.,]\d{2}))"
+_LINE_ITEM_RE = re.compile(r"^\s*(?:(\d+)\s*[xX]?\s+)?(.*?[A-Za-z].*?)\s+" + _AMOUNT + r"\s*$")
+_TOTAL_RE = re.compile(r"^\s*(sub\s*-?\s*total|tax|tip|gratuity|total)\b[^0-9$-]*" + _AMOUNT, re.IGNORECASE)
+# lines with prices that are not things anyone ate
+_NOT_AN_ITEM_RE = re.compile(r"\b(total|tax|tip|gratuity|change|cash|visa|mastercard|amex|card|balance|due|paid)\b",
+                             re.IGNORECASE)
+
+
+def parse_receipt_text(text):
+    """
+    Line items and totals from plain receipt text. The merchant is taken to be
+    the first line, items are lines ending in a price, and the subtotal, tax,
+    tip and total come from their labelled lines.
+    """
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    totals = {}
+    items = []
+    for line in lines:
+        match = _TOTAL_RE.match(line)
+        if match:
+            label = re.sub(r"[\s-]", "", match.group(1).lower())
+            label = 'tip' if label == 'gratuity' else label
+            totals.setdefault(label, _to_amount(match.group(2)))
+            continue
+        match = _LINE_ITEM_RE.match(line)
+        if match and not _NOT_AN_ITEM_RE.search(match.group(2)):
+            items.append({'description': match.group(2).strip(' .:'),
+                          'amount': _to_amount(match.group(3)),
+                          'quantity': int(match.group(1)) if match.group(1) else 1})
+    subtotal = totals.get('subtotal', round(sum(item['amount'] for item in items), 2))
+    return {
+        'receipt_name': lines[0] if lines else None,
+        'currency': None,
+        'items': items,
+        'total': totals.get('total'),
+        'tax': totals.get('tax'),
+        'tip': totals.get('tip'),
+        'subtotal': subtotal,
+    }
+
+
+def _to_amount(text):
+    return float(text.replace(',', '.'))
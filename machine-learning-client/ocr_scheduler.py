@@ -0,0 +1,297 @@
+"""
+Spend the OCR provider's request quota on the receipts that need it most.
+
+The free Mindee key allows a couple of requests an hour. OcrScheduler keeps
+a token bucket for the configured provider in Mongo (one ocr_quota document
+per provider), so every replica draws on the same budget: capacity tokens,
+refilled evenly over period_seconds. Every call to the provider takes a
+token; OCR cache hits take none. A 429 from the provider empties the bucket
+until its Retry-After.
+
+Jobs come in two lanes, by their priority field: interactive uploads (0)
+are claimed before batch and backfill jobs (1), and batch calls leave the
+last `reserve` tokens to interactive ones. A call that gets no token goes to
+the fallback provider if one is configured (e.g. local OCR). Otherwise it
+raises Deferred, and the worker puts the job back in the queue until a token
+is due, without counting it as a failed attempt.
+
+A multi-page receipt takes a token for every page it still needs at once,
+before any page is read (ScheduledProvider.prepay). A 429 on one of its
+pages sends the whole receipt to the fallback, so a receipt is never read
+by two providers; without a fallback it is deferred, and the pages already
+read are kept in the OCR cache for the next try (main.extract_pages). One
+with more pages than its lane can ever take at once goes to the fallback,
+or fails with OverCapacity rather than being deferred forever.
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+import pymongo
+
+import metrics
+import ocr_providers
+
+logger = logging.getLogger(__name__)
+
+LANES = ("interactive", "batch")
+INTERACTIVE, BATCH = range(len(LANES))
+# attempts at taking a token while other replicas keep taking them first
+MAX_ATTEMPTS = 5
+
+
+class Deferred(Exception):
+    """No quota for this call and no fallback provider; try again after retry_after seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"OCR quota used up, deferred for {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class OverCapacity(Exception):
+    """The job needs more provider calls at once than its lane's share of the quota holds."""
+
+
+def lane(job):
+    """The lane of a queued job; jobs queued before lanes existed are interactive."""
+    return LANES[min(job.get('priority') or INTERACTIVE, BATCH)]
+
+
+def as_utc(moment):
+    """Mongo hands back naive UTC datetimes."""
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+class QuotaBucket:
+    """
+    A token bucket kept in one Mongo document, shared by every replica.
+    Tokens are worked out from the stored level and the time since it was
+    stored; takes are guarded by a version number so none are lost.
+    """
+
+    def __init__(self, collection, name, capacity, period_seconds):
+        self.collection = collection
+        self.name = name
+        self.capacity = capacity
+        self.rate = capacity / period_seconds
+
+    def _level(self, doc, now):
+        if doc is None:
+            return float(self.capacity)
+        elapsed = (now - as_utc(doc['refilled_at'])).total_seconds()
+        return min(float(self.capacity), doc['tokens'] + max(elapsed, 0) * self.rate)
+
+    def tokens(self):
+        return self._level(self.collection.find_one({'_id': self.name}),
+                           datetime.now(timezone.utc))
+
+    def take(self, reserve=0, count=1):
+        """Take count tokens if reserve are still left after. Returns (taken, tokens left)."""
+        tokens = 0.0
+        for _ in range(MAX_ATTEMPTS):
+            now = datetime.now(timezone.utc)
+            doc = self.collection.find_one({'_id': self.name})
+            tokens = self._level(doc, now)
+            if tokens < reserve + count:
+                return False, tokens
+            if doc is None:
+                try:
+                    self.collection.insert_one({'_id': self.name, 'tokens': tokens - count,
+                                                'refilled_at': now, 'version': 1})
+                    return True, tokens - count
+                except pymongo.errors.DuplicateKeyError:
+                    continue
+            result = self.collection.update_one(
+                {'_id': self.name, 'version': doc['version']},
+                {'$set': {'tokens': tokens - count, 'refilled_at': now}, '$inc': {'version': 1}})
+            if result.matched_count:
+                return True, tokens - count
+        # other replicas kept winning the race; treat the bucket as empty for this call
+        return False, tokens
+
+    def seconds_until(self, reserve=0, count=1):
+        """How long until a take of count tokens with this reserve could succeed."""
+        return max(reserve + count - self.tokens(), 0) / self.rate
+
+    def drain(self, seconds):
+        """Empty the bucket for the next seconds, e.g. after the provider answered 429."""
+        self.collection.update_one(
+            {'_id': self.name},
+            {'$set': {'tokens': -seconds * self.rate, 'refilled_at': datetime.now(timezone.utc)},
+             '$inc': {'version': 1}},
+            upsert=True)
+
+
+class OcrScheduler:
+    """
+    Decides, call by call, whether a receipt is read by the configured
+    provider, the fallback provider or not yet. capacity 0 means the
+    provider has no quota and every call goes to it.
+    """
+
+    def __init__(self, collection, provider, capacity=0, period_seconds=3600, reserve=0,
+                 fallback=None, queue_metrics_seconds=5):
+        self.provider = provider
+        self.bucket = QuotaBucket(collection, provider, capacity, period_seconds) \
+            if capacity > 0 else None
+        self.reserve = reserve
+        self.fallback = fallback if fallback and fallback != provider else None
+        self.queue_metrics_seconds = queue_metrics_seconds
+        self._queue_checked = 0.0
+        self._lock = threading.Lock()
+        self.calls = {(name, route): 0 for name in LANES
+                      for route in ('provider', 'fallback', 'deferred')}
+
+    def _count(self, lane_name, route):
+        with self._lock:
+            self.calls[(lane_name, route)] += 1
+        metrics.OCR_SCHEDULED.labels(lane_name, route).inc()
+
+    def _reserve(self, lane_name):
+        return self.reserve if lane_name != 'interactive' else 0
+
+    def usable(self, lane_name):
+        """The most provider calls this lane can take at once; None without a quota."""
+        if self.bucket is None:
+            return None
+        return self.bucket.capacity - self._reserve(lane_name)
+
+    def take(self, lane_name, count=1):
+        """Whether this lane may make count provider calls now; takes the tokens if it may."""
+        if self.bucket is None:
+            return True
+        taken, tokens = self.bucket.take(self._reserve(lane_name), count)
+        metrics.OCR_QUOTA_TOKENS.labels(self.provider).set(tokens)
+        return taken
+
+    def exhausted(self, retry_after):
+        """The provider refused a call for quota; stop calling it for retry_after seconds."""
+        logger.warning("OCR provider %s is out of quota for %.0fs", self.provider, retry_after)
+        if self.bucket is not None:
+            self.bucket.drain(retry_after)
+            metrics.OCR_QUOTA_TOKENS.labels(self.provider).set(0)
+
+    def retry_after(self, lane_name, at_least=0, count=1):
+        if self.bucket is None:
+            return at_least
+        return max(self.bucket.seconds_until(self._reserve(lane_name), count), at_least)
+
+    def provider_for(self, lane_name):
+        """An OcrProvider for one job in lane_name that goes through this scheduler."""
+        return ScheduledProvider(self, lane_name)
+
+    def observe_queue(self, db, force=False):
+        """Refresh the queue depth gauges, at most every queue_metrics_seconds."""
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._queue_checked < self.queue_metrics_seconds:
+                return None
+            self._queue_checked = now
+        depth = {
+            'interactive': db.ocr_jobs.count_documents(
+                {'status': 'queued', 'priority': {'$ne': BATCH}}),
+            'batch': db.ocr_jobs.count_documents({'status': 'queued', 'priority': BATCH}),
+        }
+        for name, count in depth.items():
+            metrics.OCR_QUEUE_DEPTH.labels(name).set(count)
+        return depth
+
+    def stats(self, db):
+        with self._lock:
+            calls = {f"{name}_{route}": count for (name, route), count in self.calls.items()}
+        return {
+            'provider': self.provider,
+            'fallback': self.fallback,
+            'quota': None if self.bucket is None else {
+                'capacity': self.bucket.capacity,
+                'tokens': round(self.bucket.tokens(), 2),
+                'per_hour': round(self.bucket.rate * 3600, 2),
+                'interactive_reserve': self.reserve},
+            'queue_depth': self.observe_queue(db, force=True),
+            'calls': calls,
+        }
+
+
+class ScheduledProvider(ocr_providers.OcrProvider):
+    """
+    The provider one job's calls go through. name is the configured
+    provider's, for the OCR cache lookup; used is the provider that actually
+    read the receipt, so a fallback result is never cached as the
+    configured provider's.
+    """
+
+    def __init__(self, scheduler, lane_name):
+        self.scheduler = scheduler
+        self.lane = lane_name
+        self.name = scheduler.provider
+        self.used = scheduler.provider
+        self.prepaid = 0  # tokens taken by prepay and not yet spent
+        self.whole_receipt = False  # set by prepay: a 429 on one page decides for all of them
+        self._lock = threading.Lock()
+
+    def prepay(self, calls):
+        """
+        Take the tokens for calls provider calls (the pages of one receipt)
+        before any is made. Without them every call goes to the fallback, or
+        this raises Deferred, or OverCapacity if the lane can never hold them.
+        """
+        self.whole_receipt = True
+        usable = self.scheduler.usable(self.lane)
+        if usable is None or calls == 0:
+            return
+        if calls > usable:
+            logger.warning("%d OCR calls for one receipt exceed the %s lane's quota of %d",
+                           calls, self.lane, usable)
+            if self.scheduler.fallback is None:
+                raise OverCapacity(f"{calls} pages need more than the {usable} OCR calls "
+                                   f"the {self.lane} lane can make at once")
+            self.used = self.scheduler.fallback
+        elif self.scheduler.take(self.lane, calls):
+            self.prepaid = calls
+        elif self.scheduler.fallback is None:
+            self.scheduler._count(self.lane, 'deferred')
+            raise Deferred(self.scheduler.retry_after(self.lane, count=calls))
+        else:
+            self.used = self.scheduler.fallback
+
+    def use_fallback(self):
+        """Send the rest of this job's calls to the fallback; False if there is none."""
+        if self.scheduler.fallback is None:
+            return False
+        self.used = self.scheduler.fallback
+        return True
+
+    def _take(self):
+        with self._lock:
+            if self.used != self.scheduler.provider:
+                return False  # prepay or an earlier 429 sent this receipt to the fallback
+            if self.prepaid:
+                self.prepaid -= 1
+                return True
+        return self.scheduler.take(self.lane)
+
+    def extract(self, Object_ID, image_file):
+        retry_after = 0
+        if self._take():
+            try:
+                return self._extract(self.scheduler.provider, Object_ID, image_file)
+            except ocr_providers.QuotaExceeded as e:
+                self.scheduler.exhausted(e.retry_after)
+                retry_after = e.retry_after
+                image_file.seek(0)
+                if self.whole_receipt:
+                    # the caller re-reads every page with the fallback, or defers them all
+                    if self.scheduler.fallback is None:
+                        self.scheduler._count(self.lane, 'deferred')
+                    raise Deferred(self.scheduler.retry_after(self.lane, retry_after))
+        if self.scheduler.fallback is None:
+            self.scheduler._count(self.lane, 'deferred')
+            raise Deferred(self.scheduler.retry_after(self.lane, retry_after))
+        self.used = self.scheduler.fallback
+        return self._extract(self.scheduler.fallback, Object_ID, image_file, 'fallback')
+
+    def _extract(self, name, Object_ID, image_file, route='provider'):
+        self.scheduler._count(self.lane, route)
+        with metrics.observe_ocr(name, ocr_providers.stream_size(image_file)):
+            return ocr_providers.get_provider(name).extract(Object_ID, image_file)
@@ -0,0 +1,143 @@
+"""
+The receipt and line items as typed objects instead of free-form dicts.
+
+Both services use this module (web-app/receipt_model.py and
+machine-learning-client/receipt_model.py are the same file; change both).
+The ML client parses each OCR result into a Receipt once, at ingest: amounts
+become integer cents, quantities whole numbers, and every line item gets a
+uuid4 _id that stays with it for good, which select_appetizers, allocateitems
+and the split key on. The web app reads stored items back with
+LineItem.from_bson instead of converting each amount in every route.
+
+to_bson() writes the fields the receipts collection already uses, amounts in
+dollars, so receipts stored before this module need no migration. It writes
+only what is known: empty totals and the default is_appetizer are left out.
+"""
+import uuid
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+# receipt-level amounts, by their field name in the receipts collection
+TOTAL_FIELDS = ("total", "tax", "tip", "subtotal")
+
+
+class InvalidReceipt(ValueError):
+    """An OCR result or stored receipt with a field that cannot be read."""
+
+
+def to_cents(amount):
+    """A dollar amount (float, str or Decimal) as whole cents; None stays None."""
+    if amount is None:
+        return None
+    try:
+        return int(Decimal(str(amount)).scaleb(2).to_integral_value(rounding=ROUND_HALF_UP))
+    except (InvalidOperation, ValueError, OverflowError) as e:
+        raise InvalidReceipt(f"Invalid amount: {amount!r}") from e
+
+
+def to_dollars(cents):
+    return None if cents is None else cents / 100
+
+
+def _quantity(value):
+    """OCR quantities come as None, floats like 1.0 or strings; at least one of each item."""
+    if value is None:
+        return 1
+    try:
+        return max(1, int(Decimal(str(value)).to_integral_value(rounding=ROUND_HALF_UP)))
+    except (InvalidOperation, ValueError, OverflowError) as e:
+        raise InvalidReceipt(f"Invalid quantity: {value!r}") from e
+
+
+class LineItem:
+    """One line of a receipt: amount_cents is the line total, for all of quantity."""
+    __slots__ = ("id", "description", "amount_cents", "quantity", "is_appetizer")
+
+    def __init__(self, description, amount_cents, quantity=1, is_appetizer=False, id=None):
+        self.id = id
+        self.description = description
+        self.amount_cents = amount_cents
+        self.quantity = quantity
+        self.is_appetizer = is_appetizer
+
+    @classmethod
+    def from_ocr(cls, data):
+        """A new item from a provider's line item, with a fresh id."""
+        description = data.get("description")
+        return cls(description=str(description).strip() if description is not None else "",
+                   amount_cents=to_cents(data.get("amount")) or 0,
+                   quantity=_quantity(data.get("quantity")),
+                   id=str(uuid.uuid4()))
+
+    @classmethod
+    def from_bson(cls, doc):
+        """An item as stored on a receipt; items stored before ids were assigned have id None."""
+        item_id = doc.get("_id")
+        return cls(description=doc.get("description") or "",
+                   amount_cents=to_cents(doc.get("amount")) or 0,
+                   quantity=_quantity(doc.get("quantity")),
+                   is_appetizer=bool(doc.get("is_appetizer", False)),
+                   id=None if item_id is None else str(item_id))
+
+    @property
+    def amount(self):
+        return to_dollars(self.amount_cents)
+
+    def to_bson(self):
+        doc = {"_id": self.id, "description": self.description,
+               "amount": to_dollars(self.amount_cents), "quantity": self.quantity}
+        if self.id is None:
+            del doc["_id"]
+        if self.is_appetizer:
+            doc["is_appetizer"] = True
+        return doc
+
+    def __repr__(self):
+        return f"LineItem({self.description!r}, {self.amount_cents}, id={self.id!r})"
+
+
+class Receipt:
+    """What OCR read off a receipt: the merchant, the line items and the totals in cents."""
+    __slots__ = ("receipt_name", "currency", "items",
+                 "total_cents", "tax_cents", "tip_cents", "subtotal_cents")
+
+    def __init__(self, receipt_name=None, currency=None, items=(), total_cents=None,
+                 tax_cents=None, tip_cents=None, subtotal_cents=None):
+        self.receipt_name = receipt_name
+        self.currency = currency
+        self.items = list(items)
+        self.total_cents = total_cents
+        self.tax_cents = tax_cents
+        self.tip_cents = tip_cents
+        self.subtotal_cents = subtotal_cents
+
+    @classmethod
+    def from_ocr(cls, data):
+        """A receipt from a provider's result (see ocr_providers.OcrProvider), items newly ided."""
+        return cls(receipt_name=data.get("receipt_name"), currency=data.get("currency"),
+                   items=[LineItem.from_ocr(item) for item in data.get("items") or []],
+                   **{f"{field}_cents": to_cents(data.get(field)) for field in TOTAL_FIELDS})
+
+    @classmethod
+    def from_bson(cls, doc):
+        return cls(receipt_name=doc.get("receipt_name"), currency=doc.get("currency"),
+                   items=[LineItem.from_bson(item) for item in doc.get("items") or []],
+                   **{f"{field}_cents": to_cents(doc.get(field)) for field in TOTAL_FIELDS})
+
+    def to_bson(self):
+        """The OCR fields to $set on the receipt document."""
+        doc = {"items": [item.to_bson() for item in self.items]}
+        for field in ("receipt_name", "currency"):
+            if getattr(self, field) is not None:
+                doc[field] = getattr(self, field)
+        for field in TOTAL_FIELDS:
+            cents = getattr(self, f"{field}_cents")
+            if cents is not None:
+                doc[field] = to_dollars(cents)
+        return doc
+
+    def search_texts(self):
+        """The merchant and item descriptions, for the history search tokens."""
+        return [self.receipt_name, *(item.description for item in self.items)]
+
+    def __repr__(self):
+        return f"Receipt({self.receipt_name!r}, {len(self.items)} items, total_cents={self.total_cents})"
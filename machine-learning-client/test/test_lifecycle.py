@@ -0,0 +1,182 @@
+import gzip
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import gridfs
+import mongomock
+import mongomock.gridfs
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import lifecycle  # noqa: E402
+
+mongomock.gridfs.enable_gridfs_integration()
+
+NOW = datetime.now(timezone.utc)
+LONG_AGO = NOW - timedelta(days=60)
+
+
+def new_db():
+    return mongomock.MongoClient().db
+
+
+def age_files(db, uploaded):
+    db.fs.files.update_many({}, {'$set': {'uploadDate': uploaded}})
+
+
+def finished_receipt(db, fs, **fields):
+    receipt = {'image_id': fs.put(b'original bytes', filename='r.png',
+                                  metadata={'content_type': 'image/png'}),
+               'compact_image_id': fs.put(b'compact', filename='r_compact.jpg'),
+               'payments': {}, 'updated_at': LONG_AGO}
+    receipt.update(fields)
+    return db.receipts.insert_one(receipt).inserted_id
+
+
+def test_archive_moves_images_out_of_gridfs(tmp_path):
+    db = new_db()
+    fs = gridfs.GridFS(db)
+    receipt_id = finished_receipt(db, fs)
+    # changed recently, or still a draft: not archived yet
+    finished_receipt(db, fs, updated_at=NOW)
+    finished_receipt(db, fs, draft_expires_at=NOW)
+
+    assert lifecycle.archive_finished_images(db, tmp_path, older_than_seconds=3600, now=NOW) == 1
+    receipt = db.receipts.find_one({'_id': receipt_id})
+    assert 'image_id' not in receipt and 'compact_image_id' not in receipt
+    entry = receipt['archived_images']['original']
+    with lifecycle.open_archived_image(entry) as image:
+        assert image.read() == b'original bytes'
+    assert entry['bytes'] == len(b'original bytes')
+    assert entry['content_type'] == 'image/png'
+    # stored before the content type was kept in metadata: guessed from the name
+    assert receipt['archived_images']['compact']['content_type'] == 'image/jpeg'
+    assert db.fs.files.count_documents({}) == 4  # only the other receipts'
+
+
+def test_archive_keeps_the_page_order_of_a_multi_page_receipt(tmp_path, monkeypatch):
+    import main
+
+    db = new_db()
+    fs = gridfs.GridFS(db)
+    pages = [{'image_id': fs.put(f'page {n}'.encode(), filename=f'p{n}.jpg'),
+              'image_sha256': f'sha{n}'} for n in (1, 2, 3)]
+    receipt_id = finished_receipt(db, fs, image_id=pages[0]['image_id'], pages=pages)
+
+    assert lifecycle.archive_finished_images(db, tmp_path, older_than_seconds=3600, now=NOW) == 1
+    receipt = db.receipts.find_one({'_id': receipt_id})
+    assert receipt['pages'] == [{'image_sha256': 'sha1', 'archived': 'original'},
+                                {'image_sha256': 'sha2', 'archived': 'page2'},
+                                {'image_sha256': 'sha3', 'archived': 'page3'}]
+    # a later re-OCR reads every page, in order, from the archive
+    monkeypatch.setattr(main, '_db', db)
+    for number, page in enumerate(receipt['pages'], 1):
+        with main.open_page(page, receipt['archived_images']) as image:
+            assert image.read() == f'page {number}'.encode()
+
+
+def test_archive_keeps_files_when_the_image_changed_meanwhile(tmp_path, monkeypatch):
+    """The receipt is only updated, and its files deleted, if image_id is still the one copied."""
+    db = new_db()
+    fs = gridfs.GridFS(db)
+    receipt_id = finished_receipt(db, fs)
+    replacement = fs.put(b'new upload', filename='new.jpg')
+    archive_file = lifecycle.archive_file
+
+    def replaced_during_copy(grid_out, path):
+        db.receipts.update_one({'_id': receipt_id}, {'$set': {'image_id': replacement}})
+        return archive_file(grid_out, path)
+
+    monkeypatch.setattr(lifecycle, 'archive_file', replaced_during_copy)
+    assert lifecycle.archive_finished_images(db, tmp_path, older_than_seconds=3600, now=NOW) == 0
+    receipt = db.receipts.find_one({'_id': receipt_id})
+    assert receipt['image_id'] == replacement and 'archived_images' not in receipt
+    assert db.fs.files.count_documents({}) == 3
+    assert list(tmp_path.rglob('*.gz')) == []
+
+
+def test_archive_skips_a_receipt_it_cannot_write(tmp_path, monkeypatch, caplog):
+    db = new_db()
+    fs = gridfs.GridFS(db)
+    first = finished_receipt(db, fs)
+    second = finished_receipt(db, fs)
+    archive_file = lifecycle.archive_file
+
+    def disk_full(grid_out, path):
+        if str(first) in path.name:
+            raise OSError(28, 'No space left on device')
+        return archive_file(grid_out, path)
+
+    monkeypatch.setattr(lifecycle, 'archive_file', disk_full)
+    stats = lifecycle.run_once(db, tmp_path, 3600, 3600, tmp_path, 3600)
+    assert stats['archived_receipts'] == 1 and 'error' not in stats
+    assert 'image_id' in db.receipts.find_one({'_id': first})
+    assert 'archived_images' in db.receipts.find_one({'_id': second})
+    assert 'No space left on device' in caplog.text
+    assert not [path for path in tmp_path.rglob('*.gz') if str(first) in path.name]
+
+
+def test_orphan_sweep_keeps_referenced_and_recent_files():
+    db = new_db()
+    fs = gridfs.GridFS(db)
+    image_id = fs.put(b'image')
+    compact_id = fs.put(b'compact')
+    page_id = fs.put(b'page two')
+    orphan_id = fs.put(b'orphan')
+    db.receipts.insert_one({'image_id': image_id, 'compact_image_id': compact_id,
+                            'pages': [{'image_id': image_id}, {'image_id': page_id}]})
+    age_files(db, LONG_AGO)
+    recent_orphan_id = fs.put(b'upload in progress')
+    db.fs.files.update_one({'_id': recent_orphan_id}, {'$set': {'uploadDate': NOW}})
+
+    assert lifecycle.sweep_orphan_images(db, grace_seconds=3600, batch_size=2, now=NOW) == 1
+    remaining = {f['_id'] for f in db.fs.files.find()}
+    assert remaining == {image_id, compact_id, page_id, recent_orphan_id}
+    assert orphan_id not in remaining
+
+
+def test_temp_file_sweep_respects_the_grace_period(tmp_path):
+    old = tmp_path / 'receipt_old.jpg'
+    new = tmp_path / 'receipt_new.jpg'
+    unrelated = tmp_path / 'notes.jpg'
+    for path in (old, new, unrelated):
+        path.write_bytes(b'x')
+    an_hour_ago = time.time() - 3600
+    os.utime(old, (an_hour_ago - 10, an_hour_ago - 10))
+    os.utime(unrelated, (an_hour_ago - 10, an_hour_ago - 10))
+
+    assert lifecycle.sweep_temp_files(tmp_path, grace_seconds=3600) == 1
+    assert not old.exists() and new.exists() and unrelated.exists()
+
+
+def test_open_archived_image_reads_the_gzip(tmp_path):
+    path = tmp_path / 'image.jpg.gz'
+    with gzip.open(path, 'wb') as out:
+        out.write(b'jpeg')
+    with lifecycle.open_archived_image({'path': str(path)}) as image:
+        assert image.read() == b'jpeg'
+
+
+def test_lifecycle_worker_survives_a_failed_pass(monkeypatch, caplog):
+    import threading
+    import main
+
+    stop = threading.Event()
+    passes = []
+
+    def run_once(*args):
+        passes.append(args)
+        if len(passes) == 1:
+            raise PermissionError(13, 'Permission denied')
+        stop.set()
+        return {}
+
+    monkeypatch.setattr(main, '_db', new_db())
+    monkeypatch.setattr(main, 'LIFECYCLE_INTERVAL_SECONDS', 0)
+    monkeypatch.setattr(lifecycle, 'run_once', run_once)
+    main.lifecycle_worker(stop)
+    assert len(passes) == 2
+    assert 'Lifecycle pass failed' in caplog.text
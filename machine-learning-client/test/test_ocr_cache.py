@@ -0,0 +1,79 @@
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import mongomock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from ocr_cache import OcrResultCache  # noqa: E402
+
+
+def test_least_recently_used_entry_is_evicted_from_memory():
+    collection = mongomock.MongoClient().db.ocr_cache
+    cache = OcrResultCache(collection, max_entries=2)
+    cache.put("a", {"total": 1.0})
+    cache.put("b", {"total": 2.0})
+    assert cache.get("a") == {"total": 1.0}  # now b is the oldest
+    cache.put("c", {"total": 3.0})
+    assert list(cache._entries) == ["a", "c"]
+    # evicted from memory, but still in Mongo
+    assert cache.get("b") == {"total": 2.0}
+    assert cache.stats()["memory_hits"] == 1 and cache.stats()["mongo_hits"] == 1
+
+
+def test_results_are_shared_through_mongo():
+    """A second cache on the same collection, like another replica or a restart, finds the result."""
+    collection = mongomock.MongoClient().db.ocr_cache
+    OcrResultCache(collection).put("abc", {"items": [{"description": "Nachos"}]})
+    cache = OcrResultCache(collection)
+    assert cache.get("abc") == {"items": [{"description": "Nachos"}]}
+    assert cache.get("abc") == {"items": [{"description": "Nachos"}]}
+    assert cache.get("missing") is None
+    stats = cache.stats()
+    assert (stats["mongo_hits"], stats["memory_hits"], stats["misses"]) == (1, 1, 1)
+    assert stats["hit_ratio"] == 2 / 3
+
+
+def test_callers_get_their_own_copy():
+    cache = OcrResultCache(mongomock.MongoClient().db.ocr_cache)
+    receipt_data = {"items": [{"description": "Nachos"}]}
+    cache.put("abc", receipt_data)
+    receipt_data["items"].clear()
+    cache.get("abc")["items"].clear()
+    assert cache.get("abc") == {"items": [{"description": "Nachos"}]}
+
+
+def test_ensure_indexes_expires_entries_after_the_ttl():
+    collection = mongomock.MongoClient().db.ocr_cache
+    OcrResultCache(collection, ttl_seconds=60).ensure_indexes()
+    assert collection.index_information()["created_at_1"]["expireAfterSeconds"] == 60
+
+
+def test_entries_expire_from_memory_and_mongo():
+    """Results older than ttl_seconds are misses, whether kept in memory or only in Mongo."""
+    collection = mongomock.MongoClient().db.ocr_cache
+    cache = OcrResultCache(collection, ttl_seconds=60)
+    cache.put("mindee:abc", {"total": 1.0})
+    assert cache.get("mindee:abc") == {"total": 1.0}
+
+    stored_long_ago = datetime.now(timezone.utc) - timedelta(seconds=61)
+    cache._entries["mindee:abc"] = ({"total": 1.0}, stored_long_ago)
+    collection.update_one({"_id": "mindee:abc"}, {"$set": {"created_at": stored_long_ago}})
+    assert cache.get("mindee:abc") is None
+    assert "mindee:abc" not in cache._entries
+    assert cache.stats()["memory_hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_changed_ttl_updates_the_index_in_place(monkeypatch):
+    """A new OCR_CACHE_TTL_SECONDS is applied with collMod rather than a conflicting create_index."""
+    collection = mongomock.MongoClient().db.ocr_cache
+    OcrResultCache(collection, ttl_seconds=60).ensure_indexes()
+    commands = []
+    monkeypatch.setattr(type(collection.database), "command",
+                        lambda self, *args, **kwargs: commands.append((args, kwargs)))
+    OcrResultCache(collection, ttl_seconds=60).ensure_indexes()
+    assert commands == []
+    OcrResultCache(collection, ttl_seconds=120).ensure_indexes()
+    assert commands == [(("collMod", "ocr_cache"),
+                         {"index": {"keyPattern": {"created_at": 1}, "expireAfterSeconds": 120}})]
@@ -0,0 +1,71 @@
+import io
+import json
+import sys
+from pathlib import Path
+
+import pytest
+import requests_mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import ocr_providers  # noqa: E402
+
+
+def mindee_prediction():
+    return {"document": {"inference": {"pages": [{"prediction": {
+        "supplier_name": {"raw_value": "Harbor Lane Cafe"},
+        "locale": {"currency": "USD"},
+        "line_items": [{"description": "Nachos", "total_amount": 8.9, "quantity": 1},
+                       {"description": "Shrimp Tacos", "total_amount": 12.35, "quantity": 1}],
+        "total_amount": {"value": 23.5},
+        "total_tax": {"value": 2.25},
+        "tip": {"value": None},
+        "total_net": {"value": 21.25},
+    }}]}}}
+
+
+def test_mindee_provider_extract(monkeypatch):
+    """The Mindee provider streams the image to the API and parses the prediction."""
+    monkeypatch.setenv("OCR_API_KEY", "test-key")
+    with requests_mock.Mocker() as m:
+        m.post(ocr_providers.MINDEE_URL, json=mindee_prediction())
+        receipt = ocr_providers.MindeeProvider().extract("abc", io.BytesIO(b"jpeg bytes"))
+        request = m.last_request
+    assert request.headers["Authorization"] == "Token test-key"
+    assert receipt == {"receipt_name": "Harbor Lane Cafe", "currency": "USD",
+                       "items": [{"description": "Nachos", "amount": 8.9, "quantity": 1},
+                                 {"description": "Shrimp Tacos", "amount": 12.35, "quantity": 1}],
+                       "total": 23.5, "tax": 2.25, "tip": None, "subtotal": 21.25}
+
+
+def test_replay_provider_reads_both_recording_formats(tmp_path):
+    asprise = ocr_providers.ReplayProvider()  # response1.json
+    receipt = asprise.extract("abc", io.BytesIO(b"ignored"))
+    assert receipt["receipt_name"] == "HARBOR LANE CAFE"
+    assert (receipt["subtotal"], receipt["tax"], receipt["total"]) == (29.47, 1.92, 31.39)
+    assert receipt["items"][0] == {"description": "Tacos Del Mal Shrimp", "amount": 14.98,
+                                   "quantity": 1}
+    receipt["items"].clear()
+    assert len(asprise.extract("abc", io.BytesIO(b"ignored"))["items"]) == 3
+
+    recording = tmp_path / "mindee.json"
+    recording.write_text(json.dumps(mindee_prediction()))
+    assert ocr_providers.ReplayProvider(str(recording)).extract("abc", None)["total"] == 23.5
+
+
+def test_get_provider_creates_each_provider_once(monkeypatch):
+    monkeypatch.setattr(ocr_providers, "_providers", {})
+    assert ocr_providers.get_provider("replay") is ocr_providers.get_provider("replay")
+    with pytest.raises(ValueError, match="Unknown OCR_PROVIDER"):
+        ocr_providers.get_provider("asprise")
+
+
+def test_mindee_provider_out_of_quota(monkeypatch):
+    """A 429 from Mindee is reported as QuotaExceeded with its Retry-After."""
+    monkeypatch.setenv("OCR_API_KEY", "test-key")
+    with requests_mock.Mocker() as m:
+        m.post(ocr_providers.MINDEE_URL, status_code=429, headers={"Retry-After": "120"},
+               json={"api_request": {"error": {"code": "TooManyRequests"}}})
+        with pytest.raises(ocr_providers.QuotaExceeded) as excinfo:
+            ocr_providers.MindeeProvider().extract("abc", io.BytesIO(b"jpeg bytes"))
+    assert excinfo.value.retry_after == 120
@@ -0,0 +1,226 @@
+import hashlib
+import io
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import gridfs
+import mongomock
+import mongomock.gridfs
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main  # noqa: E402
+import ocr_providers  # noqa: E402
+import ocr_scheduler  # noqa: E402
+from ocr_cache import OcrResultCache  # noqa: E402
+
+mongomock.gridfs.enable_gridfs_integration()
+
+
+class FakeProvider(ocr_providers.OcrProvider):
+    def __init__(self, name, fail_with=None, fail_on=None):
+        self.name = name
+        self.fail_with = fail_with
+        self.fail_on = fail_on  # image bytes to fail on; None for every image
+        self.calls = 0
+
+    def extract(self, Object_ID, image_file):
+        self.calls += 1
+        if self.fail_with and self.fail_on in (None, image_file.read()):
+            raise self.fail_with
+        return {"receipt_name": self.name, "currency": "USD", "total": 1.0,
+                "items": [{"description": f"Page {self.calls}", "amount": 1.0, "quantity": 1}]}
+
+
+@pytest.fixture
+def providers(monkeypatch):
+    fakes = {"fake": FakeProvider("fake"), "fallback": FakeProvider("fallback")}
+    for name, provider in fakes.items():
+        monkeypatch.setitem(ocr_providers._providers, name, provider)
+    return fakes
+
+
+def scheduler(capacity=2, reserve=1, fallback=None):
+    return ocr_scheduler.OcrScheduler(mongomock.MongoClient().db.ocr_quota, "fake",
+                                      capacity=capacity, period_seconds=3600, reserve=reserve,
+                                      fallback=fallback)
+
+
+def test_bucket_take_drain_and_seconds_until():
+    bucket = ocr_scheduler.QuotaBucket(mongomock.MongoClient().db.ocr_quota, "fake",
+                                       capacity=2, period_seconds=3600)
+    assert bucket.take() == (True, 1.0)
+    assert bucket.take(reserve=1) == (False, pytest.approx(1.0, abs=0.01))
+    assert bucket.take()[0]
+    assert not bucket.take()[0]
+    # one token refills every 1800 seconds
+    assert bucket.seconds_until() == pytest.approx(1800, abs=5)
+    assert bucket.seconds_until(count=2) == pytest.approx(3600, abs=5)
+
+    bucket.drain(600)
+    assert bucket.tokens() == pytest.approx(-1 / 3, abs=0.01)
+    assert bucket.seconds_until() == pytest.approx(2400, abs=5)
+
+
+def test_batch_calls_leave_the_reserve_to_interactive_ones(providers):
+    quota = scheduler(capacity=2, reserve=1)
+    assert quota.take("batch")
+    assert not quota.take("batch")
+    assert quota.take("interactive")
+    with pytest.raises(ocr_scheduler.Deferred) as deferred:
+        quota.provider_for("interactive").extract(None, io.BytesIO(b"image"))
+    assert deferred.value.retry_after == pytest.approx(1800, abs=5)
+    assert quota.calls[("interactive", "deferred")] == 1
+
+
+def test_fallback_reads_what_the_quota_cannot(providers):
+    quota = scheduler(capacity=1, reserve=0, fallback="fallback")
+    first, second = quota.provider_for("batch"), quota.provider_for("batch")
+    assert first.extract(None, io.BytesIO(b"one"))["receipt_name"] == "fake"
+    assert second.extract(None, io.BytesIO(b"two"))["receipt_name"] == "fallback"
+    assert (first.used, second.used) == ("fake", "fallback")
+
+
+def test_quota_exceeded_drains_the_bucket_and_falls_back(providers):
+    providers["fake"].fail_with = ocr_providers.QuotaExceeded(120)
+    quota = scheduler(capacity=5, reserve=0, fallback="fallback")
+    provider = quota.provider_for("interactive")
+    assert provider.extract(None, io.BytesIO(b"image"))["receipt_name"] == "fallback"
+    assert quota.bucket.seconds_until() == pytest.approx(120 + 720, abs=5)
+
+
+def test_prepay_takes_every_page_at_once(providers):
+    quota = scheduler(capacity=3, reserve=1)
+    provider = quota.provider_for("batch")
+    provider.prepay(2)
+    assert quota.bucket.tokens() == pytest.approx(1, abs=0.01)
+    for page in range(2):
+        provider.extract(None, io.BytesIO(b"page"))
+    assert providers["fake"].calls == 2
+    assert quota.bucket.tokens() == pytest.approx(1, abs=0.01)
+
+    # not enough for both pages: deferred before either is read
+    with pytest.raises(ocr_scheduler.Deferred):
+        quota.provider_for("batch").prepay(2)
+    assert providers["fake"].calls == 2
+
+
+def test_prepay_over_the_lane_capacity(providers, caplog):
+    """Two pages can never fit a batch lane of capacity 2 with 1 reserved."""
+    with pytest.raises(ocr_scheduler.OverCapacity):
+        scheduler(capacity=2, reserve=1).provider_for("batch").prepay(2)
+    provider = scheduler(capacity=2, reserve=1, fallback="fallback").provider_for("batch")
+    provider.prepay(2)
+    assert provider.extract(None, io.BytesIO(b"page"))["receipt_name"] == "fallback"
+    assert "exceed the batch lane's quota of 1" in caplog.text
+
+
+@pytest.fixture
+def ml_db(monkeypatch):
+    db = mongomock.MongoClient().db
+    monkeypatch.setattr(main, "_db", db)
+    monkeypatch.setattr(main, "_ocr_cache", OcrResultCache(db.ocr_cache))
+    monkeypatch.setattr(main, "OCR_PREPROCESS", False)
+    return db
+
+
+def queued_receipt(db, pages=1):
+    fs = gridfs.GridFS(db)
+    images = [{"image_id": fs.put(f"page {n}".encode()),
+               "image_sha256": hashlib.sha256(f"page {n}".encode()).hexdigest()}
+              for n in range(pages)]
+    receipt = {"image_id": images[0]["image_id"], "image_sha256": images[0]["image_sha256"]}
+    if pages > 1:
+        # as the web app's batch_upload stores them
+        receipt["pages"] = images
+        receipt["image_sha256"] = hashlib.sha256(
+            "".join(page["image_sha256"] for page in images).encode()).hexdigest()
+    receipt_id = db.receipts.insert_one(receipt).inserted_id
+    now = datetime.now(timezone.utc)
+    job_id = db.ocr_jobs.insert_one({"receipt_id": receipt_id, "status": "running",
+                                     "stage": "ocr_running", "stages": [], "priority": 1,
+                                     "attempts": 1, "run_after": now,
+                                     "lease_expires_at": now + timedelta(minutes=5)}).inserted_id
+    return receipt_id, db.ocr_jobs.find_one({"_id": job_id})
+
+
+def test_run_job_defers_without_spending_an_attempt(ml_db, providers, monkeypatch):
+    quota = scheduler(capacity=2, reserve=1)
+    quota.take("batch")
+    monkeypatch.setattr(main, "_scheduler", quota)
+    receipt_id, job = queued_receipt(ml_db)
+
+    main.run_job(job)
+    job = ml_db.ocr_jobs.find_one({"_id": job["_id"]})
+    assert job["status"] == "queued" and job["stage"] == "deferred"
+    assert job["attempts"] == 0
+    assert "lease_expires_at" not in job
+    run_after = job["run_after"].replace(tzinfo=timezone.utc)
+    assert run_after - datetime.now(timezone.utc) > timedelta(minutes=25)
+    assert providers["fake"].calls == 0
+
+
+def test_run_job_reads_a_multi_page_receipt_once_its_quota_fits(ml_db, providers, monkeypatch):
+    monkeypatch.setattr(main, "_scheduler", scheduler(capacity=3, reserve=1))
+    receipt_id, job = queued_receipt(ml_db, pages=2)
+
+    main.run_job(job)
+    assert ml_db.ocr_jobs.find_one({"_id": job["_id"]})["status"] == "done"
+    assert len(ml_db.receipts.find_one({"_id": receipt_id})["items"]) == 2
+    assert providers["fake"].calls == 2
+
+
+def test_run_job_fails_a_receipt_the_quota_can_never_hold(ml_db, providers, monkeypatch):
+    monkeypatch.setattr(main, "_scheduler", scheduler(capacity=2, reserve=1))
+    receipt_id, job = queued_receipt(ml_db, pages=2)
+
+    main.run_job(job)
+    job = ml_db.ocr_jobs.find_one({"_id": job["_id"]})
+    assert job["status"] == "failed" and "2 pages" in job["last_error"]
+    assert providers["fake"].calls == 0
+
+
+def test_run_job_fails_when_the_receipt_is_gone(ml_db, providers, monkeypatch):
+    monkeypatch.setattr(main, "_scheduler", scheduler(capacity=0))
+    receipt_id, job = queued_receipt(ml_db)
+    ml_db.receipts.delete_one({"_id": receipt_id})
+
+    main.run_job(job)
+    job = ml_db.ocr_jobs.find_one({"_id": job["_id"]})
+    assert job["status"] == "failed" and "no longer exists" in job["last_error"]
+    assert providers["fake"].calls == 0
+
+
+def test_run_job_keeps_the_pages_read_before_a_429(ml_db, providers, monkeypatch):
+    """Deferred on page 2: pages 1 and 3 are cached, and only page 2 is read on the retry."""
+    quota = scheduler(capacity=5, reserve=0)
+    monkeypatch.setattr(main, "_scheduler", quota)
+    providers["fake"].fail_with = ocr_providers.QuotaExceeded(60)
+    providers["fake"].fail_on = b"page 1"
+    receipt_id, job = queued_receipt(ml_db, pages=3)
+
+    main.run_job(job)
+    assert ml_db.ocr_jobs.find_one({"_id": job["_id"]})["stage"] == "deferred"
+    assert providers["fake"].calls == 3
+
+    providers["fake"].fail_with = None
+    quota.bucket.collection.delete_many({})  # the Retry-After has passed
+    main.run_job(ml_db.ocr_jobs.find_one({"_id": job["_id"]}))
+    assert ml_db.ocr_jobs.find_one({"_id": job["_id"]})["status"] == "done"
+    assert providers["fake"].calls == 4
+    assert len(ml_db.receipts.find_one({"_id": receipt_id})["items"]) == 3
+
+
+def test_a_429_on_one_page_sends_every_page_to_the_fallback(ml_db, providers, monkeypatch):
+    monkeypatch.setattr(main, "_scheduler", scheduler(capacity=5, reserve=0, fallback="fallback"))
+    providers["fake"].fail_with = ocr_providers.QuotaExceeded(60)
+    providers["fake"].fail_on = b"page 1"
+    receipt_id, job = queued_receipt(ml_db, pages=3)
+
+    main.run_job(job)
+    receipt = ml_db.receipts.find_one({"_id": receipt_id})
+    assert receipt["receipt_name"] == "fallback"
+    assert providers["fallback"].calls == 3
+    assert ml_db.ocr_cache.find_one({"_id": "fake:" + hashlib.sha256(b"page 1").hexdigest()}) is None
@@ -0,0 +1,43 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from ocr_providers import parse_receipt_text  # noqa: E402
+
+
+def test_items_and_labelled_totals():
+    text = """
+        HARBOR LANE CAFE
+        123 Main St
+        2 x Fish Tacos      $18.50
+        Especial Salad       12.50
+        Lemonade 3.00
+        Subtotal            34.00
+        Sales Tax            2.98
+        Gratuity             5.00
+        TOTAL              $41.98
+        VISA ****1234       41.98
+    """
+    receipt = parse_receipt_text(text)
+    assert receipt["receipt_name"] == "HARBOR LANE CAFE"
+    assert receipt["items"] == [
+        {"description": "Fish Tacos", "amount": 18.5, "quantity": 2},
+        {"description": "Especial Salad", "amount": 12.5, "quantity": 1},
+        {"description": "Lemonade", "amount": 3.0, "quantity": 1},
+    ]
+    assert (receipt["subtotal"], receipt["tip"], receipt["total"]) == (34.0, 5.0, 41.98)
+
+
+def test_comma_decimals_and_missing_subtotal():
+    """European decimals are read, and without a subtotal line the items are summed."""
+    receipt = parse_receipt_text("Bistro\nCroque Monsieur 9,50\nCafe Creme 3,20\nTotal 12,70")
+    assert [item["amount"] for item in receipt["items"]] == [9.5, 3.2]
+    assert receipt["subtotal"] == 12.7 and receipt["total"] == 12.7
+    assert receipt["tax"] is None
+
+
+def test_empty_text():
+    receipt = parse_receipt_text("  \n ")
+    assert receipt["receipt_name"] is None and receipt["items"] == []
+    assert receipt["subtotal"] == 0
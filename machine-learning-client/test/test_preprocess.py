@@ -0,0 +1,68 @@
+import io
+import sys
+from pathlib import Path
+
+import mongomock
+import mongomock.gridfs
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main  # noqa: E402
+from preprocess import otsu_threshold, preprocess_image, receipt_bounds  # noqa: E402
+
+mongomock.gridfs.enable_gridfs_integration()
+
+
+def receipt_photo(width=4000, height=3000, paper=(1000, 200, 3000, 2800), fmt="JPEG"):
+    """A dark table with a bright receipt on it and a few printed rows."""
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(20, 60, size=(height, width), dtype=np.uint8)
+    left, top, right, bottom = paper
+    pixels[top:bottom, left:right] = rng.integers(220, 255, size=(bottom - top, right - left),
+                                                  dtype=np.uint8)
+    pixels[top + 100:bottom - 100:80, left + 100:right - 100] = 10  # the text
+    out = io.BytesIO()
+    Image.fromarray(pixels).convert("RGB").save(out, format=fmt)
+    return out.getvalue()
+
+
+def test_otsu_separates_paper_from_background():
+    gray = np.array([[30] * 50 + [230] * 50] * 10, dtype=np.uint8)
+    assert 30 <= otsu_threshold(gray) < 230
+    assert receipt_bounds(np.full((100, 100), 200, dtype=np.uint8)) is None  # nothing to crop
+
+
+def test_preprocess_crops_to_the_paper_and_downscales():
+    """The crop hugs the receipt (plus a small margin) and the long edge is capped."""
+    compact, info = preprocess_image(receipt_photo(), max_long_edge=1600)
+    left, top, right, bottom = info["crop"]
+    assert 900 <= left <= 1000 and 2000 <= right - left <= 2200
+    assert 100 <= top <= 200 and 2600 <= bottom - top <= 2800
+    assert max(info["compact_size"]) == 1600
+    assert info["original_size"] == [4000, 3000]
+    with Image.open(io.BytesIO(compact)) as image:
+        assert image.mode == "L" and list(image.size) == info["compact_size"]
+    assert info["compact_bytes"] < info["original_bytes"]
+
+
+def test_compact_image_is_saved_once_and_reused(monkeypatch):
+    db = mongomock.MongoClient().db
+    monkeypatch.setattr(main, "_db", db)
+    receipt_id = db.receipts.insert_one({}).inserted_id
+
+    compact = main.compact_image(receipt_id, {}, io.BytesIO(receipt_photo())).read()
+    receipt = db.receipts.find_one({"_id": receipt_id})
+    assert receipt["preprocess"]["compact_bytes"] == len(compact)
+    assert main.compact_image(receipt_id, receipt, None).read() == compact
+
+
+def test_shrink_keeps_the_original_when_not_smaller():
+    """An image already small enough, or not an image at all, is sent to OCR as it is."""
+    small = io.BytesIO()
+    Image.new("L", (40, 60), 255).save(small, format="PNG")  # a few hundred bytes
+    assert main.shrink_image("abc", small.getvalue()) == (None, None)
+    assert main.shrink_image("abc", b"%PDF-1.4 not an image") == (None, None)
+    compact, info = main.shrink_image("abc", receipt_photo())
+    assert compact is not None and info["crop"]
@@ -1,18 +1,32 @@
 import os
-from flask import Flask, render_template, redirect, request, url_for, jsonify
+import hashlib
+import math
+from flask import Flask, Response, render_template, redirect, request, url_for, jsonify
+from markupsafe import Markup
 import pymongo
-from pymongo import MongoClient
+import gridfs
 from werkzeug.utils import secure_filename
 import requests
 from dotenv import load_dotenv
 from bson import ObjectId
-import json
+import batch_split
+import batch_upload
+import metrics
+import ml_client
+import page_cache
+import progress
+import receipt_store
+import schema
+import split_engine
+import split_ledger
+import wizard_session
+import atexit
 import uuid
+from datetime import datetime, timezone
+import logging
 
-import logger
-
-logger.basicConfig(level=logger.DEBUG)
-logger = logger.getLogger(__name__)
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
 
 load_dotenv()  # take environment variables from .env.
 
@@ -24,20 +38,105 @@ if os.getenv("FLASK_ENV", "development") == "development":
 #     # turn on d   ebugging, if in development
     app.debug = True  # debug mnode
 
+# per-route latency, Mongo and ML-call timings at /metrics
+metrics.install(app)
+
 # connect to the database
-cxn = pymongo.MongoClient(os.getenv("MONGO_URI"))
+cxn = pymongo.MongoClient(os.getenv("MONGO_URI"),
+                          event_listeners=[metrics.MongoCommandMetrics()])
 db = cxn[os.getenv("MONGO_DBNAME")]  # store a reference to the database
 
+# uploads are copied into GridFS this many bytes at a time
+IMAGE_CHUNK_SIZE = 255 * 1024
+# largest batch accepted by /api/calculate_bills; bigger runs use batch_split.py
+BATCH_SPLIT_MAX_RECEIPTS = int(os.getenv("BATCH_SPLIT_MAX_RECEIPTS", 5000))
+# most files accepted by one /api/upload_batch call
+UPLOAD_BATCH_MAX_FILES = int(os.getenv("UPLOAD_BATCH_MAX_FILES", 50))
+
+
+# rendered results pages and history rows, per receipt version
+results_pages = page_cache.PageCache(int(os.getenv("RESULTS_CACHE_SIZE", 1000)))
+history_rows = page_cache.PageCache(int(os.getenv("HISTORY_ROW_CACHE_SIZE", 5000)))
+
+
+# one pooled, retrying client shared by every call to the ML service
+ml_service = ml_client.MLServiceClient(**ml_client.settings_from_env())
 
-# Call the ML service to perform OCR on the receipt
-def call_ml_service(Object_ID):
-    url = "http://machine-learning-client:5002/predict"
-    headers = {'Content-Type': 'application/json'}
-    data = json.dumps({"Object_ID": str(Object_ID)})
-    response = requests.post(url, data=data, headers=headers)
-    logger.debug(f"Response Status Code: {response.status_code}")
-    logger.debug(f"Response Text: {response.text}")
-    return response.json()
+# one Mongo poller feeding every open /progress stream in this process
+progress_hub = progress.ProgressHub(db, poll_seconds=float(os.getenv("PROGRESS_POLL_SECONDS", 0.5)))
+# how long a progress stream or long-poll stays open before the browser reconnects
+PROGRESS_STREAM_SECONDS = float(os.getenv("PROGRESS_STREAM_SECONDS", 300))
+PROGRESS_WAIT_MAX_SECONDS = 30
+
+
+# optional in-process state for the split wizard, written to Mongo once per split;
+# it needs every request for a receipt to reach the same process, so it is only
+# used with WEB_CONCURRENCY=1 set explicitly. gunicorn and uvicorn both take
+# their worker count from it; don't pass them -w/--workers as well.
+WIZARD_SESSION_CACHE_SIZE = int(os.getenv("WIZARD_SESSION_CACHE_SIZE", 0))
+
+
+wizard_sessions = None
+if WIZARD_SESSION_CACHE_SIZE > 0:
+    if os.getenv("WEB_CONCURRENCY") != "1":
+        logger.warning("WIZARD_SESSION_CACHE_SIZE ignored: wizard sessions need a single "
+                       "worker process (WEB_CONCURRENCY=1)")
+    else:
+        wizard_sessions = wizard_session.WizardSessions(
+            WIZARD_SESSION_CACHE_SIZE, ttl_seconds=int(os.getenv("WIZARD_SESSION_TTL_SECONDS", 1800)))
+        atexit.register(wizard_sessions.checkpoint)
+
+
+# The receipt as a wizard page sees it: the session draft when sessions are on
+def wizard_receipt(receipt_id, view):
+    if wizard_sessions is None:
+        return receipt_store.get_receipt(db, receipt_id, view)
+    draft = wizard_sessions.load(db, receipt_id)
+    if draft is not None:
+        wizard_sessions.items(db, receipt_id, draft)
+    return draft
+
+
+# Queue an OCR job for the ML service instead of waiting on the Mindee round trip
+def enqueue_ocr_job(receipt_id, stored_at=None):
+    job = batch_upload.ocr_job(receipt_id, stored_at)
+    db.ocr_jobs.insert_one(job)
+    return job
+
+
+# Stream an uploaded image into GridFS without holding the whole file in memory
+def store_image(file):
+    digest = hashlib.sha256()
+    fs = gridfs.GridFS(db)
+    # the content type goes in metadata; GridFS's own contentType field is deprecated
+    with fs.new_file(filename=secure_filename(file.filename),
+                     metadata={"content_type": file.mimetype},
+                     chunk_size=IMAGE_CHUNK_SIZE) as grid_in:
+        for chunk in iter(lambda: file.stream.read(IMAGE_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            grid_in.write(chunk)
+    return grid_in._id, digest.hexdigest()
+
+
+# Make sure the collections are indexed before the first request is served
+indexes_ready = False
+
+@app.before_request
+def ensure_indexes():
+    global indexes_ready
+    if not indexes_ready:
+        schema.bootstrap(db)
+        indexes_ready = True
+
+@app.cli.command("init-db")
+def init_db():
+    """Create the indexes the app relies on."""
+    print(f"Ensured indexes: {', '.join(schema.bootstrap(db))}")
+
+@app.cli.command("backfill-search")
+def backfill_search():
+    """Add history search tokens to receipts saved before search indexing."""
+    print(f"Indexed {receipt_store.backfill_search_tokens(db)} receipts")
 
 
 #homepage -add receipt - history 
@@ -54,12 +153,15 @@ def upload_image():
     if file.filename == '':
         return jsonify({"error": "No selected file"}), 400
     if file:
-        image_data = file.read()
         try:
-            result = db.receipts.insert_one({"image": image_data})
+            image_id, image_sha256 = store_image(file)
+            result = db.receipts.insert_one({"image_id": image_id,
+                                             "image_sha256": image_sha256,
+                                             **schema.draft_fields()})
+            stored_at = datetime.now(timezone.utc)
             inserted_id = str(result.inserted_id)
             #logger.debug("YAY", inserted_id)
-            call_ml_service(inserted_id)
+            enqueue_ocr_job(inserted_id, stored_at)
             return redirect(url_for('numofpeople', receipt_id=inserted_id))
         except pymongo.errors.ServerSelectionTimeoutError as e:
             logger.error("Could not connect to MongoDB: %s", str(e))
@@ -68,6 +170,51 @@ def upload_image():
     return jsonify({"error": "Unexpected error occurred"}), 500
 
 
+@app.route('/api/upload_batch', methods=['POST'])
+def upload_batch():
+    """
+    Upload many receipt images in one request, as repeated `images` files.
+    Each file becomes its own receipt, or with pages=1 the files are the
+    pages of one receipt, in order. Returns each file's status and a
+    batch_id to follow OCR progress at /api/upload_batch/<batch_id>.
+    """
+    files = request.files.getlist('images')
+    if not files:
+        return jsonify({"error": "No images part"}), 400
+    if len(files) > UPLOAD_BATCH_MAX_FILES:
+        return jsonify({"error": f"At most {UPLOAD_BATCH_MAX_FILES} files per upload"}), 400
+
+    statuses, stored = [], []
+    try:
+        for index, file in enumerate(files):
+            status = {"file": index, "filename": file.filename}
+            statuses.append(status)
+            if file.filename == '':
+                status.update(status="rejected", error="No selected file")
+                continue
+            image_id, image_sha256 = store_image(file)
+            if image_sha256 == batch_upload.EMPTY_SHA256:
+                gridfs.GridFS(db).delete(image_id)
+                status.update(status="rejected", error="Empty file")
+                continue
+            stored.append((status, {"image_id": image_id, "image_sha256": image_sha256}))
+        if not stored:
+            return jsonify(batch_id=None, files=statuses), 400
+        batch_id = batch_upload.queue_batch(db, stored, multipage=request.form.get('pages') == '1')
+    except pymongo.errors.ServerSelectionTimeoutError as e:
+        logger.error("Could not connect to MongoDB: %s", str(e))
+        return jsonify({"error": "Database connection failed"}), 503
+    return jsonify(batch_id=batch_id, files=statuses), 202
+
+
+@app.route('/api/upload_batch/<batch_id>')
+def upload_batch_status(batch_id):
+    status = batch_upload.batch_status(db, batch_id)
+    if status is None:
+        return jsonify({"error": "Batch not found"}), 404
+    return jsonify(status), 200
+
+
 #(  pull receipt from database )
 @app.route('/numofpeople/<receipt_id>')
 def numofpeople(receipt_id):
@@ -87,14 +234,60 @@ def submit_people(receipt_id):
     names_list = [name.strip() for name in names.split(',')]
 
     try:
+        if wizard_sessions is not None:
+            if not wizard_sessions.update(db, receipt_id, num_of_people=count, names=names_list):
+                return jsonify({"error": "Receipt not found"}), 404
+            return redirect(url_for('select_appetizers', receipt_id=receipt_id))
         # Update the existing document in the receipts collection
         db.receipts.update_one({"_id": ObjectId(receipt_id)},
-                               {"$set": {"num_of_people": count, "names": names_list}})
+                               {"$set": {"num_of_people": count, "names": names_list},
+                                "$addToSet": {"search_tokens": {
+                                    "$each": receipt_store.search_tokens(*names_list)}},
+                                **schema.split_changed(), **schema.touch()})
         return redirect(url_for('select_appetizers', receipt_id=receipt_id))
          # Redirect to another page after submission
     except pymongo.errors.ServerSelectionTimeoutError as e:
         logger.error("Could not connect to MongoDB: %s", str(e))
         return jsonify({"error": "Database connection failed"}), 503
+
+@app.route('/job_status/<receipt_id>')
+def job_status(receipt_id):
+    """
+    Report the state of the OCR job for a receipt so pages can poll for it.
+    With ?wait=N&after=K this long-polls: it answers once the job has
+    reached more than K stages, or after N seconds, for clients without
+    EventSource.
+    """
+    job = db.ocr_jobs.find_one({"receipt_id": ObjectId(receipt_id)},
+                               sort=[("created_at", pymongo.DESCENDING)])
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    wait = request.args.get('wait', type=float)
+    if wait:
+        job = progress_hub.wait(receipt_id, request.args.get('after', -1, type=int),
+                                min(wait, PROGRESS_WAIT_MAX_SECONDS)) or job
+    return jsonify(progress.job_summary(receipt_id, job)), 200
+
+@app.route('/progress/<receipt_id>')
+def progress_stream(receipt_id):
+    """
+    Server-sent events for the receipt's OCR job, one per stage it reaches.
+    """
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    return Response(progress_hub.stream(receipt_id, last_event_id, PROGRESS_STREAM_SECONDS),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/receipt_items/<receipt_id>')
+def receipt_items(receipt_id):
+    """
+    The scanned merchant, items and total, fetched by numofpeople once OCR is ready.
+    """
+    receipt = receipt_store.get_receipt(db, receipt_id, 'items_preview')
+    if not receipt:
+        return jsonify({"error": "Receipt not found"}), 404
+    return jsonify(receipt_store.items_preview(receipt)), 200
+
 #label appetizers
 
 def is_valid_uuid(uuid_to_test, version=4):
@@ -109,49 +302,27 @@ def select_appetizers(receipt_id):
     if request.method == 'POST':
         if 'no_appetizers' in request.form and request.form['no_appetizers'] == 'none':
             #logger.debug("No appetizers selected by user.")
-            db.receipts.update_one(
-                {'_id': ObjectId(receipt_id)},
-                {'$set': {'items.$[].is_appetizer': False}})
-            return redirect(url_for('allocateitems', receipt_id=receipt_id))
-
-        appetizer_ids = request.form.getlist('appetizers')
-        #logger.debug(f"Received appetizer IDs: {appetizer_ids}")
-
-        valid_ids = [id for id in appetizer_ids if is_valid_uuid(id)]
-        #logger.debug(f"Valid appetizer IDs: {valid_ids}")
-        
-        # First reset all items to not be appetizers
-        db.receipts.update_one(
-            {'_id': ObjectId(receipt_id)},
-            {'$set': {'items.$[].is_appetizer': False}}
-        )
-
-        if valid_ids:
-            # Update items where the ID matches any of the valid appetizer IDs
-            db.receipts.update_many(
-                {'_id': ObjectId(receipt_id), 'items._id': {'$in': valid_ids}},
-                {'$set': {'items.$.is_appetizer': True}}
-            )
-            # Reset is_appetizer for other items
-            db.receipts.update_many(
-                {'_id': ObjectId(receipt_id), 'items._id': {'$nin': valid_ids}},
-                {'$set': {'items.$.is_appetizer': False}}
-            )
-            selected_appetizers = db.receipts.find_one({'_id': ObjectId(receipt_id)}, 
-                                                       {'items': 1})['items']
-            selected_appetizer_details = [(item['description'], item['amount']) 
-                                          for item in selected_appetizers 
-                                          if str(item['_id']) in valid_ids]
-            #logger.debug(f"Selected Appetizers: {selected_appetizer_details}")
+            valid_ids = []
         else:
-            db.receipts.update_one(
-                {'_id': ObjectId(receipt_id)},
-                {'$set': {'items.$[].is_appetizer': False}}
-            )
+            appetizer_ids = request.form.getlist('appetizers')
+            #logger.debug(f"Received appetizer IDs: {appetizer_ids}")
+            valid_ids = [id for id in appetizer_ids if is_valid_uuid(id)]
+            #logger.debug(f"Valid appetizer IDs: {valid_ids}")
+
+        if wizard_sessions is not None:
+            receipt = wizard_receipt(receipt_id, 'items')
+            if not receipt:
+                return jsonify({"error": "Receipt not found"}), 404
+            wizard_sessions.update(db, receipt_id, items=[
+                dict(item, is_appetizer=str(item.get('_id')) in valid_ids)
+                for item in receipt.get('items', [])])
+            return redirect(url_for('allocateitems', receipt_id=receipt_id))
 
+        # Flag the chosen items and clear every other item in one round trip
+        receipt_store.set_appetizers(db, receipt_id, valid_ids)
         return redirect(url_for('allocateitems', receipt_id=receipt_id))
 
-    receipt = db.receipts.find_one({'_id': ObjectId(receipt_id)})
+    receipt = wizard_receipt(receipt_id, 'items')
     if not receipt:
         return jsonify({"error": "Receipt not found"}), 404
     items = receipt.get('items', [])
@@ -164,10 +335,6 @@ def select_appetizers(receipt_id):
 @app.route('/allocateitems/<receipt_id>', methods=['GET', 'POST'])
 def allocateitems(receipt_id):
     if request.method == 'POST':
-        # Clear previous allocations to avoid duplicates
-        db.receipts.update_one({'_id': ObjectId(receipt_id)}, 
-                               {'$unset': {'allocations': ''}})
-
         allocations = {}  # This will store which items are chosen by which people
         item_counts = {}  # This will count how many people have chosen each item
 
@@ -180,14 +347,27 @@ def allocateitems(receipt_id):
         #logger.debug(f"Updated allocations: {allocations}")
         #logger.debug(f"Updated item counts: {item_counts}")
 
-        # Store the updated allocations and counts in the database
-        db.receipts.update_one(
-            {'_id': ObjectId(receipt_id)},
-            {'$set': {'allocations': allocations, 'item_counts': item_counts}}
+        if wizard_sessions is not None:
+            if not wizard_sessions.update(db, receipt_id, allocations=allocations,
+                                          item_counts=item_counts):
+                return jsonify({"error": "Receipt not found"}), 404
+            return redirect(url_for('enter_tip', receipt_id=receipt_id))
+
+        # Replace the allocations and counts in one write; $set overwrites the
+        # previous maps whole, so no separate $unset is needed
+        result = db.receipts.update_one(
+            {'_id': ObjectId(receipt_id), 'shares': {'$exists': False}},
+            {'$set': {'allocations': allocations, 'item_counts': item_counts}, **schema.touch()}
         )
+        if not result.matched_count:
+            # already split: only the items that moved change the stored shares
+            try:
+                split_ledger.reallocate(db, receipt_id, allocations)
+            except split_engine.SplitError as e:
+                return jsonify({"error": str(e)}), 400
         return redirect(url_for('enter_tip', receipt_id=receipt_id))
     else:
-        receipt = db.receipts.find_one({'_id': ObjectId(receipt_id)})
+        receipt = wizard_receipt(receipt_id, 'names_and_items')
         return render_template('allocateitems.html', 
                                people=receipt.get('names', []), 
                                food_items=receipt.get('items', []), 
@@ -216,89 +396,45 @@ def calculate_bill(receipt_id):
         
         # Validate that the tip percentage is a valid float
         try:
-            tip_percentage = float(tip_percentage_input) / 100
+            if not math.isfinite(float(tip_percentage_input)):
+                raise ValueError(tip_percentage_input)
         except ValueError:
             #logger.error("Invalid tip percentage input.")
             return jsonify({"error": "Invalid tip percentage provided"}), 400
 
         # Fetching the receipt
-        receipt = db.receipts.find_one({"_id": ObjectId(receipt_id)})
+        receipt = wizard_receipt(receipt_id, 'split_inputs')
         if not receipt:
             #logger.error("No receipt found.")
             return jsonify({"error": "Receipt not found"}), 404
 
-        items = receipt.get('items', [])
-        allocations = receipt.get('allocations', {})
-        item_counts = receipt.get('item_counts', {})     
-        #logger.debug(f"Allocations retrieved: {allocations}")
-        #logger.debug(f"Item counts retrieved: {item_counts}")
-        
-        # Aggregate total appetizer cost
-        appetizer_items = [item for item in items if item.get('is_appetizer', False)]
-        #logger.debug(f"Items marked as appetizers: {[(item['description'], 
-        # item['amount']) for item in appetizer_items]}")
-        
-        appetizer_total = sum(item['amount'] for item in appetizer_items 
-                              if item.get('is_appetizer', False))
-        #logger.debug(f"Total appetizer cost: {appetizer_total}")
-    
-        tax = float(receipt.get('tax', 0.00))
-        subtotal = float(receipt.get('subtotal', 0.00))
-        
-        #logger.debug(f"Subtotal and tax values: Subtotal={subtotal}, Tax={tax}")
-        
-        if not items or subtotal <= 0:
-            #logger.error("No items found or subtotal is zero or negative.")
-            return jsonify({"error": "Invalid receipt data"}), 400
-        
-        payments = {name: 0 for name in receipt.get('names', [])}
-        
-        num_people = len(receipt.get('names', []))
-
-        if num_people == 0:
-            #logger.error("Number of people is zero.")
-            return jsonify({"error": "Number of people cannot be zero"}), 400
+        if wizard_sessions is None and receipt.get('shares') is not None:
+            # split before: the stored shares only need scaling to the new tip
+            try:
+                payments, total_payment = split_ledger.set_tip(
+                    db, receipt_id, tip_percentage_input, extra=schema.finalize_update(),
+                    receipt=receipt)
+            except split_ledger.LedgerConflict:
+                return jsonify({"error": "The split is being edited elsewhere, try again"}), 409
+            results_pages.invalidate(receipt_id)
+            return render_template('results.html', payments=payments,
+                                   total_payment=total_payment, receipt_id=receipt_id)
 
-        if num_people > 0:
-            appetizer_cost_per_person = appetizer_total / num_people
+        try:
+            payments, total_payment = split_engine.split_receipt(receipt, tip_percentage_input)
+        except split_engine.SplitError as e:
+            return jsonify({"error": str(e)}), 400
+
+        update = {'$set': {'payments': payments}, **schema.finalize_update()}
+        # keep the shares so later edits adjust them instead of splitting again
+        for operator, fields in split_ledger.ledger_update(receipt, tip_percentage_input).items():
+            update.setdefault(operator, {}).update(fields)
+        if wizard_sessions is not None:
+            # the wizard's changes and the payments in one write
+            wizard_sessions.finish(db, receipt_id, update)
         else:
-            appetizer_cost_per_person = 0
-        #logger.debug(f"Appetizer cost per person: {appetizer_cost_per_person}")
-
-        appetizer_cost_per_person = appetizer_total / num_people if num_people else 0
-        for name in payments:
-            payments[name] += appetizer_cost_per_person
-            #logger.debug(f"Initial payment for {name}: {payments[name]}")
-
-        # Calculate individual item costs and distribute them
-        for item_id, users in allocations.items():
-            item = next((item for item in items if str(item['_id']) == item_id), None)
-            if item:
-                num_users = item_counts.get(item_id, 1)
-                cost_per_user = item['amount'] / num_users
-                for user in users:
-                    payments[user] += cost_per_user
-                    #logger.debug(f"Allocating ${cost_per_user:.2f} to {user} for item {item['description']}")
-            else:
-                logger.debug(f"Item not found for ID: {item_id}")
-
-
-
-
-        total_with_tax = subtotal + tax
-        total_with_tip = total_with_tax * (1 + tip_percentage)
-        #logger.debug(f"Total with tax: {total_with_tax}, Total with tip: {total_with_tip}")
-
-        # Apply tax and tip proportionally
-        total_payment = 0
-        for name, payment in payments.items():
-            person_share_before_tax = payment / subtotal if subtotal > 0 else 0
-            final_payment = payment + (total_with_tax - subtotal) * person_share_before_tax + (total_with_tip - total_with_tax) * person_share_before_tax
-            payments[name] = round(final_payment, 2)
-            total_payment += payments[name]
-            #logger.debug(f"Final payment for {name}: {payments[name]}")
-
-        db.receipts.update_one({"_id": ObjectId(receipt_id)}, {'$set': {'payments': payments}})
+            db.receipts.update_one({"_id": ObjectId(receipt_id)}, update)
+        results_pages.invalidate(receipt_id)
         
         return render_template('results.html', payments=payments, 
                                total_payment=total_payment, receipt_id=receipt_id)
@@ -309,6 +445,114 @@ def calculate_bill(receipt_id):
 
 
 
+@app.route('/results/<receipt_id>')
+def results(receipt_id):
+    """
+    The results of a calculated bill, for sharing. Rendered once per receipt
+    version and revalidated with its ETag, so repeat visits get a 304.
+    """
+    if not ObjectId.is_valid(receipt_id):
+        return jsonify({"error": "Receipt not found"}), 404
+    receipt = receipt_store.get_receipt(db, receipt_id, 'results')
+    if not receipt or receipt.get('payments') is None:
+        return jsonify({"error": "Receipt not found"}), 404
+    version = page_cache.version_stamp(receipt_id, receipt)
+
+    def render():
+        payments = receipt['payments']
+        return render_template('results.html', payments=payments,
+                               total_payment=round(sum(payments.values()), 2),
+                               receipt_id=receipt_id)
+    response = Response(results_pages.render(receipt_id, version, render), mimetype='text/html')
+    response.set_etag(version)
+    # browsers keep the page but check back each time; unchanged means a bodiless 304
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@app.route('/api/calculate_bills', methods=['POST'])
+def calculate_bills():
+    """
+    Recompute the split for many receipts in one call. Expects JSON like
+    {"receipts": [{"receipt_id": "...", "tip_percentage": 18}, ...]}.
+    """
+    request_data = request.get_json(silent=True) or {}
+    entries = request_data.get('receipts')
+    if not isinstance(entries, list) or not entries:
+        return jsonify({"error": "receipts must be a non-empty list"}), 400
+    if len(entries) > BATCH_SPLIT_MAX_RECEIPTS:
+        return jsonify({"error": f"At most {BATCH_SPLIT_MAX_RECEIPTS} receipts per call"}), 400
+    try:
+        tips = {str(entry['receipt_id']): entry.get('tip_percentage', 0) for entry in entries}
+    except (KeyError, TypeError, AttributeError):
+        return jsonify({"error": "Each entry needs a receipt_id"}), 400
+
+    try:
+        results, stats = batch_split.run_batch(db, tips)
+    except pymongo.errors.ServerSelectionTimeoutError as e:
+        logger.error("Could not connect to MongoDB: %s", str(e))
+        return jsonify({"error": "Database connection failed"}), 503
+    logger.info("Batch split: %s", stats)
+    return jsonify(results=results, stats=stats), 200
+
+
+def ledger_edit(edit, receipt_id, *args):
+    """Run a split_ledger edit for one of the /api/receipts/<receipt_id>/... routes."""
+    if not ObjectId.is_valid(receipt_id):
+        return jsonify({"error": "Receipt not found"}), 404
+    try:
+        result = edit(db, receipt_id, *args)
+    except split_ledger.NoLedger:
+        return jsonify({"error": "Calculate the bill before editing the split"}), 409
+    except split_ledger.LedgerConflict:
+        return jsonify({"error": "The split is being edited elsewhere, try again"}), 409
+    except split_engine.SplitError as e:
+        return jsonify({"error": str(e)}), 400
+    except pymongo.errors.ServerSelectionTimeoutError as e:
+        logger.error("Could not connect to MongoDB: %s", str(e))
+        return jsonify({"error": "Database connection failed"}), 503
+    if result is None:
+        return jsonify({"error": "Receipt not found"}), 404
+    results_pages.invalidate(receipt_id)
+    payments, total_payment = result
+    return jsonify(payments=payments, total_payment=total_payment), 200
+
+
+@app.route('/api/receipts/<receipt_id>/allocations/<item_id>', methods=['PUT'])
+def move_item(receipt_id, item_id):
+    """Give an item to other people, e.g. {"people": ["Alice", "Bob"]}."""
+    people = (request.get_json(silent=True) or {}).get('people')
+    if not isinstance(people, list) or not all(isinstance(name, str) for name in people):
+        return jsonify({"error": "people must be a list of names"}), 400
+    return ledger_edit(split_ledger.move_item, receipt_id, item_id, people)
+
+
+@app.route('/api/receipts/<receipt_id>/tip', methods=['PUT'])
+def change_tip(receipt_id):
+    """Change the tip, e.g. {"tip_percentage": 20}."""
+    tip_percentage = (request.get_json(silent=True) or {}).get('tip_percentage')
+    try:
+        if not math.isfinite(float(tip_percentage)):
+            raise ValueError(tip_percentage)
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid tip percentage provided"}), 400
+    return ledger_edit(split_ledger.set_tip, receipt_id, tip_percentage)
+
+
+@app.route('/api/receipts/<receipt_id>/people', methods=['POST'])
+def add_person(receipt_id):
+    """Add someone to the split, e.g. {"name": "Dan"}."""
+    name = str((request.get_json(silent=True) or {}).get('name') or '').strip()
+    if not name:
+        return jsonify({"error": "name is required"}), 400
+    return ledger_edit(split_ledger.add_person, receipt_id, name)
+
+
+@app.route('/api/receipts/<receipt_id>/people/<name>', methods=['DELETE'])
+def remove_person(receipt_id, name):
+    return ledger_edit(split_ledger.remove_person, receipt_id, name)
+
+
 @app.route("/search_history")
 def search_history():
     return render_template("search_history.html")
@@ -316,16 +560,21 @@ def search_history():
 #route to show all the receipts history with functionality to search a keyword
 @app.route("/history")
 def history():
-    keyword = request.args.get('search', None)
-    
-    query = {}
-    if keyword:
-        query = {"name": {"$regex": keyword, "$options": "i"}}
-    
-    items = db.receipts.find(query)
-    items_list = list(items)
-
-    return render_template("search_history.html", items=items_list)
+    keyword = request.args.get('search', '')
+    before = request.args.get('before')
+    limit = request.args.get('limit', receipt_store.HISTORY_PAGE_SIZE, type=int)
+    if before is not None and not ObjectId.is_valid(before):
+        return jsonify({"error": "Invalid page cursor"}), 400
+
+    receipts, next_cursor = receipt_store.search_history(db, keyword, before, limit)
+    # each row is rendered once per receipt version and reused across searches and pages
+    rows = [Markup(history_rows.render(
+                receipt['_id'], page_cache.version_stamp(receipt['_id'], receipt),
+                lambda receipt=receipt: render_template("history_row.html", item=receipt)))
+            for receipt in receipts]
+
+    return render_template("search_history.html", rows=rows, search=keyword,
+                           next_cursor=next_cursor, limit=limit)
 
 @app.route('/test_mongodb')
 def test_mongodb():
@@ -337,12 +586,20 @@ def test_mongodb():
         return jsonify(success=False, message=str(e)), 500
 @app.route('/test_ml_service')
 def test_ml_service():
-    response = requests.get('http://machine-learning-client:5002/test_connection')
+    try:
+        with metrics.observe_ml_call('/test_connection'):
+            response = ml_service.get('/test_connection')
+    except (requests.RequestException, ml_client.CircuitOpenError) as e:
+        logger.error("ML service unreachable: %s", str(e))
+        return jsonify(success=False, message="Failed to connect to ML service"), 500
     if response.status_code == 200:
         return jsonify(success=True, message="Connected to ML service",
                        response=response.json()), 200
     else:
         return jsonify(success=False, message="Failed to connect to ML service"), 500
+@app.route('/ml_service_status')
+def ml_service_status():
+    return jsonify(ml_service.status()), 200
 @app.route('/test_connection', methods=['GET'])
 def test_connection():
     return jsonify(success=True, message="Machine Learning Client is reachable"), 200
@@ -0,0 +1,126 @@
+"""
+Async serving mode for the web app.
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5000 --workers 2
+
+The routes that spend their time waiting are native coroutines: OCR progress
+streams, job status long-polls, receipt item lookups and calls to the ML
+service. They run on motor and httpx, so an open connection costs a coroutine
+rather than a thread. Every other route is the unchanged Flask view, with the
+same templates, served through asgiref's WSGI adapter.
+"""
+import contextlib
+import os
+import time
+
+from asgiref.wsgi import WsgiToAsgi
+from motor.motor_asyncio import AsyncIOMotorClient
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+import app as sync_app
+import metrics
+import ml_client
+import progress
+import receipt_store
+
+db = AsyncIOMotorClient(os.getenv("MONGO_URI"),
+                        event_listeners=[metrics.MongoCommandMetrics()])[os.getenv("MONGO_DBNAME")]
+ml_service = ml_client.AsyncMLServiceClient(**ml_client.settings_from_env())
+progress_hub = progress.AsyncProgressHub(db, poll_seconds=sync_app.progress_hub.poll_seconds)
+
+
+def _number(value, cast, default=None):
+    """Parse a query value the way Flask's ``args.get(type=...)`` does: bad values fall back to the default."""
+    if value is None:
+        return default
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return default
+
+
+async def job_status(request):
+    receipt_id = request.path_params["receipt_id"]
+    job = await progress.find_job(db, receipt_id)
+    if not job:
+        return JSONResponse({"error": "Job not found"}, status_code=404)
+    wait = _number(request.query_params.get("wait"), float)
+    if wait:
+        after = _number(request.query_params.get("after"), int, -1)
+        job = await progress_hub.wait(receipt_id, after,
+                                      min(wait, sync_app.PROGRESS_WAIT_MAX_SECONDS)) or job
+    return JSONResponse(progress.job_summary(receipt_id, job))
+
+
+async def progress_stream(request):
+    last_event_id = _number(request.headers.get("last-event-id"), int)
+    events = progress_hub.stream(request.path_params["receipt_id"], last_event_id,
+                                 sync_app.PROGRESS_STREAM_SECONDS)
+    return StreamingResponse(events, media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def receipt_items(request):
+    receipt = await receipt_store.get_receipt(db, request.path_params["receipt_id"],
+                                              "items_preview")
+    if not receipt:
+        return JSONResponse({"error": "Receipt not found"}, status_code=404)
+    return JSONResponse(receipt_store.items_preview(receipt))
+
+
+async def test_ml_service(request):
+    failed = {"success": False, "message": "Failed to connect to ML service"}
+    try:
+        with metrics.observe_ml_call("/test_connection"):
+            response = await ml_service.get("/test_connection")
+    except ml_service.errors as e:
+        sync_app.logger.error("ML service unreachable: %s", str(e))
+        return JSONResponse(failed, status_code=500)
+    if response.status_code != 200:
+        return JSONResponse(failed, status_code=500)
+    return JSONResponse({"success": True, "message": "Connected to ML service",
+                         "response": response.json()})
+
+
+async def ml_service_status(request):
+    return JSONResponse(ml_service.status())
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    yield
+    await ml_service.aclose()
+    db.client.close()
+
+
+def timed(route, endpoint):
+    """Record a native route in the same request metrics the Flask routes use."""
+    async def timed_endpoint(request):
+        started = time.perf_counter()
+        try:
+            response = await endpoint(request)
+        except Exception:
+            metrics.REQUEST_ERRORS.labels(request.method, route).inc()
+            raise
+        length = response.headers.get("content-length")
+        metrics.observe_request(request.method, route, response.status_code,
+                                time.perf_counter() - started, None,
+                                int(length) if length else None)
+        return response
+    return Route(route, timed_endpoint)
+
+
+application = Starlette(
+    routes=[
+        timed("/job_status/{receipt_id}", job_status),
+        timed("/progress/{receipt_id}", progress_stream),
+        timed("/receipt_items/{receipt_id}", receipt_items),
+        timed("/test_ml_service", test_ml_service),
+        timed("/ml_service_status", ml_service_status),
+        # everything else: the Flask app, templates and all
+        Mount("/", app=WsgiToAsgi(sync_app.app)),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,124 @@
+"""
+Recompute the split for many stored receipts at once.
+
+Receipts are loaded with a single cursor, split in a tight loop (or across
+a process pool for very large batches) and the payments are written back
+with one bulk_write. Used by the /api/calculate_bills endpoint and runnable
+from the command line for month-end reconciliation:
+
+    python batch_split.py --tip 18 --all
+    python batch_split.py --tip 15 --ids-file receipt_ids.txt --processes 4
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pymongo
+from bson import ObjectId
+from bson.errors import InvalidId
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+
+import receipt_store
+import schema
+import split_engine
+import split_ledger
+
+
+def _split_job(job):
+    receipt_id, receipt, tip_percentage = job
+    try:
+        payments, total = split_engine.split_receipt(receipt, tip_percentage)
+        ledger = split_ledger.ledger_update(receipt, tip_percentage)
+    except split_engine.SplitError as e:
+        return receipt_id, {"error": str(e)}, None
+    return receipt_id, {"payments": payments, "total_payment": total}, ledger
+
+
+def run_batch(db, tips, processes=0):
+    """
+    Split every receipt in tips, a {receipt_id: tip_percentage} mapping, and
+    save the payments. Returns per-receipt results and throughput stats.
+    """
+    started = time.perf_counter()
+    results = {}
+    object_ids = {}
+    for receipt_id in tips:
+        try:
+            object_ids[ObjectId(receipt_id)] = receipt_id
+        except (InvalidId, TypeError):
+            results[receipt_id] = {"error": "Invalid receipt id"}
+
+    cursor = receipt_store.find_receipts(db, {"_id": {"$in": list(object_ids)}}, 'split_inputs')
+    jobs = [(object_ids[receipt['_id']], receipt, tips[object_ids[receipt['_id']]])
+            for receipt in cursor]
+    loaded = time.perf_counter()
+
+    if processes and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            computed = list(pool.map(_split_job, jobs, chunksize=max(1, len(jobs) // (processes * 4))))
+    else:
+        computed = [_split_job(job) for job in jobs]
+    results.update((receipt_id, result) for receipt_id, result, _ in computed)
+    for receipt_id in object_ids.values():
+        results.setdefault(receipt_id, {"error": "Receipt not found"})
+    split_done = time.perf_counter()
+
+    writes = [UpdateOne({"_id": ObjectId(receipt_id)},
+                        {"$set": dict(ledger["$set"], payments=result["payments"]),
+                         "$inc": ledger["$inc"], **schema.finalize_update()})
+              for receipt_id, result, ledger in computed if "payments" in result]
+    if writes:
+        db.receipts.bulk_write(writes, ordered=False)
+    finished = time.perf_counter()
+
+    elapsed = finished - started
+    stats = {
+        "requested": len(tips),
+        "split": len(writes),
+        "failed": len(tips) - len(writes),
+        "load_seconds": round(loaded - started, 4),
+        "split_seconds": round(split_done - loaded, 4),
+        "write_seconds": round(finished - split_done, 4),
+        "elapsed_seconds": round(elapsed, 4),
+        "receipts_per_second": round(len(tips) / elapsed, 1) if elapsed else None,
+    }
+    return results, stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recompute payments for stored receipts.")
+    parser.add_argument("receipt_ids", nargs="*", help="receipt ids to recompute")
+    parser.add_argument("--ids-file", help="file with one receipt id per line")
+    parser.add_argument("--all", action="store_true", help="recompute every receipt with names")
+    parser.add_argument("--tip", required=True, help="tip percentage applied to every receipt")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="split in a pool of this many processes (default: in-process)")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    db = pymongo.MongoClient(os.getenv("MONGO_URI"))[os.getenv("MONGO_DBNAME")]
+
+    receipt_ids = list(args.receipt_ids)
+    if args.ids_file:
+        with open(args.ids_file) as f:
+            receipt_ids.extend(line.strip() for line in f if line.strip())
+    if args.all:
+        receipt_ids.extend(str(receipt['_id']) for receipt in
+                           db.receipts.find({"names.0": {"$exists": True}}, {"_id": 1}))
+    if not receipt_ids:
+        parser.error("no receipts given")
+
+    results, stats = run_batch(db, dict.fromkeys(receipt_ids, args.tip), args.processes)
+    for receipt_id, result in results.items():
+        if "error" in result:
+            print(f"{receipt_id}: {result['error']}", file=sys.stderr)
+    print(json.dumps(stats, indent=2))
+    return 0 if stats["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
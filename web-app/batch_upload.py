@@ -0,0 +1,105 @@
+"""
+Store and queue many uploaded receipts at once.
+
+The /api/upload_batch route streams each file into GridFS, then queue_batch
+inserts all the receipts with one insert_many and all their OCR jobs with
+another. The ML client's OCR workers claim the jobs concurrently, so
+OCR_WORKERS bounds how many receipts are read at a time. The pages of a
+multi-page receipt are read in parallel as well, bounded by
+OCR_PAGE_CONCURRENCY, and their line items are merged into one receipt.
+
+A multi-page receipt lists its images in order under `pages`. image_id is
+its first page, and image_sha256 is a digest of all the page digests, so
+the OCR cache only matches the same pages in the same order.
+
+Batch jobs are queued at BATCH priority, so the ML client reads single
+uploads, where someone is waiting on the result, first and leaves them the
+last of the OCR quota (see the ML client's ocr_scheduler).
+"""
+import hashlib
+import uuid
+from datetime import datetime, timezone
+
+from bson import ObjectId
+
+import progress
+import schema
+
+# sha256 of zero bytes: an empty upload
+EMPTY_SHA256 = hashlib.sha256().hexdigest()
+# OCR job priorities, lowest first; the ML client's lanes
+INTERACTIVE, BATCH = 0, 1
+
+
+def ocr_job(receipt_id, stored_at=None, now=None, priority=INTERACTIVE):
+    """A queued OCR job for a stored receipt."""
+    now = now or datetime.now(timezone.utc)
+    return {
+        "receipt_id": ObjectId(receipt_id),
+        "status": "queued",
+        "stage": "queued",
+        "stages": [{"stage": "stored", "at": stored_at or now},
+                   {"stage": "queued", "at": now}],
+        "priority": priority,
+        "attempts": 0,
+        "last_error": None,
+        "run_after": now,
+        "created_at": now,
+        "updated_at": now,
+    }
+
+
+def new_receipt(batch_id, pages, now):
+    """
+    A receipt for one image, or for the images of its pages in order. Not a
+    draft: nobody may split it within the draft TTL, so it isn't expired.
+    """
+    receipt = {"batch_id": batch_id, "image_id": pages[0]["image_id"], **schema.stored_fields(now)}
+    if len(pages) == 1:
+        receipt["image_sha256"] = pages[0]["image_sha256"]
+    else:
+        receipt["pages"] = pages
+        receipt["image_sha256"] = hashlib.sha256(
+            "".join(page["image_sha256"] for page in pages).encode()).hexdigest()
+    return receipt
+
+
+def queue_batch(db, stored, multipage=False):
+    """
+    Insert the receipts for stored, a list of (status, page) pairs, and queue
+    their OCR jobs. Each status dict is marked queued with its receipt_id.
+    Returns the batch id.
+    """
+    batch_id = uuid.uuid4().hex
+    now = datetime.now(timezone.utc)
+    if multipage:
+        groups = [stored]
+    else:
+        groups = [[entry] for entry in stored]
+    result = db.receipts.insert_many(
+        [new_receipt(batch_id, [page for _, page in group], now) for group in groups])
+    db.ocr_jobs.insert_many([ocr_job(receipt_id, now=now, priority=BATCH)
+                             for receipt_id in result.inserted_ids])
+    for receipt_id, group in zip(result.inserted_ids, groups):
+        for status, _ in group:
+            status.update(status="queued", receipt_id=str(receipt_id))
+    return batch_id
+
+
+def batch_status(db, batch_id):
+    """OCR progress for every receipt in a batch, or None if there is no such batch."""
+    receipt_ids = [receipt["_id"] for receipt in db.receipts.find({"batch_id": batch_id}, {"_id": 1})]
+    if not receipt_ids:
+        return None
+    latest = {}
+    for job in db.ocr_jobs.find({"receipt_id": {"$in": receipt_ids}}, progress.JOB_VIEW) \
+            .sort("created_at", 1):
+        latest[job["receipt_id"]] = job
+    receipts = [progress.job_summary(str(receipt_id), latest[receipt_id]) if receipt_id in latest
+                else {"receipt_id": str(receipt_id), "status": "unknown"}
+                for receipt_id in receipt_ids]
+    counts = {}
+    for receipt in receipts:
+        counts[receipt["status"]] = counts.get(receipt["status"], 0) + 1
+    return {"batch_id": batch_id, "receipts": receipts, "counts": counts,
+            "finished": all(receipt["status"] in progress.FINAL_STATUSES for receipt in receipts)}
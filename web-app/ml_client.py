@@ -0,0 +1,276 @@
+"""
+Shared HTTP client for the machine-learning-client service.
+
+Requests go through one pooled requests.Session, so connections to the ML
+service are reused instead of paying a new TCP handshake per receipt. Every
+call has connect/read timeouts, transient failures are retried a bounded
+number of times with jittered backoff, and a circuit breaker stops sending
+traffic to an ML service that keeps failing until it has had time to recover.
+A read timeout is only retried for idempotent methods: a POST /predict that
+timed out may still be running, and sending it again could pay for OCR twice.
+AsyncMLServiceClient does the same on a pooled httpx.AsyncClient for the
+ASGI serving mode.
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# responses worth retrying: the ML service is restarting or overloaded
+RETRY_STATUSES = {502, 503, 504}
+# methods safe to send again after the service may already have acted on them
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+
+class CircuitOpenError(Exception):
+    """The ML service has failed too often recently; the call was not attempted."""
+
+
+class CircuitBreaker:
+    """
+    closed: calls go through. After failure_threshold failures in a row it
+    opens and rejects calls. Once reset_timeout has passed it goes half-open
+    and lets a single trial call through; success closes it again and
+    failure re-opens it.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = "closed"
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self.total_failures = 0
+        self.rejected = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        if self._state == "open" and self._clock() - self._opened_at >= self.reset_timeout:
+            self._state = "half_open"
+            self._trial_in_flight = False
+        return self._state
+
+    def allow(self):
+        with self._lock:
+            state = self._current_state()
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._state = "closed"
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self.total_failures += 1
+            if self._state == "half_open" or self._failures >= self.failure_threshold:
+                self._state = "open"
+                self._opened_at = self._clock()
+            self._trial_in_flight = False
+
+    def release(self):
+        """A call ended without an answer either way (e.g. it was cancelled); free its trial slot."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def snapshot(self):
+        with self._lock:
+            state = self._current_state()
+            retry_in = None
+            if state == "open":
+                retry_in = max(0.0, self.reset_timeout - (self._clock() - self._opened_at))
+            return {
+                "state": state,
+                "consecutive_failures": self._failures,
+                "failure_threshold": self.failure_threshold,
+                "total_failures": self.total_failures,
+                "rejected_calls": self.rejected,
+                "retry_in_seconds": retry_in,
+            }
+
+
+def settings_from_env(environ=os.environ):
+    """Client keyword arguments from the ML_* environment variables."""
+    return {
+        "base_url": environ.get("ML_SERVICE_URL", "http://machine-learning-client:5002"),
+        "pool_size": int(environ.get("ML_POOL_SIZE", 10)),
+        "connect_timeout": float(environ.get("ML_CONNECT_TIMEOUT", 3)),
+        "read_timeout": float(environ.get("ML_READ_TIMEOUT", 30)),
+        "max_retries": int(environ.get("ML_MAX_RETRIES", 2)),
+        "retry_backoff": float(environ.get("ML_RETRY_BACKOFF", 0.2)),
+        "breaker": CircuitBreaker(
+            failure_threshold=int(environ.get("ML_BREAKER_FAILURES", 5)),
+            reset_timeout=float(environ.get("ML_BREAKER_RESET_SECONDS", 30))),
+    }
+
+
+class _ServiceClient:
+    """Configuration, breaker and retry policy shared by the sync and async clients."""
+
+    def __init__(self, base_url, pool_size=10, connect_timeout=3.0, read_timeout=30.0,
+                 max_retries=2, retry_backoff=0.2, breaker=None):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.pool_size = pool_size
+
+    def _check_circuit(self):
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"ML service circuit is {self.breaker.state}")
+
+    @staticmethod
+    def _retry_read_timeout(method):
+        return method.upper() in IDEMPOTENT_METHODS
+
+    def _settle(self, response):
+        """Count an answer towards the breaker: a 5xx is a failure even when it isn't retried."""
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    def _backoff(self, attempt):
+        # full jitter so callers that failed together don't retry together
+        return random.uniform(0, self.retry_backoff * 2 ** attempt)
+
+    def status(self):
+        return {
+            "base_url": self.base_url,
+            "pool_size": self.pool_size,
+            "connect_timeout": self.timeout[0],
+            "read_timeout": self.timeout[1],
+            "max_retries": self.max_retries,
+            "circuit": self.breaker.snapshot(),
+        }
+
+
+class MLServiceClient(_ServiceClient):
+    def __init__(self, base_url, **kwargs):
+        super().__init__(base_url, **kwargs)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method, path, **kwargs):
+        """
+        Send a request, retrying connection errors, timeouts and 502/503/504.
+        Raises CircuitOpenError without calling the service while the breaker is open.
+        Any requests error or 5xx answer counts against the breaker.
+        """
+        self._check_circuit()
+        kwargs.setdefault("timeout", self.timeout)
+        try:
+            response = self._send(method, path, **kwargs)
+        except requests.RequestException:
+            self.breaker.record_failure()
+            raise
+        except BaseException:
+            self.breaker.release()
+            raise
+        return self._settle(response)
+
+    def _send(self, method, path, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.request(method, self.base_url + path, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if isinstance(e, requests.ReadTimeout) and not self._retry_read_timeout(method):
+                    raise
+                error = e
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+                error = requests.HTTPError(f"{response.status_code} from ML service",
+                                           response=response)
+            if attempt < self.max_retries:
+                time.sleep(self._backoff(attempt))
+        raise error
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post_json(self, path, payload, **kwargs):
+        return self.request("POST", path, json=payload, **kwargs)
+
+
+class AsyncMLServiceClient(_ServiceClient):
+    """
+    The same retries and circuit breaker on an httpx.AsyncClient, so waiting
+    on the ML service holds a coroutine rather than a thread. Errors are
+    httpx's (httpx.HTTPError: transport, status and decoding errors).
+    """
+
+    def __init__(self, base_url, transport=None, **kwargs):
+        import httpx  # only the ASGI serving mode needs httpx
+
+        super().__init__(base_url, **kwargs)
+        self._httpx = httpx
+        # what a failed call raises, for callers' except clauses
+        self.errors = (httpx.HTTPError, CircuitOpenError)
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url, transport=transport,
+            timeout=httpx.Timeout(self.timeout[1], connect=self.timeout[0]),
+            limits=httpx.Limits(max_connections=self.pool_size,
+                                max_keepalive_connections=self.pool_size))
+
+    async def request(self, method, path, **kwargs):
+        self._check_circuit()
+        try:
+            response = await self._send(method, path, **kwargs)
+        except self._httpx.HTTPError:
+            self.breaker.record_failure()
+            raise
+        except BaseException:  # cancelled, most likely
+            self.breaker.release()
+            raise
+        return self._settle(response)
+
+    async def _send(self, method, path, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await self.client.request(method, path, **kwargs)
+            except self._httpx.TransportError as e:  # connect errors and timeouts
+                if isinstance(e, self._httpx.ReadTimeout) and not self._retry_read_timeout(method):
+                    raise
+                error = e
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+                error = self._httpx.HTTPStatusError(f"{response.status_code} from ML service",
+                                                    request=response.request, response=response)
+            if attempt < self.max_retries:
+                await asyncio.sleep(self._backoff(attempt))
+        raise error
+
+    async def get(self, path, **kwargs):
+        return await self.request("GET", path, **kwargs)
+
+    async def post_json(self, path, payload, **kwargs):
+        return await self.request("POST", path, json=payload, **kwargs)
+
+    async def aclose(self):
+        await self.client.aclose()
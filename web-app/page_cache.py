@@ -0,0 +1,77 @@
+"""
+Rendered HTML for finished receipts, cached per receipt version.
+
+Once a bill is calculated its results page only changes when the split is
+edited, yet every diner with the shared link refreshes it. Entries are keyed
+by receipt id plus a version stamp made from updated_at, which every write
+to a receipt sets, and ledger_version, which every change to the payments
+bumps. A changed receipt therefore never matches its old entries, whichever
+process or service wrote it. The routes that rewrite payments here also
+drop a receipt's entries straight away with invalidate().
+
+The stamp doubles as the results page's ETag, so a browser that already has
+the current page gets a 304 without anything being rendered or sent.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def version_stamp(receipt_id, receipt):
+    """A short, opaque version of a receipt: changes whenever the receipt is written."""
+    updated_at = receipt.get("updated_at")
+    raw = f"{receipt_id}|{receipt.get('ledger_version', 0)}|" \
+          f"{updated_at.isoformat() if updated_at else ''}"
+    return hashlib.blake2b(raw.encode(), digest_size=8).hexdigest()
+
+
+class PageCache:
+    """LRU of rendered HTML keyed by (receipt id, version stamp)."""
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, receipt_id, version):
+        with self._lock:
+            html = self._entries.get((str(receipt_id), version))
+            if html is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((str(receipt_id), version))
+            self.hits += 1
+            return html
+
+    def put(self, receipt_id, version, html):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[(str(receipt_id), version)] = html
+            self._entries.move_to_end((str(receipt_id), version))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def render(self, receipt_id, version, render):
+        """The cached HTML for this version, or render() it and keep it."""
+        html = self.get(receipt_id, version)
+        if html is None:
+            html = render()
+            self.put(receipt_id, version, html)
+        return html
+
+    def invalidate(self, receipt_id):
+        """Drop every cached version of a receipt."""
+        receipt_id = str(receipt_id)
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == receipt_id]:
+                del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self._entries), "max_entries": self.max_entries,
+                    "hits": self.hits, "misses": self.misses,
+                    "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0}
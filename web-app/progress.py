@@ -0,0 +1,286 @@
+"""
+Stream OCR progress to the browser.
+
+Each OCR job document in ocr_jobs carries the stage it has reached and a
+stages history: the web app records stored and queued at upload, the ML
+client adds ocr_running, parsed and ready (or retrying/failed, or deferred
+while the OCR quota refills, until run_after). Rather than
+every open stream querying Mongo, one poller per process looks for jobs
+updated since its last pass and hands them to the streams waiting on those
+receipts. Run under gunicorn's gevent worker the poller and the streams are
+greenlets, so thousands of open streams don't each hold an OS thread.
+AsyncProgressHub is the same on asyncio and motor for the ASGI mode.
+"""
+import asyncio
+import json
+import queue
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import pymongo
+from bson import ObjectId
+
+STAGES = ("stored", "queued", "ocr_running", "parsed", "ready")
+FINAL_STATUSES = {"done", "failed"}
+# job fields a stream needs; never the whole document
+JOB_VIEW = {"receipt_id": 1, "status": 1, "stage": 1, "stages": 1, "attempts": 1, "last_error": 1,
+            "run_after": 1, "created_at": 1, "updated_at": 1}
+
+
+def utcnow():
+    # naive UTC, the way pymongo hands dates back, so both compare cleanly
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def find_job(db, receipt_id):
+    """The latest OCR job for a receipt, or None (a coroutine with motor)."""
+    return db.ocr_jobs.find_one({"receipt_id": ObjectId(receipt_id)}, JOB_VIEW,
+                                sort=[("created_at", pymongo.DESCENDING)])
+
+
+def job_stages(job):
+    """
+    The stages a job has been through. Jobs queued before stages were
+    recorded only have a status, so a finished one reports its outcome.
+    """
+    if job.get("stages"):
+        return job["stages"]
+    if job["status"] in FINAL_STATUSES:
+        return [{"stage": "ready" if job["status"] == "done" else "failed",
+                 "at": job["updated_at"]}]
+    return []
+
+
+def job_summary(receipt_id, job):
+    """The /job_status JSON body for a job."""
+    summary = {
+        "receipt_id": receipt_id,
+        "status": job["status"],
+        "stage": job.get("stage"),
+        "stages": [{"stage": s["stage"], "at": s["at"].isoformat()} for s in job_stages(job)],
+        "attempts": job.get("attempts", 0),
+        "last_error": job.get("last_error"),
+        "created_at": job["created_at"].isoformat(),
+        "updated_at": job["updated_at"].isoformat(),
+    }
+    if job.get("stage") == "deferred" and job.get("run_after"):
+        summary["deferred_until"] = job["run_after"].isoformat()
+    return summary
+
+
+def stage_event(index, stage, job):
+    payload = {"stage": stage["stage"], "at": stage["at"].isoformat(),
+               "status": job["status"], "last_error": job.get("last_error")}
+    return f"id: {index}\nevent: stage\ndata: {json.dumps(payload)}\n\n"
+
+
+def end_event(status):
+    return f"event: end\ndata: {json.dumps({'status': status})}\n\n"
+
+
+def waiting_for(job, after):
+    """Whether a long-poll for more than `after` stages should keep waiting."""
+    return job is not None and len(job_stages(job)) <= after \
+        and job["status"] not in FINAL_STATUSES
+
+
+class ProgressHub:
+    """Fan one Mongo poller out to every stream watching a receipt."""
+
+    def __init__(self, db, poll_seconds=0.5):
+        self.db = db
+        self.poll_seconds = poll_seconds
+        self._lock = threading.Lock()
+        self._subscribers = {}  # receipt ObjectId -> set of queues
+        self._since = None
+        self._poller = None
+
+    def subscribe(self, receipt_id):
+        inbox = queue.Queue()
+        with self._lock:
+            self._subscribers.setdefault(ObjectId(receipt_id), set()).add(inbox)
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._run, daemon=True,
+                                                name="progress-poller")
+                self._poller.start()
+        return inbox
+
+    def unsubscribe(self, receipt_id, inbox):
+        with self._lock:
+            inboxes = self._subscribers.get(ObjectId(receipt_id))
+            if inboxes is not None:
+                inboxes.discard(inbox)
+                if not inboxes:
+                    del self._subscribers[ObjectId(receipt_id)]
+
+    def watching(self):
+        with self._lock:
+            return sum(len(inboxes) for inboxes in self._subscribers.values())
+
+    def poll_once(self):
+        """Deliver every job updated since the last pass to its subscribers."""
+        with self._lock:
+            if not self._subscribers:
+                self._since = None
+                return 0
+        if self._since is None:
+            # a little slack for clock drift between the services
+            self._since = utcnow() - timedelta(seconds=max(self.poll_seconds, 1) * 2)
+        delivered = 0
+        # $gte so updates in the same millisecond aren't lost; streams ignore repeats
+        for job in self.db.ocr_jobs.find({"updated_at": {"$gte": self._since}}, JOB_VIEW):
+            if job["updated_at"] > self._since:
+                self._since = job["updated_at"]
+            with self._lock:
+                inboxes = list(self._subscribers.get(job["receipt_id"], ()))
+            for inbox in inboxes:
+                inbox.put(job)
+                delivered += 1
+        return delivered
+
+    def _run(self):
+        while True:
+            try:
+                self.poll_once()
+            except pymongo.errors.PyMongoError:
+                pass  # Mongo hiccup: streams keep their keepalives, try again next tick
+            time.sleep(self.poll_seconds)
+
+    def wait(self, receipt_id, after, timeout):
+        """
+        Long-poll: the job once it has more than `after` stages, or the
+        latest job when timeout runs out.
+        """
+        inbox = self.subscribe(receipt_id)
+        try:
+            job = find_job(self.db, receipt_id)
+            deadline = time.monotonic() + timeout
+            while waiting_for(job, after):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    job = inbox.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            return job
+        finally:
+            self.unsubscribe(receipt_id, inbox)
+
+    def stream(self, receipt_id, last_event_id=None, timeout=300, keepalive=15):
+        """
+        Server-sent events for a receipt's OCR job: one `stage` event per
+        stage reached (earlier stages are replayed first), then an `end`
+        event once the job is done or has failed. A reconnecting browser
+        sends Last-Event-ID and only gets what it missed.
+        """
+        inbox = self.subscribe(receipt_id)
+        try:
+            job = find_job(self.db, receipt_id)
+            if job is None:
+                yield end_event("missing")
+                return
+            sent = last_event_id + 1 if last_event_id is not None else 0
+            deadline = time.monotonic() + timeout
+            yield "retry: 2000\n\n"
+            while True:
+                stages = job_stages(job)
+                for index in range(sent, len(stages)):
+                    yield stage_event(index, stages[index], job)
+                sent = max(sent, len(stages))
+                if job["status"] in FINAL_STATUSES:
+                    yield end_event(job["status"])
+                    return
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    job = inbox.get(timeout=min(keepalive, remaining))
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+        finally:
+            self.unsubscribe(receipt_id, inbox)
+
+
+class AsyncProgressHub(ProgressHub):
+    """ProgressHub on asyncio: db is a motor database, streams are async generators."""
+
+    def subscribe(self, receipt_id):
+        inbox = asyncio.Queue()
+        with self._lock:
+            self._subscribers.setdefault(ObjectId(receipt_id), set()).add(inbox)
+            if self._poller is None or self._poller.done():
+                self._poller = asyncio.get_running_loop().create_task(self._run())
+        return inbox
+
+    async def poll_once(self):
+        with self._lock:
+            if not self._subscribers:
+                self._since = None
+                return 0
+        if self._since is None:
+            self._since = utcnow() - timedelta(seconds=max(self.poll_seconds, 1) * 2)
+        delivered = 0
+        jobs = await self.db.ocr_jobs.find({"updated_at": {"$gte": self._since}},
+                                           JOB_VIEW).to_list(None)
+        for job in jobs:
+            if job["updated_at"] > self._since:
+                self._since = job["updated_at"]
+            for inbox in list(self._subscribers.get(job["receipt_id"], ())):
+                inbox.put_nowait(job)
+                delivered += 1
+        return delivered
+
+    async def _run(self):
+        while True:
+            try:
+                await self.poll_once()
+            except pymongo.errors.PyMongoError:
+                pass
+            await asyncio.sleep(self.poll_seconds)
+
+    async def wait(self, receipt_id, after, timeout):
+        inbox = self.subscribe(receipt_id)
+        try:
+            job = await find_job(self.db, receipt_id)
+            deadline = time.monotonic() + timeout
+            while waiting_for(job, after):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    job = await asyncio.wait_for(inbox.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            return job
+        finally:
+            self.unsubscribe(receipt_id, inbox)
+
+    async def stream(self, receipt_id, last_event_id=None, timeout=300, keepalive=15):
+        inbox = self.subscribe(receipt_id)
+        try:
+            job = await find_job(self.db, receipt_id)
+            if job is None:
+                yield end_event("missing")
+                return
+            sent = last_event_id + 1 if last_event_id is not None else 0
+            deadline = time.monotonic() + timeout
+            yield "retry: 2000\n\n"
+            while True:
+                stages = job_stages(job)
+                for index in range(sent, len(stages)):
+                    yield stage_event(index, stages[index], job)
+                sent = max(sent, len(stages))
+                if job["status"] in FINAL_STATUSES:
+                    yield end_event(job["status"])
+                    return
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    job = await asyncio.wait_for(inbox.get(), min(keepalive, remaining))
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+        finally:
+            self.unsubscribe(receipt_id, inbox)
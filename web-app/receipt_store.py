@@ -0,0 +1,126 @@
+"""
+Access to the receipts collection for the split workflow pages.
+
+Every read names the view it needs, so a page only pulls the fields it
+renders and never the stored image or other pages' state.
+"""
+import re
+
+import pymongo
+from bson import ObjectId
+
+import schema
+
+# Named projections, one per page of the split workflow
+VIEWS = {
+    # select_appetizers: the line items to tick
+    "items": {"items": 1},
+    # numofpeople: what the scan found, shown while names are typed in
+    "items_preview": {"receipt_name": 1, "currency": 1, "total": 1,
+                      "items.description": 1, "items.amount": 1, "items.quantity": 1},
+    # allocateitems: who is at the table and what they can pick
+    "names_and_items": {"names": 1, "items": 1},
+    # calculate_bill: everything the split itself depends on, and the split
+    # stored last time (split_ledger) in case only the tip has changed
+    "split_inputs": {"names": 1, "items": 1, "allocations": 1, "item_counts": 1,
+                     "subtotal": 1, "tax": 1, "shares": 1, "appetizer_cents": 1,
+                     "tip_percentage": 1, "ledger_version": 1},
+    # wizard sessions: everything the wizard steps read or change
+    "wizard": {"num_of_people": 1, "names": 1, "items": 1, "allocations": 1,
+               "item_counts": 1, "subtotal": 1, "tax": 1},
+    # wizard sessions: the scanned items, once OCR has saved them
+    "split_totals": {"items": 1, "subtotal": 1, "tax": 1},
+    # history: one table row per receipt, and its version for the row cache
+    "history_row": {"receipt_name": 1, "names": 1, "total": 1, "currency": 1,
+                    "items.description": 1, "updated_at": 1, "ledger_version": 1},
+    # shared results page: the payments and their version for the page cache
+    "results": {"payments": 1, "updated_at": 1, "ledger_version": 1},
+}
+
+# /history returns at most this many receipts per page
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE_SIZE = 100
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def get_receipt(db, receipt_id, view):
+    """Fetch one receipt with only the fields of the named view, or None."""
+    return db.receipts.find_one({"_id": ObjectId(receipt_id)}, VIEWS[view])
+
+
+def items_preview(receipt):
+    """The /receipt_items JSON body: what the scan found on a receipt."""
+    return {
+        "receipt_name": receipt.get("receipt_name"),
+        "currency": receipt.get("currency"),
+        "total": receipt.get("total"),
+        "items": [{"description": item.get("description"), "amount": item.get("amount"),
+                   "quantity": item.get("quantity")} for item in receipt.get("items", [])],
+    }
+
+
+def search_tokens(*texts):
+    """
+    Lowercase word tokens for the history search index. The ML client keeps
+    its own copy of this tokenizer and the two must stay in step.
+    """
+    tokens = set()
+    for text in texts:
+        if text:
+            tokens.update(_TOKEN_RE.findall(str(text).lower()))
+    return sorted(tokens)
+
+
+def search_history(db, keywords, before=None, limit=HISTORY_PAGE_SIZE):
+    """
+    One page of receipts, newest first, whose merchant, item descriptions or
+    participant names contain a word starting with every keyword. Pass the
+    returned cursor as before to get the next page; it is None on the last page.
+    """
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+    # anchored, case-sensitive prefixes over the lowercased tokens can use the index
+    query = {"$and": [{"search_tokens": {"$regex": "^" + re.escape(token)}}
+                      for token in search_tokens(keywords)]}
+    if not query["$and"]:
+        query = {}
+    if before is not None:
+        query = {"$and": [query, {"_id": {"$lt": ObjectId(before)}}]}
+    rows = list(db.receipts.find(query, VIEWS["history_row"])
+                .sort("_id", pymongo.DESCENDING)
+                .limit(limit + 1))
+    next_cursor = str(rows[limit - 1]["_id"]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def backfill_search_tokens(db):
+    """Index receipts saved before search_tokens existed. Returns how many were updated."""
+    updated = 0
+    for receipt in db.receipts.find({"search_tokens": {"$exists": False}},
+                                    {"receipt_name": 1, "names": 1, "items.description": 1}):
+        tokens = search_tokens(receipt.get("receipt_name"), *receipt.get("names", []),
+                               *(item.get("description") for item in receipt.get("items", [])))
+        db.receipts.update_one({"_id": receipt["_id"]}, {"$set": {"search_tokens": tokens}})
+        updated += 1
+    return updated
+
+
+def find_receipts(db, query, view):
+    """Cursor over the receipts matching query, projected to the named view."""
+    return db.receipts.find(query, VIEWS[view])
+
+
+def set_appetizers(db, receipt_id, appetizer_ids):
+    """
+    Mark exactly the given items as appetizers and every other item as not,
+    with one atomic update. Array filters touch every matching element,
+    unlike the positional $ operator which only updates the first one.
+    """
+    return db.receipts.update_one(
+        {"_id": ObjectId(receipt_id)},
+        {"$set": {"items.$[chosen].is_appetizer": True,
+                  "items.$[other].is_appetizer": False},
+         **schema.split_changed(), **schema.touch()},
+        array_filters=[{"chosen._id": {"$in": appetizer_ids}},
+                       {"other._id": {"$nin": appetizer_ids}}],
+    )
@@ -0,0 +1,82 @@
+"""
+The indexes the web app relies on, declared in one place.
+
+bootstrap(db) creates any that are missing. It runs before the first request
+is served and as `flask init-db`, and it is idempotent. Both services
+create the indexes for their own queue and cache queries (see the ML
+client's start_workers); the ones here serve the web app's reads.
+
+Receipts carry created_at and updated_at; the ML client archives the images
+of receipts that were finished and left untouched for a while. Receipts
+that never reach calculate_bill are drafts: upload stamps them with
+draft_expires_at and the TTL index deletes them once it passes, unless the
+split is calculated first and the stamp is cleared (see finalize_update).
+Batch uploads aren't drafts: they are often split long after they are read,
+so they are kept until deleted.
+"""
+import os
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+# how long an unfinished receipt is kept before the TTL monitor removes it
+DRAFT_TTL_SECONDS = int(os.getenv("DRAFT_TTL_SECONDS", 7 * 24 * 3600))
+
+INDEXES = {
+    "receipts": [
+        # history search: every keyword is an anchored prefix match on the tokens
+        IndexModel([("search_tokens", ASCENDING)], name="search_tokens_1"),
+        # item lookups and the appetizer/allocation updates that match on item ids
+        IndexModel([("items._id", ASCENDING)], name="items_id"),
+        # merchant lookups and sorting
+        IndexModel([("receipt_name", ASCENDING)], name="receipt_name"),
+        # newest-first listings and date ranges
+        IndexModel([("created_at", DESCENDING)], name="created_at"),
+        # receipts a participant took part in
+        IndexModel([("names", ASCENDING)], name="names"),
+        # /api/upload_batch/<batch_id>: the receipts uploaded together
+        IndexModel([("batch_id", ASCENDING)], name="batch_id", sparse=True),
+        # abandoned drafts; expireAfterSeconds=0 expires each at its own timestamp
+        IndexModel([("draft_expires_at", ASCENDING)], name="draft_ttl", expireAfterSeconds=0),
+    ],
+    "ocr_jobs": [
+        # /job_status and /progress: the latest job for a receipt
+        IndexModel([("receipt_id", ASCENDING), ("created_at", DESCENDING)],
+                   name="receipt_latest_job"),
+    ],
+}
+
+
+def bootstrap(db):
+    """Create every declared index that doesn't exist yet; returns their names."""
+    created = []
+    for collection, indexes in INDEXES.items():
+        created.extend(db[collection].create_indexes(indexes))
+    return created
+
+
+def stored_fields(now=None):
+    """Lifecycle fields for a receipt kept until it is deleted, e.g. one from a batch upload."""
+    now = now or datetime.now(timezone.utc)
+    return {"created_at": now, "updated_at": now}
+
+
+def draft_fields(now=None):
+    """Lifecycle fields for a newly uploaded receipt."""
+    now = now or datetime.now(timezone.utc)
+    return {**stored_fields(now), "draft_expires_at": now + timedelta(seconds=DRAFT_TTL_SECONDS)}
+
+
+def touch():
+    """Update fragment stamping a receipt's updated_at; every receipt write includes it."""
+    return {"$currentDate": {"updated_at": True}}
+
+
+def split_changed():
+    """Update fragment dropping the stored split shares (see split_ledger) once its inputs change."""
+    return {"$unset": {"shares": ""}}
+
+
+def finalize_update():
+    """Update fragment keeping a receipt for good once its split is calculated."""
+    return {"$unset": {"draft_expires_at": ""}, **touch()}
@@ -0,0 +1,161 @@
+"""
+Bill splitting for a receipt.
+
+Item amounts are converted to integer cents once and every share is kept
+exact (as a whole number of 1/denominator cents) until the very end, where
+it is rounded once so the shares always add up to the rounded receipt
+total. Left-over cents go to the people with the largest rounding
+remainders, ties broken by the order of the names, so the same inputs
+always give the same split.
+
+split_ledger keeps each person's pre-tax share on the receipt, in
+1/SHARE_UNITS cents, so edits after the first split can adjust a few shares
+instead of splitting again; payments_from_shares turns those into the same
+payments split_bill would.
+"""
+from decimal import Decimal, InvalidOperation
+from fractions import Fraction
+from functools import reduce
+from math import gcd
+
+from receipt_model import InvalidReceipt, LineItem
+
+
+# pre-tax shares are stored in 1/SHARE_UNITS cents; divisible by every count up to
+# 24, so an item shared by up to 24 people splits exactly
+SHARE_UNITS = reduce(lambda a, b: a * b // gcd(a, b), range(1, 25))
+
+
+class SplitError(ValueError):
+    """The receipt or the split inputs cannot produce a bill."""
+
+
+def to_fraction(amount):
+    """Exact value of a stored amount; floats go through str() to drop binary noise."""
+    if amount is None:  # OCR leaves missing fields such as tax empty
+        return Fraction(0)
+    if isinstance(amount, Fraction):
+        return amount
+    try:
+        return Fraction(Decimal(str(amount)))
+    except (InvalidOperation, ValueError, OverflowError) as e:
+        raise SplitError(f"Invalid amount: {amount!r}") from e
+
+
+def line_items(items):
+    """Stored item documents as LineItems, amounts in cents."""
+    try:
+        return [LineItem.from_bson(item) for item in items]
+    except InvalidReceipt as e:
+        raise SplitError(str(e)) from e
+
+
+def split_bill(names, items, allocations, item_counts, subtotal, tax, tip_percentage):
+    """
+    Work out what each person owes, in integer cents.
+
+    Appetizers are shared evenly by everyone. Each allocated item is split
+    between the people it is allocated to, and tax and tip are added in
+    proportion to each person's share of the subtotal.
+    """
+    subtotal = to_fraction(subtotal)
+    if not items or subtotal <= 0:
+        raise SplitError("Invalid receipt data")
+    if not names:
+        raise SplitError("Number of people cannot be zero")
+
+    # one pass to index the items and collect what each allocation divides by
+    items = line_items(items)
+    items_by_id = {item.id: item for item in items if item.id is not None}
+    splits = []
+    for item_id, users in allocations.items():
+        item = items_by_id.get(item_id)
+        if item is None or not users:
+            continue
+        splits.append((item.amount_cents, item_counts.get(item_id) or len(users), users))
+    appetizer_cents = sum(item.amount_cents for item in items if item.is_appetizer)
+
+    # shares are counted in 1/denominator cents so every division is exact
+    denominator = reduce(lambda a, b: a * b // gcd(a, b),
+                         (divisor for _, divisor, _ in splits), len(names))
+    units = dict.fromkeys(names, appetizer_cents * (denominator // len(names)))
+    for cents, divisor, users in splits:
+        per_user = cents * (denominator // divisor)
+        for user in users:
+            if user not in units:
+                raise SplitError(f"Unknown person: {user}")
+            units[user] += per_user
+
+    return apportion_with_tax({name: Fraction(value, denominator) for name, value in units.items()},
+                              subtotal, tax, tip_percentage)
+
+
+def apportion_with_tax(pre_tax, subtotal, tax, tip_percentage):
+    """
+    Whole-cent payments from exact pre-tax shares: tax and tip are added in
+    proportion to each share of the subtotal.
+    """
+    subtotal = to_fraction(subtotal)
+    total_with_tax = subtotal + to_fraction(tax)
+    total_with_tip = total_with_tax * (1 + to_fraction(tip_percentage) / 100)
+    scale = total_with_tip / subtotal
+    return apportion_cents({name: value * scale for name, value in pre_tax.items()})
+
+
+def payments_from_shares(names, shares, appetizer_cents, subtotal, tax, tip_percentage):
+    """
+    What each person owes, in integer cents, from stored shares: shares[i] is
+    names[i]'s allocated items in 1/SHARE_UNITS cents, and the appetizers
+    are shared evenly. Gives the same result as split_bill on the same inputs.
+    """
+    if to_fraction(subtotal) <= 0:
+        raise SplitError("Invalid receipt data")
+    if not names:
+        raise SplitError("Number of people cannot be zero")
+    appetizer = Fraction(appetizer_cents, len(names))
+    return apportion_with_tax({name: Fraction(share, SHARE_UNITS) + appetizer
+                               for name, share in zip(names, shares)},
+                              subtotal, tax, tip_percentage)
+
+
+def split_receipt(receipt, tip_percentage):
+    """
+    Split a stored receipt document (the split_inputs view).
+    Returns the payments in dollars and their total.
+    """
+    cents = split_bill(
+        names=receipt.get('names', []),
+        items=receipt.get('items', []),
+        allocations=receipt.get('allocations', {}),
+        item_counts=receipt.get('item_counts', {}),
+        subtotal=receipt.get('subtotal', 0),
+        tax=receipt.get('tax', 0),
+        tip_percentage=tip_percentage)
+    payments = {name: cents_to_dollars(amount) for name, amount in cents.items()}
+    return payments, cents_to_dollars(sum(cents.values()))
+
+
+def apportion_cents(amounts):
+    """
+    Round exact amounts of cents to whole cents so they sum to the rounded total.
+
+    Largest remainder method: everyone gets the floor of their amount and
+    the cents still missing go one each to the largest fractional parts.
+    """
+    cents = {name: value.numerator // value.denominator for name, value in amounts.items()}
+    target = _round_half_up(sum(amounts.values()))
+    shortfall = target - sum(cents.values())
+    order = sorted(amounts, key=lambda name: amounts[name] - cents[name], reverse=True)
+    for name in order[:shortfall]:
+        cents[name] += 1
+    return cents
+
+
+def _round_half_up(value):
+    """Nearest integer to a Fraction, with halves rounded up."""
+    floor = value.numerator // value.denominator
+    return floor + (1 if (value - floor) * 2 >= 1 else 0)
+
+
+def cents_to_dollars(cents):
+    return cents / 100
@@ -0,0 +1,286 @@
+"""
+The split kept as derived state on the receipt, so edits after the first
+calculate_bill adjust it instead of splitting again.
+
+calculate_bill stores each person's pre-tax share next to the payments:
+
+    shares           shares[i] is names[i]'s allocated items, in
+                     1/SHARE_UNITS cents
+    appetizer_cents  the appetizers, shared evenly at payment time
+    tip_percentage   the tip the payments were worked out with
+    ledger_version   bumped by every write to the shares
+
+Each edit (move an item, change the tip, add or remove a person) reads the
+ledger without the line items, works out the few shares it changes and
+writes them back with one $inc, guarded by ledger_version so concurrent
+edits never lose an update. The payments are worked out again from the
+shares (split_engine.payments_from_shares), which touches every person but
+not the items.
+
+Writes that change the split inputs some other way (new names, appetizers,
+a checkpointed wizard draft) drop the shares with schema.split_changed(),
+and the next calculate_bill splits from scratch and stores them again.
+"""
+import re
+
+from bson import ObjectId
+
+import receipt_store
+import schema
+import split_engine
+from split_engine import SHARE_UNITS, SplitError
+
+LEDGER_VIEW = {"names": 1, "shares": 1, "appetizer_cents": 1, "subtotal": 1, "tax": 1,
+               "tip_percentage": 1, "ledger_version": 1}
+# attempts at an edit that keeps losing the race to other edits
+MAX_ATTEMPTS = 5
+
+_ITEM_ID_RE = re.compile(r"[\w-]+")
+
+
+class NoLedger(Exception):
+    """The receipt has no stored shares yet; calculate the bill first."""
+
+
+class LedgerConflict(Exception):
+    """Other edits kept changing the shares; try again."""
+
+
+def item_units(cents, divisor, count):
+    """
+    What each of the first count people sharing an item split divisor ways
+    adds to their share, in 1/SHARE_UNITS cents. Exact for up to 24 ways;
+    past that the odd units go to the first people so the item still adds
+    up exactly.
+    """
+    if not count:
+        return []
+    per_user, remainder = divmod(cents * SHARE_UNITS, divisor)
+    return [per_user + (1 if i < remainder else 0) for i in range(count)]
+
+
+def item_cents(receipt):
+    """Each of a receipt's items' amount in cents, by item id."""
+    return {item.id: item.amount_cents for item in split_engine.line_items(receipt.get('items', []))
+            if item.id is not None}
+
+
+def build(receipt):
+    """Ledger fields for a receipt in the split_inputs view."""
+    names = receipt.get('names', [])
+    index = {name: i for i, name in enumerate(names)}
+    shares = [0] * len(names)
+    items = split_engine.line_items(receipt.get('items', []))
+    items_by_id = {item.id: item for item in items if item.id is not None}
+    for item_id, users in receipt.get('allocations', {}).items():
+        item = items_by_id.get(item_id)
+        if item is None or not users:
+            continue
+        divisor = receipt.get('item_counts', {}).get(item_id) or len(users)
+        for user, units in zip(users, item_units(item.amount_cents, divisor, len(users))):
+            if user not in index:
+                raise SplitError(f"Unknown person: {user}")
+            shares[index[user]] += units
+    appetizer_cents = sum(item.amount_cents for item in items if item.is_appetizer)
+    return {"shares": shares, "appetizer_cents": appetizer_cents}
+
+
+def ledger_update(receipt, tip_percentage):
+    """Update fragment storing the ledger for a receipt that was just split from scratch."""
+    return {"$set": dict(build(receipt), tip_percentage=float(tip_percentage)),
+            "$inc": {"ledger_version": 1}}
+
+
+def payments(receipt):
+    """The payments in dollars and their total from a receipt's ledger fields."""
+    cents = split_engine.payments_from_shares(
+        receipt['names'], receipt['shares'], receipt.get('appetizer_cents', 0),
+        receipt.get('subtotal', 0), receipt.get('tax', 0), receipt.get('tip_percentage', 0))
+    return ({name: split_engine.cents_to_dollars(amount) for name, amount in cents.items()},
+            split_engine.cents_to_dollars(sum(cents.values())))
+
+
+def _edit(db, receipt_id, change, projection=None, extra=None, receipt=None):
+    """
+    Apply one edit to a receipt's ledger. change(receipt) returns the update
+    for the edit and the ledger fields it leaves behind; the payments are
+    added to that update and it is written only if ledger_version is still
+    what was read. receipt, if the caller has already read it, saves the
+    first read. Returns (payments, total), or None if there is no receipt.
+    """
+    for _ in range(MAX_ATTEMPTS):
+        if receipt is None:
+            receipt = db.receipts.find_one({"_id": ObjectId(receipt_id)},
+                                           dict(LEDGER_VIEW, **(projection or {})))
+        if receipt is None:
+            return None
+        if receipt.get('shares') is None:
+            raise NoLedger(receipt_id)
+        update, after = change(receipt)
+        paid, total = payments(dict(receipt, **after))
+        update.setdefault("$set", {})["payments"] = paid
+        update.setdefault("$inc", {})["ledger_version"] = 1
+        for operator, fields in dict(schema.touch(), **(extra or {})).items():
+            update.setdefault(operator, {}).update(fields)
+        result = db.receipts.update_one(
+            {"_id": receipt["_id"], "ledger_version": receipt.get('ledger_version')}, update)
+        if result.matched_count:
+            return paid, total
+        receipt = None
+    raise LedgerConflict(receipt_id)
+
+
+def _check_item_id(item_id):
+    if not isinstance(item_id, str) or not _ITEM_ID_RE.fullmatch(item_id):
+        raise SplitError(f"Invalid item id: {item_id!r}")
+
+
+def set_tip(db, receipt_id, tip_percentage, extra=None, receipt=None):
+    """Change the tip. No share changes; every payment is scaled again."""
+    split_engine.to_fraction(tip_percentage)  # reject garbage before writing it
+
+    def change(receipt):
+        tip = float(tip_percentage)
+        return {"$set": {"tip_percentage": tip}}, {"tip_percentage": tip}
+    return _edit(db, receipt_id, change, extra=extra, receipt=receipt)
+
+
+def move_item(db, receipt_id, item_id, people):
+    """Allocate an item to people (none to leave it unallocated), adjusting only their shares."""
+    _check_item_id(item_id)
+
+    def change(receipt):
+        items = receipt.get('items') or []
+        if not items:
+            raise SplitError(f"Unknown item: {item_id}")
+        index = {name: i for i, name in enumerate(receipt['names'])}
+        unknown = [person for person in people if person not in index]
+        if unknown:
+            raise SplitError(f"Unknown person: {unknown[0]}")
+        cents = split_engine.line_items(items[:1])[0].amount_cents
+        before = receipt.get('allocations', {}).get(item_id) or []
+        divisor = receipt.get('item_counts', {}).get(item_id) or len(before)
+        deltas = [0] * len(receipt['shares'])
+        for user, units in zip(before, item_units(cents, divisor, len(before))):
+            deltas[index[user]] -= units
+        for user, units in zip(people, item_units(cents, len(people), len(people))):
+            deltas[index[user]] += units
+
+        update = {"$inc": {f"shares.{i}": delta for i, delta in enumerate(deltas) if delta}}
+        if people:
+            update["$set"] = {f"allocations.{item_id}": list(people),
+                              f"item_counts.{item_id}": len(people)}
+        else:
+            update["$unset"] = {f"allocations.{item_id}": "", f"item_counts.{item_id}": ""}
+        shares = [share + delta for share, delta in zip(receipt['shares'], deltas)]
+        return update, {"shares": shares}
+    return _edit(db, receipt_id, change,
+                 projection={f"allocations.{item_id}": 1, f"item_counts.{item_id}": 1,
+                             "items": {"$elemMatch": {"_id": item_id}}})
+
+
+def add_person(db, receipt_id, name):
+    """Add someone with nothing allocated yet; they join in on the appetizers."""
+    def change(receipt):
+        if name in receipt['names']:
+            raise SplitError(f"{name} is already on this receipt")
+        names = receipt['names'] + [name]
+        return ({"$push": {"names": name, "shares": 0},
+                 "$set": {"num_of_people": str(len(names))},
+                 "$addToSet": {"search_tokens": {"$each": receipt_store.search_tokens(name)}}},
+                {"names": names, "shares": receipt['shares'] + [0]})
+    return _edit(db, receipt_id, change)
+
+
+def remove_person(db, receipt_id, name):
+    """
+    Take someone off the receipt. Items they shared are split between the
+    others on them; items only they had are left unallocated.
+    """
+    def change(receipt):
+        if name not in receipt['names']:
+            raise SplitError(f"Unknown person: {name}")
+        names = [other for other in receipt['names'] if other != name]
+        if not names:
+            raise SplitError("Number of people cannot be zero")
+        index = {other: i for i, other in enumerate(names)}
+        shares = [share for other, share in zip(receipt['names'], receipt['shares'])
+                  if other != name]
+        amounts = item_cents(receipt)
+        update = {"$set": {}, "$unset": {}}
+        for item_id, before in receipt.get('allocations', {}).items():
+            if name not in before or item_id not in amounts:
+                continue
+            cents = amounts[item_id]
+            divisor = receipt.get('item_counts', {}).get(item_id) or len(before)
+            after = [user for user in before if user != name]
+            for user, units in zip(before, item_units(cents, divisor, len(before))):
+                if user != name:
+                    shares[index[user]] -= units
+            for user, units in zip(after, item_units(cents, len(after), len(after))):
+                shares[index[user]] += units
+            if after:
+                update["$set"][f"allocations.{item_id}"] = after
+                update["$set"][f"item_counts.{item_id}"] = len(after)
+            else:
+                update["$unset"][f"allocations.{item_id}"] = ""
+                update["$unset"][f"item_counts.{item_id}"] = ""
+        update["$set"].update(names=names, shares=shares, num_of_people=str(len(names)))
+        if not update["$unset"]:
+            del update["$unset"]
+        return update, {"names": names, "shares": shares}
+    return _edit(db, receipt_id, change,
+                 projection={"allocations": 1, "item_counts": 1,
+                             "items._id": 1, "items.amount": 1})
+
+
+def reallocate(db, receipt_id, allocations):
+    """
+    Replace the allocations from the allocateitems form, adjusting only the
+    shares of items whose people changed, in one write. Returns None, with
+    nothing written, if the receipt has no ledger.
+    """
+    for item_id in allocations:
+        _check_item_id(item_id)
+
+    def change(receipt):
+        index = {name: i for i, name in enumerate(receipt['names'])}
+        amounts = item_cents(receipt)
+        current = receipt.get('allocations', {})
+        shares = list(receipt['shares'])
+        update = {"$set": {}, "$unset": {}}
+        for item_id in set(current) | set(allocations):
+            before, after = current.get(item_id) or [], allocations.get(item_id) or []
+            if before == after:
+                continue
+            if after:
+                update["$set"][f"allocations.{item_id}"] = after
+                update["$set"][f"item_counts.{item_id}"] = len(after)
+            else:
+                update["$unset"][f"allocations.{item_id}"] = ""
+                update["$unset"][f"item_counts.{item_id}"] = ""
+            if item_id not in amounts:
+                continue  # not one of this receipt's items; split_bill ignores it too
+            cents = amounts[item_id]
+            divisor = receipt.get('item_counts', {}).get(item_id) or len(before)
+            for user, units in zip(before, item_units(cents, divisor, len(before))):
+                shares[index[user]] -= units
+            for user, units in zip(after, item_units(cents, len(after), len(after))):
+                if user not in index:
+                    raise SplitError(f"Unknown person: {user}")
+                shares[index[user]] += units
+        deltas = {f"shares.{i}": new - old
+                  for i, (old, new) in enumerate(zip(receipt['shares'], shares)) if new != old}
+        if deltas:
+            update["$inc"] = deltas
+        for operator in ("$set", "$unset"):
+            if not update[operator]:
+                del update[operator]
+        return update, {"shares": shares}
+    try:
+        return _edit(db, receipt_id, change,
+                     projection={"allocations": 1, "item_counts": 1,
+                                 "items._id": 1, "items.amount": 1})
+    except NoLedger:
+        return None
+
@@ -7,16 +7,26 @@ from unittest.mock import patch
 import sys
 from pathlib import Path
 import mongomock
+import pymongo
+import mongomock.gridfs
+import gridfs
+import hashlib
+import json
+import uuid
 import requests_mock
 from bson import ObjectId
+from datetime import datetime, timezone
 
 # Adjust the Python path to include the directory above the 'test' directory where 'app.py' is located
 current_dir = Path(__file__).resolve().parent
 parent_dir = current_dir.parent  # 'web_app' directory
 sys.path.insert(0, str(parent_dir))
+os.environ.setdefault("MONGO_DBNAME", "test_db")
 
 from app import app  # Now you can successfully import app
-from app import call_ml_service  # Assuming call_ml_service is in app.py
+import progress
+
+mongomock.gridfs.enable_gridfs_integration()
 
 # Use a valid ObjectId for tests
 test_id = str(ObjectId())
@@ -32,16 +42,32 @@ def client():
     os.close(db_fd)
     os.unlink(db_path)
 
-@pytest.fixture
+@pytest.fixture(autouse=True)
 def mock_db(monkeypatch):
     mock_client = mongomock.MongoClient()
     monkeypatch.setattr('pymongo.MongoClient', lambda *args, **kwargs: mock_client)
     db = mock_client['test_db']  # simulate the database
+    monkeypatch.setattr('app.db', db)  # the app connects at import time
+    monkeypatch.setattr('app.progress_hub', progress.ProgressHub(db, poll_seconds=0.01))
     # Now simulate collections within this database
     db.create_collection("receipts")
     db.create_collection("images")
     return db
 
+@pytest.fixture
+def real_db(monkeypatch):
+    """A scratch database on a real MongoDB, for behaviour mongomock does not implement."""
+    uri = os.getenv("MONGO_TEST_URI")
+    if not uri:
+        pytest.skip("MONGO_TEST_URI is not set")
+    real_client = pymongo.MongoClient(uri, serverSelectionTimeoutMS=2000)
+    db_name = f"test_{ObjectId()}"
+    db = real_client[db_name]
+    monkeypatch.setattr('app.db', db)
+    yield db
+    real_client.drop_database(db_name)
+    real_client.close()
+
 @pytest.fixture
 def mock_requests(monkeypatch):
     """
@@ -86,13 +112,27 @@ def test_numofpeople_route(client, prepare_data):
     assert response.status_code == 200
     assert 'Enter Number of People and Names' in response.data.decode()
 
-def test_post_appetizers_selection(client, mock_db, prepare_data):
+def test_post_appetizers_selection(client, mock_db, prepare_data, monkeypatch):
     """Test updating appetizers selection."""
+    # mongomock has no array filters; test_select_appetizers_flags_every_chosen_item
+    # runs the update itself against a real MongoDB
+    updates = []
+    original_update = mongomock.collection.Collection.update_one
+
+    def update_one(self, filter, update, *args, array_filters=None, **kwargs):
+        if array_filters is None:
+            return original_update(self, filter, update, *args, **kwargs)
+        updates.append((filter, array_filters))
+        return pymongo.results.UpdateResult({'n': 1, 'nModified': 1}, True)
+    monkeypatch.setattr(mongomock.collection.Collection, 'update_one', update_one)
+
     appetizer_id = str(ObjectId())  # Simulating an appetizer ID
     data = {'appetizers': [appetizer_id]}
     response = client.post(f'/select_appetizers/{prepare_data}', data=data)
     assert response.status_code == 302  # Expect redirection after successful post
     assert '/allocateitems/' in response.headers['Location']
+    assert updates == [({'_id': ObjectId(prepare_data)},
+                        [{'chosen._id': {'$in': []}}, {'other._id': {'$nin': []}}])]
 
 def test_finalize_allocation(client, mock_db, prepare_data):
     """Test finalizing the item allocation updates the database correctly."""
@@ -190,4 +230,694 @@ def test_allocate_items_no_selection(client, prepare_data):
     """Test posting allocate items with no selection leads to no change."""
     response = client.post(f'/allocateitems/{prepare_data}', data={})
     assert response.status_code == 302
-    assert '/enter_tip/' in response.headers['Location']
\ No newline at end of file
+    assert '/enter_tip/' in response.headers['Location']
+
+def test_upload_image_queues_ocr_job(client, mock_db):
+    """Test uploading an image stores it, queues an OCR job and redirects right away."""
+    data = {'image': (io.BytesIO(b'fake image bytes'), 'receipt.jpg')}
+    response = client.post('/upload', data=data, content_type='multipart/form-data')
+    assert response.status_code == 302
+    assert '/numofpeople/' in response.headers['Location']
+    receipt = mock_db.receipts.find_one()
+    job = mock_db.ocr_jobs.find_one({"receipt_id": receipt["_id"]})
+    assert job["status"] == "queued"
+    assert job["attempts"] == 0
+
+def test_upload_image_stored_in_gridfs(client, mock_db):
+    """Test the uploaded image goes to GridFS and only its id is kept on the receipt."""
+    image = b'\xff\xd8' + os.urandom(600 * 1024)  # spans several GridFS chunks
+    data = {'image': (io.BytesIO(image), 'receipt.jpg')}
+    response = client.post('/upload', data=data, content_type='multipart/form-data')
+    assert response.status_code == 302
+    receipt = mock_db.receipts.find_one()
+    assert 'image' not in receipt
+    assert receipt['image_sha256'] == hashlib.sha256(image).hexdigest()
+    stored = gridfs.GridFS(mock_db).get(receipt['image_id'])
+    assert stored.read() == image
+    assert stored.metadata == {'content_type': 'image/jpeg'}
+
+def test_job_status(client, mock_db, prepare_data):
+    """Test the job status endpoint reports the queued OCR job."""
+    from app import enqueue_ocr_job
+    enqueue_ocr_job(prepare_data)
+    response = client.get(f'/job_status/{prepare_data}')
+    assert response.status_code == 200
+    assert response.get_json()['status'] == 'queued'
+
+def test_job_status_lists_stages(client, mock_db, prepare_data):
+    """Test a freshly queued job has been stored and queued."""
+    from app import enqueue_ocr_job
+    enqueue_ocr_job(prepare_data)
+    job = client.get(f'/job_status/{prepare_data}').get_json()
+    assert job['stage'] == 'queued'
+    assert [s['stage'] for s in job['stages']] == ['stored', 'queued']
+
+def finish_job(db, receipt_id, *stages, status='done'):
+    """Move a receipt's OCR job through stages the way the ML client does."""
+    for stage in stages:
+        now = datetime.now(timezone.utc)
+        db.ocr_jobs.update_one({"receipt_id": ObjectId(receipt_id)},
+                               {"$set": {"stage": stage, "updated_at": now,
+                                         "status": status if stage in ('ready', 'failed') else 'running'},
+                                "$push": {"stages": {"stage": stage, "at": now}}})
+
+def sse_events(body):
+    """(event, data) pairs from a text/event-stream body."""
+    events = []
+    for block in body.split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.splitlines()
+                      if ': ' in line and not line.startswith(':'))
+        if 'event' in fields:
+            events.append((fields['event'], json.loads(fields['data'])))
+    return events
+
+def test_progress_stream_replays_stages(client, mock_db, prepare_data):
+    """Test the SSE stream sends every stage of a finished job, then ends."""
+    from app import enqueue_ocr_job
+    enqueue_ocr_job(prepare_data)
+    finish_job(mock_db, prepare_data, 'ocr_running', 'parsed', 'ready')
+    response = client.get(f'/progress/{prepare_data}')
+    assert response.mimetype == 'text/event-stream'
+    events = sse_events(response.get_data(as_text=True))
+    assert [data['stage'] for event, data in events if event == 'stage'] == \
+        ['stored', 'queued', 'ocr_running', 'parsed', 'ready']
+    assert events[-1] == ('end', {'status': 'done'})
+
+def test_progress_stream_resumes_after_last_event(client, mock_db, prepare_data):
+    """Test a reconnecting browser only gets the stages it missed."""
+    from app import enqueue_ocr_job
+    enqueue_ocr_job(prepare_data)
+    finish_job(mock_db, prepare_data, 'ocr_running', 'ready')
+    response = client.get(f'/progress/{prepare_data}', headers={'Last-Event-ID': '1'})
+    stages = [data['stage'] for event, data in sse_events(response.get_data(as_text=True))
+              if event == 'stage']
+    assert stages == ['ocr_running', 'ready']
+
+def test_progress_stream_follows_live_job(client, mock_db, prepare_data):
+    """Test stages reported while the stream is open reach it through the poller."""
+    from app import enqueue_ocr_job
+    enqueue_ocr_job(prepare_data)
+    response = client.get(f'/progress/{prepare_data}', buffered=False)
+    chunks = response.response
+    received = []
+    for chunk in chunks:
+        received.append(chunk.decode() if isinstance(chunk, bytes) else chunk)
+        if '"stage": "queued"' in received[-1]:
+            finish_job(mock_db, prepare_data, 'ocr_running', 'parsed', 'ready')
+    response.close()
+    stages = [data['stage'] for event, data in sse_events(''.join(received)) if event == 'stage']
+    assert stages == ['stored', 'queued', 'ocr_running', 'parsed', 'ready']
+
+def test_job_status_long_poll(client, mock_db, prepare_data):
+    """Test the long-poll returns straight away once the job is past the given stage."""
+    from app import enqueue_ocr_job
+    enqueue_ocr_job(prepare_data)
+    finish_job(mock_db, prepare_data, 'ocr_running')
+    job = client.get(f'/job_status/{prepare_data}?wait=5&after=1').get_json()
+    assert job['stage'] == 'ocr_running'
+
+def test_job_status_long_poll_waits_for_the_next_stage(client, mock_db, prepare_data):
+    """Test after=len(stages), what the page sends next, holds the request until wait runs out."""
+    import time
+    from app import enqueue_ocr_job
+    enqueue_ocr_job(prepare_data)
+    stages = client.get(f'/job_status/{prepare_data}').get_json()['stages']
+    started = time.monotonic()
+    job = client.get(f'/job_status/{prepare_data}?wait=0.5&after={len(stages)}').get_json()
+    assert time.monotonic() - started >= 0.5
+    assert job['stage'] == 'queued'
+
+def test_receipt_items(client, mock_db):
+    """Test numofpeople can fetch the scanned items without the image."""
+    receipt_id = mock_db.receipts.insert_one({
+        "image": b"x" * 1024, "receipt_name": "Cafe", "currency": "USD", "total": 12.5,
+        "items": [{"_id": str(uuid.uuid4()), "description": "Soup", "amount": 12.5, "quantity": 1}],
+    }).inserted_id
+    receipt = client.get(f'/receipt_items/{receipt_id}').get_json()
+    assert receipt == {"receipt_name": "Cafe", "currency": "USD", "total": 12.5,
+                       "items": [{"description": "Soup", "amount": 12.5, "quantity": 1}]}
+    assert client.get(f'/receipt_items/{test_id}').status_code == 404
+
+def test_job_status_not_found(client):
+    """Test the job status endpoint for a receipt without a job."""
+    response = client.get(f'/job_status/{test_id}')
+    assert response.status_code == 404
+
+def test_routes_never_read_image(client, mock_db, monkeypatch):
+    """Test every receipts read made by the workflow routes is projected without the image."""
+    receipt_id = mock_db.receipts.insert_one({
+        "image": b"x" * 1024,
+        "names": ["Alice", "Bob"],
+        "items": [{"_id": str(uuid.uuid4()), "description": "Salad", "amount": 10.0}],
+        "subtotal": 10.0,
+        "tax": 1.0,
+    }).inserted_id
+    projections = []
+    original_find = mongomock.collection.Collection.find
+
+    def recording_find(self, filter=None, projection=None, *args, **kwargs):
+        if self.name == 'receipts':
+            projections.append(projection)
+        return original_find(self, filter, projection, *args, **kwargs)
+
+    monkeypatch.setattr(mongomock.collection.Collection, 'find', recording_find)
+    assert client.get(f'/select_appetizers/{receipt_id}').status_code == 200
+    assert client.get(f'/allocateitems/{receipt_id}').status_code == 200
+    response = client.post(f'/calculate_bill/{receipt_id}', data={'tip_percentage': '15'})
+    assert response.status_code == 200
+    assert client.get('/history?search=Salad').status_code == 200
+    assert len(projections) == 4
+    for projection in projections:
+        assert projection and 'image' not in projection
+        assert all(value for value in projection.values())  # inclusion-only views
+
+def many_items_receipt(db, count=250):
+    items = [{"_id": str(uuid.uuid4()), "description": f"Dish {i}", "amount": 1.0 + i,
+              "is_appetizer": i % 2 == 0} for i in range(count)]
+    receipt_id = db.receipts.insert_one({"names": ["Alice"], "items": items}).inserted_id
+    return receipt_id, [item["_id"] for item in items]
+
+def test_select_appetizers_is_one_round_trip(client, mock_db, monkeypatch):
+    """Test selecting appetizers on a large receipt issues a single update."""
+    receipt_id, item_ids = many_items_receipt(mock_db)
+    chosen = item_ids[::3]
+    calls = []
+    for method in ('find', 'update_one', 'update_many', 'bulk_write'):
+        monkeypatch.setattr(mongomock.collection.Collection, method,
+                            lambda self, *args, _method=method, **kwargs:
+                            calls.append((_method, args, kwargs)))
+    response = client.post(f'/select_appetizers/{receipt_id}', data={'appetizers': chosen})
+    assert response.status_code == 302
+    assert len(calls) == 1
+    method, args, kwargs = calls[0]
+    assert method == 'update_one'
+    assert args[0] == {'_id': receipt_id}
+    assert kwargs['array_filters'] == [{'chosen._id': {'$in': chosen}},
+                                       {'other._id': {'$nin': chosen}}]
+
+def test_select_appetizers_flags_every_chosen_item(client, real_db):
+    """Test every chosen item is flagged and every other item cleared, not just the first."""
+    receipt_id, item_ids = many_items_receipt(real_db)
+    chosen = set(item_ids[::3])
+    response = client.post(f'/select_appetizers/{receipt_id}', data={'appetizers': list(chosen)})
+    assert response.status_code == 302
+    items = real_db.receipts.find_one({'_id': receipt_id})['items']
+    assert all(item['is_appetizer'] == (item['_id'] in chosen) for item in items)
+
+    response = client.post(f'/select_appetizers/{receipt_id}', data={'no_appetizers': 'none'})
+    items = real_db.receipts.find_one({'_id': receipt_id})['items']
+    assert not any(item['is_appetizer'] for item in items)
+
+def test_calculate_bill_stores_payments(client, mock_db):
+    """Test the bill is split to the cent and saved on the receipt."""
+    items = [{"_id": str(uuid.uuid4()), "description": "Pasta", "amount": 10.00},
+             {"_id": str(uuid.uuid4()), "description": "Wine", "amount": 20.00}]
+    receipt_id = mock_db.receipts.insert_one({
+        "names": ["Alice", "Bob", "Carol"],
+        "items": items,
+        "allocations": {items[0]["_id"]: ["Alice"], items[1]["_id"]: ["Alice", "Bob", "Carol"]},
+        "item_counts": {items[0]["_id"]: 1, items[1]["_id"]: 3},
+        "subtotal": 30.00,
+        "tax": 0.00,
+    }).inserted_id
+    response = client.post(f'/calculate_bill/{receipt_id}', data={'tip_percentage': '10'})
+    assert response.status_code == 200
+    payments = mock_db.receipts.find_one({"_id": receipt_id})['payments']
+    assert payments == {"Alice": 18.34, "Bob": 7.33, "Carol": 7.33}
+
+def test_uploaded_receipt_is_a_draft_until_split(client, mock_db):
+    """Test an upload expires unless its bill is calculated."""
+    data = {'image': (io.BytesIO(b'fake image data'), 'test.jpg')}
+    client.post('/upload', data=data, content_type='multipart/form-data')
+    receipt = mock_db.receipts.find_one()
+    assert receipt['draft_expires_at'] > receipt['created_at']
+    items = [{"_id": str(uuid.uuid4()), "description": "Pasta", "amount": 10.00}]
+    mock_db.receipts.update_one({"_id": receipt["_id"]}, {"$set": {
+        "names": ["Alice"], "items": items, "allocations": {items[0]["_id"]: ["Alice"]},
+        "item_counts": {items[0]["_id"]: 1}, "subtotal": 10.00, "tax": 0.00}})
+    client.post(f'/calculate_bill/{receipt["_id"]}', data={'tip_percentage': '10'})
+    assert 'draft_expires_at' not in mock_db.receipts.find_one({"_id": receipt["_id"]})
+
+def test_schema_bootstrap(mock_db):
+    """Test every declared index is created, including the draft TTL."""
+    import schema
+    schema.bootstrap(mock_db)
+    schema.bootstrap(mock_db)  # idempotent
+    indexes = mock_db.receipts.index_information()
+    assert {"search_tokens_1", "items_id", "receipt_name", "created_at", "names", "batch_id",
+            "draft_ttl"} <= set(indexes)
+    assert indexes["draft_ttl"]["expireAfterSeconds"] == 0
+    assert "receipt_latest_job" in mock_db.ocr_jobs.index_information()
+
+def plan_stages(plan):
+    """Every stage name in an explain() plan tree."""
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(plan_stages(value))
+    return stages
+
+def test_hot_queries_use_indexes(real_db):
+    """Test the app's hot queries are answered by index scans, not collection scans."""
+    import schema
+    schema.bootstrap(real_db)
+    for i in range(200):
+        receipt_id = real_db.receipts.insert_one({
+            "receipt_name": f"Cafe {i % 20}", "names": [f"Person {i % 30}", "Alice"],
+            "items": [{"_id": str(uuid.uuid4()), "description": "Soup", "amount": 5.0}],
+            "search_tokens": ["cafe", str(i % 20), "soup"],
+            **schema.draft_fields()}).inserted_id
+        real_db.ocr_jobs.insert_one({"receipt_id": receipt_id, "status": "done",
+                                     "created_at": datetime.now(timezone.utc)})
+    item_id = real_db.receipts.find_one()["items"][0]["_id"]
+    queries = {
+        "history search": real_db.receipts.find(
+            {"$and": [{"search_tokens": {"$regex": "^caf"}}]}).sort("_id", -1).limit(21),
+        "item id": real_db.receipts.find({"items._id": item_id}),
+        "merchant": real_db.receipts.find({"receipt_name": "Cafe 3"}),
+        "participant": real_db.receipts.find({"names": "Person 7"}),
+        "newest first": real_db.receipts.find().sort("created_at", -1).limit(20),
+        "latest job": real_db.ocr_jobs.find({"receipt_id": receipt_id})
+            .sort("created_at", -1).limit(1),
+    }
+    for name, cursor in queries.items():
+        stages = plan_stages(cursor.explain()["queryPlanner"]["winningPlan"])
+        assert "IXSCAN" in stages, f"{name}: {stages}"
+        assert "COLLSCAN" not in stages, f"{name}: {stages}"
+
+def split_ready_receipt(db, names=("Alice", "Bob"), amounts=(12.00, 8.00)):
+    items = [{"_id": str(uuid.uuid4()), "description": f"Dish {i}", "amount": amount}
+             for i, amount in enumerate(amounts)]
+    allocations = {item["_id"]: [names[i % len(names)]] for i, item in enumerate(items)}
+    return db.receipts.insert_one({
+        "names": list(names),
+        "items": items,
+        "allocations": allocations,
+        "item_counts": {item_id: 1 for item_id in allocations},
+        "subtotal": sum(amounts),
+        "tax": 0.0,
+    }).inserted_id
+
+def test_batch_calculate_bills(client, mock_db):
+    """Test the batch endpoint splits many receipts and reports per-receipt status."""
+    receipt_ids = [split_ready_receipt(mock_db) for _ in range(20)]
+    entries = [{"receipt_id": str(receipt_id), "tip_percentage": 10} for receipt_id in receipt_ids]
+    entries += [{"receipt_id": test_id, "tip_percentage": 10},
+                {"receipt_id": "not-an-id", "tip_percentage": 10}]
+    response = client.post('/api/calculate_bills', json={"receipts": entries})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["stats"]["split"] == 20
+    assert body["stats"]["failed"] == 2
+    assert body["results"][test_id] == {"error": "Receipt not found"}
+    assert body["results"]["not-an-id"] == {"error": "Invalid receipt id"}
+    assert body["results"][str(receipt_ids[0])]["payments"] == {"Alice": 13.2, "Bob": 8.8}
+    for receipt_id in receipt_ids:
+        assert mock_db.receipts.find_one({"_id": receipt_id})["payments"] == {"Alice": 13.2, "Bob": 8.8}
+
+def test_batch_calculate_bills_rejects_bad_body(client):
+    """Test the batch endpoint validates its JSON body."""
+    assert client.post('/api/calculate_bills', json={}).status_code == 400
+    assert client.post('/api/calculate_bills', json={"receipts": [{}]}).status_code == 400
+
+def test_history_search_matches_tokens(client, mock_db):
+    """Test history search matches merchant, item and participant words by prefix."""
+    from app import receipt_store
+    mock_db.receipts.insert_one({
+        "receipt_name": "Harbor Lane Cafe", "names": ["Alice", "Bob"], "total": 31.39,
+        "items": [{"description": "Tacos Del Mal Shrimp"}],
+        "search_tokens": receipt_store.search_tokens("Harbor Lane Cafe", "Alice", "Bob",
+                                                     "Tacos Del Mal Shrimp")})
+    mock_db.receipts.insert_one({
+        "receipt_name": "Joe's Pizza", "names": ["Carol"], "items": [],
+        "search_tokens": receipt_store.search_tokens("Joe's Pizza", "Carol")})
+    for keyword in ('harbor', 'SHRI', 'alice cafe'):
+        page = client.get(f'/history?search={keyword}').data.decode()
+        assert 'Harbor Lane Cafe' in page
+        assert 'Pizza' not in page
+    assert 'No results found.' in client.get('/history?search=alice pizza').data.decode()
+
+def test_history_paginates(client, mock_db):
+    """Test history pages through receipts newest first with a capped page size."""
+    for i in range(7):
+        mock_db.receipts.insert_one({"_id": ObjectId(), "receipt_name": f"Place{i}",
+                                     "search_tokens": ["cafe", f"place{i}"]})
+    from app import receipt_store
+    rows, cursor = receipt_store.search_history(mock_db, 'cafe', limit=3)
+    assert [row['receipt_name'] for row in rows] == ['Place6', 'Place5', 'Place4']
+    rows, cursor = receipt_store.search_history(mock_db, 'cafe', before=cursor, limit=3)
+    assert [row['receipt_name'] for row in rows] == ['Place3', 'Place2', 'Place1']
+    rows, cursor = receipt_store.search_history(mock_db, 'cafe', before=cursor, limit=3)
+    assert [row['receipt_name'] for row in rows] == ['Place0']
+    assert cursor is None
+    rows, _ = receipt_store.search_history(mock_db, '', limit=10 ** 6)
+    assert len(rows) == 7
+    response = client.get('/history?search=cafe&limit=2')
+    assert 'Next page' in response.data.decode()
+    assert client.get('/history?before=nope').status_code == 400
+
+def test_ml_service_status(client):
+    """Test the ML client pool and circuit breaker state is exposed."""
+    response = client.get('/ml_service_status')
+    assert response.status_code == 200
+    assert response.get_json()['circuit']['state'] in ('closed', 'open', 'half_open')
+
+def test_ml_service_uses_pooled_client(mock_requests):
+    """Test calls to the ML service go through the app's shared ML client."""
+    import app as web_app
+    mock_requests.post('http://machine-learning-client:5002/predict', json={'_id': test_id})
+    response = web_app.ml_service.post_json('/predict', {'Object_ID': test_id})
+    assert response.json() == {'_id': test_id}
+    assert mock_requests.last_request.json() == {'Object_ID': test_id}
+
+def test_metrics_endpoint(client):
+    """Test requests are counted per route template and exposed in Prometheus format."""
+    client.get('/')
+    client.get(f'/job_status/{test_id}')
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    body = response.get_data(as_text=True)
+    assert 'http_requests_total{method="GET",route="/",status="200"}' in body
+    assert 'route="/job_status/<receipt_id>",status="404"' in body
+    assert 'http_request_duration_seconds_bucket{le="0.005",method="GET",route="/"}' in body
+
+def test_mongo_command_metrics():
+    """Test the command listener times commands by name and collection."""
+    from types import SimpleNamespace
+    import metrics
+    listener = metrics.MongoCommandMetrics()
+    sample = lambda: metrics.REGISTRY.get_sample_value(
+        'mongo_command_duration_seconds_count', {'command': 'find', 'collection': 'receipts'}) or 0
+    before = sample()
+    listener.started(SimpleNamespace(command_name='find', command={'find': 'receipts'},
+                                     connection_id=('db', 27017), request_id=1))
+    listener.succeeded(SimpleNamespace(command_name='find', connection_id=('db', 27017),
+                                       request_id=1, duration_micros=1500))
+    assert sample() == before + 1
+
+def test_workflow_writes_stamp_updated_at(client, mock_db):
+    """Test the workflow pages record when a receipt last changed."""
+    data = {'image': (io.BytesIO(b'fake image data'), 'test.jpg')}
+    client.post('/upload', data=data, content_type='multipart/form-data')
+    receipt = mock_db.receipts.find_one()
+    assert receipt['updated_at'] == receipt['created_at']
+    client.post(f'/submit_people/{receipt["_id"]}', data={'count': '2', 'names': 'Alice, Bob'})
+    assert mock_db.receipts.find_one()['updated_at'] > receipt['created_at']
+
+def test_wizard_sessions_split_in_two_round_trips(client, mock_db, monkeypatch):
+    """Test with wizard sessions on, a whole split reads the receipt once and writes it once."""
+    import app as web_app
+    import wizard_session
+    monkeypatch.setattr(web_app, 'wizard_sessions', wizard_session.WizardSessions(10))
+    items = [{"_id": str(uuid.uuid4()), "description": "Nachos", "amount": 9.00},
+             {"_id": str(uuid.uuid4()), "description": "Pasta", "amount": 12.00}]
+    receipt_id = mock_db.receipts.insert_one({"items": items, "subtotal": 21.00, "tax": 0.0,
+                                              **__import__('schema').draft_fields()}).inserted_id
+    calls = []
+    for method in ('find', 'update_one', 'update_many', 'insert_one'):
+        original = getattr(mongomock.collection.Collection, method)
+        def recording(self, *args, _method=method, _original=original, **kwargs):
+            if self.name == 'receipts':
+                calls.append(_method)
+            return _original(self, *args, **kwargs)
+        monkeypatch.setattr(mongomock.collection.Collection, method, recording)
+
+    client.post(f'/submit_people/{receipt_id}', data={'count': '2', 'names': 'Alice, Bob'})
+    assert client.get(f'/select_appetizers/{receipt_id}').status_code == 200
+    client.post(f'/select_appetizers/{receipt_id}', data={'appetizers': [items[0]["_id"]]})
+    assert b'Pasta' in client.get(f'/allocateitems/{receipt_id}').data
+    client.post(f'/allocateitems/{receipt_id}', data={f'item_{items[1]["_id"]}': ['Bob']})
+    response = client.post(f'/calculate_bill/{receipt_id}', data={'tip_percentage': '0'})
+    assert response.status_code == 200
+    assert calls == ['find', 'update_one']
+
+    receipt = mock_db.receipts.find_one({"_id": receipt_id})
+    assert receipt['names'] == ['Alice', 'Bob']
+    assert 'alice' in receipt['search_tokens']
+    assert [item['is_appetizer'] for item in receipt['items']] == [True, False]
+    assert receipt['allocations'] == {items[1]["_id"]: ['Bob']}
+    assert receipt['payments'] == {'Alice': 4.5, 'Bob': 16.5}
+    assert 'draft_expires_at' not in receipt
+
+def test_wizard_sessions_checkpoint_evicted_drafts(mock_db):
+    """Test a draft pushed out of the cache is saved, not lost."""
+    import wizard_session
+    sessions = wizard_session.WizardSessions(max_entries=1)
+    first, second = (str(mock_db.receipts.insert_one({"items": []}).inserted_id) for _ in range(2))
+    sessions.update(mock_db, first, names=['Alice'], num_of_people='1')
+    sessions.update(mock_db, second, names=['Bob'], num_of_people='1')
+    assert mock_db.receipts.find_one({"_id": ObjectId(first)})['names'] == ['Alice']
+    assert 'names' not in mock_db.receipts.find_one({"_id": ObjectId(second)})
+    assert sessions.stats()['checkpoints'] == 1
+
+def test_upload_batch_queues_each_file(client, mock_db):
+    """Test a batch upload stores every file as its own receipt and reports each file."""
+    data = {'images': [(io.BytesIO(b'receipt one'), 'one.jpg'),
+                       (io.BytesIO(b''), 'empty.jpg'),
+                       (io.BytesIO(b'receipt two'), 'two.jpg')]}
+    response = client.post('/api/upload_batch', data=data, content_type='multipart/form-data')
+    assert response.status_code == 202
+    files = response.get_json()['files']
+    assert [f['status'] for f in files] == ['queued', 'rejected', 'queued']
+    assert files[1]['error'] == 'Empty file'
+    assert mock_db.receipts.count_documents({}) == 2
+    assert mock_db.ocr_jobs.count_documents({"status": "queued"}) == 2
+    assert mock_db.fs.files.count_documents({}) == 2
+    receipt = mock_db.receipts.find_one({"_id": ObjectId(files[2]['receipt_id'])})
+    assert receipt['image_sha256'] == hashlib.sha256(b'receipt two').hexdigest()
+    # batch receipts are kept, not expired by the draft TTL index
+    assert 'draft_expires_at' not in receipt
+    assert receipt['created_at'] == receipt['updated_at']
+
+def test_upload_batch_pages_make_one_receipt(client, mock_db):
+    """Test with pages=1 the files become the ordered pages of a single receipt."""
+    data = {'pages': '1', 'images': [(io.BytesIO(b'page one'), 'p1.jpg'),
+                                     (io.BytesIO(b'page two'), 'p2.jpg')]}
+    response = client.post('/api/upload_batch', data=data, content_type='multipart/form-data')
+    assert response.status_code == 202
+    files = response.get_json()['files']
+    assert files[0]['receipt_id'] == files[1]['receipt_id']
+    receipt = mock_db.receipts.find_one()
+    fs = gridfs.GridFS(mock_db)
+    assert [fs.get(page['image_id']).read() for page in receipt['pages']] == [b'page one', b'page two']
+    assert receipt['image_id'] == receipt['pages'][0]['image_id']
+    assert mock_db.ocr_jobs.count_documents({}) == 1
+
+def test_upload_batch_status(client, mock_db):
+    """Test the batch status endpoint reports OCR progress per receipt."""
+    data = {'images': [(io.BytesIO(b'a'), 'a.jpg'), (io.BytesIO(b'b'), 'b.jpg')]}
+    batch = client.post('/api/upload_batch', data=data,
+                        content_type='multipart/form-data').get_json()
+    done_id = ObjectId(batch['files'][0]['receipt_id'])
+    mock_db.ocr_jobs.update_one({"receipt_id": done_id}, {"$set": {"status": "done"}})
+    status = client.get(f"/api/upload_batch/{batch['batch_id']}").get_json()
+    assert status['counts'] == {'done': 1, 'queued': 1}
+    assert not status['finished']
+    assert client.get('/api/upload_batch/nope').status_code == 404
+
+def test_upload_batch_limits(client, mock_db, monkeypatch):
+    """Test a batch with no files, or too many, is refused."""
+    assert client.post('/api/upload_batch', data={}).status_code == 400
+    monkeypatch.setattr('app.UPLOAD_BATCH_MAX_FILES', 1)
+    data = {'images': [(io.BytesIO(b'a'), 'a.jpg'), (io.BytesIO(b'b'), 'b.jpg')]}
+    response = client.post('/api/upload_batch', data=data, content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert mock_db.receipts.count_documents({}) == 0
+
+def split_receipt(mock_db, client):
+    """A receipt whose bill has been calculated once, so it carries its shares."""
+    items = [{"_id": str(uuid.uuid4()), "description": d, "amount": a}
+             for d, a in (("Nachos", 9.00), ("Pasta", 12.00), ("Steak", 30.00))]
+    receipt_id = mock_db.receipts.insert_one({
+        "names": ["Alice", "Bob", "Carol"], "items": items, "subtotal": 51.00, "tax": 5.10,
+        "allocations": {items[0]["_id"]: ["Alice", "Bob", "Carol"],
+                        items[1]["_id"]: ["Bob"], items[2]["_id"]: ["Carol"]},
+        "item_counts": {items[0]["_id"]: 3, items[1]["_id"]: 1, items[2]["_id"]: 1},
+    }).inserted_id
+    assert client.post(f'/calculate_bill/{receipt_id}',
+                       data={'tip_percentage': '10'}).status_code == 200
+    return receipt_id, [item["_id"] for item in items]
+
+def resplit(mock_db, receipt_id, tip):
+    """The payments a split from scratch gives for the receipt as stored now."""
+    import split_engine
+    receipt = mock_db.receipts.find_one({"_id": receipt_id})
+    return split_engine.split_receipt(receipt, tip)[0]
+
+def test_calculate_bill_stores_split_shares(client, mock_db):
+    """Test the first split keeps each person's share for later edits."""
+    receipt_id, _ = split_receipt(mock_db, client)
+    receipt = mock_db.receipts.find_one({"_id": receipt_id})
+    assert len(receipt['shares']) == 3
+    assert receipt['tip_percentage'] == 10.0
+    assert receipt['ledger_version'] == 1
+
+def test_move_item_is_one_write(client, mock_db, monkeypatch):
+    """Test moving an item reads the receipt without its items and writes one $inc."""
+    receipt_id, item_ids = split_receipt(mock_db, client)
+    finds, updates = [], []
+    original_find, original_update = (mongomock.collection.Collection.find,
+                                      mongomock.collection.Collection.update_one)
+
+    def recording_find(self, filter=None, projection=None, *args, **kwargs):
+        finds.append(projection)
+        return original_find(self, filter, projection, *args, **kwargs)
+
+    def recording_update(self, filter, update, *args, **kwargs):
+        updates.append(update)
+        return original_update(self, filter, update, *args, **kwargs)
+    monkeypatch.setattr(mongomock.collection.Collection, 'find', recording_find)
+    monkeypatch.setattr(mongomock.collection.Collection, 'update_one', recording_update)
+
+    response = client.put(f'/api/receipts/{receipt_id}/allocations/{item_ids[1]}',
+                          json={'people': ['Alice', 'Bob']})
+    assert response.status_code == 200
+    assert len(finds) == 1 and "items" in finds[0] and "$elemMatch" in finds[0]["items"]
+    assert len(updates) == 1
+    assert set(updates[0]["$inc"]) == {"shares.0", "shares.1", "ledger_version"}
+    monkeypatch.undo()
+    assert response.get_json()['payments'] == resplit(mock_db, receipt_id, '10')
+
+def test_change_tip_and_people(client, mock_db):
+    """Test tip and party changes keep the payments equal to a split from scratch."""
+    receipt_id, item_ids = split_receipt(mock_db, client)
+    response = client.put(f'/api/receipts/{receipt_id}/tip', json={'tip_percentage': 20})
+    assert response.get_json()['payments'] == resplit(mock_db, receipt_id, '20')
+
+    response = client.post(f'/api/receipts/{receipt_id}/people', json={'name': 'Dan'})
+    assert response.status_code == 200
+    assert response.get_json()['payments'] == resplit(mock_db, receipt_id, '20')
+    assert response.get_json()['payments']['Dan'] == 0.0
+    assert client.post(f'/api/receipts/{receipt_id}/people',
+                       json={'name': 'Dan'}).status_code == 400
+
+    response = client.delete(f'/api/receipts/{receipt_id}/people/Bob')
+    assert response.status_code == 200
+    receipt = mock_db.receipts.find_one({"_id": receipt_id})
+    assert receipt['names'] == ['Alice', 'Carol', 'Dan']
+    assert item_ids[1] not in receipt['allocations']
+    assert receipt['allocations'][item_ids[0]] == ['Alice', 'Carol']
+    assert response.get_json()['payments'] == resplit(mock_db, receipt_id, '20')
+
+def test_ledger_edits_of_an_invalid_receipt_id(client):
+    """Test the split edit routes answer 404, not 500, for an id that isn't an ObjectId."""
+    assert client.put('/api/receipts/nope/tip', json={'tip_percentage': 20}).status_code == 404
+    assert client.put('/api/receipts/nope/allocations/x',
+                      json={'people': ['Alice']}).status_code == 404
+    assert client.post('/api/receipts/nope/people', json={'name': 'Dan'}).status_code == 404
+    assert client.delete('/api/receipts/nope/people/Bob').status_code == 404
+
+def test_tip_only_calculate_bill_uses_shares(client, mock_db):
+    """Test recalculating with another tip and re-allocating both keep the split right."""
+    receipt_id, item_ids = split_receipt(mock_db, client)
+    data = {f'item_{item_ids[0]}': ['Alice'], f'item_{item_ids[2]}': ['Bob', 'Carol']}
+    assert client.post(f'/allocateitems/{receipt_id}', data=data).status_code == 302
+    receipt = mock_db.receipts.find_one({"_id": receipt_id})
+    assert item_ids[1] not in receipt['allocations']
+    assert receipt['payments'] == resplit(mock_db, receipt_id, '10')
+    client.post(f'/calculate_bill/{receipt_id}', data={'tip_percentage': '15'})
+    receipt = mock_db.receipts.find_one({"_id": receipt_id})
+    assert receipt['payments'] == resplit(mock_db, receipt_id, '15')
+    assert receipt['ledger_version'] == 3
+
+def test_split_edits_need_a_split(client, mock_db, prepare_data):
+    """Test editing a receipt that was never split asks for the bill first."""
+    response = client.put(f'/api/receipts/{prepare_data}/tip', json={'tip_percentage': 20})
+    assert response.status_code == 409
+    assert client.put(f'/api/receipts/{ObjectId()}/tip',
+                      json={'tip_percentage': 20}).status_code == 404
+
+def test_changing_names_drops_split_shares(client, mock_db):
+    """Test re-entering the party invalidates the stored shares."""
+    receipt_id, _ = split_receipt(mock_db, client)
+    client.post(f'/submit_people/{receipt_id}', data={'count': '2', 'names': 'Alice, Bob'})
+    assert 'shares' not in mock_db.receipts.find_one({"_id": receipt_id})
+
+def test_results_page_revalidates_with_etag(client, mock_db, monkeypatch):
+    """Test the shared results page is rendered once per version and answers 304 when unchanged."""
+    import app as web_app
+    import page_cache
+    monkeypatch.setattr(web_app, 'results_pages', page_cache.PageCache(10))
+    receipt_id, _ = split_receipt(mock_db, client)
+    first = client.get(f'/results/{receipt_id}')
+    assert first.status_code == 200
+    assert b'Alice' in first.data
+    etag = first.headers['ETag']
+    assert 'no-cache' in first.headers['Cache-Control']
+    assert client.get(f'/results/{receipt_id}').data == first.data
+    assert web_app.results_pages.stats()['hits'] == 1
+    assert client.get(f'/results/{receipt_id}',
+                      headers={'If-None-Match': etag}).status_code == 304
+
+    client.put(f'/api/receipts/{receipt_id}/tip', json={'tip_percentage': 20})
+    changed = client.get(f'/results/{receipt_id}', headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+    assert client.get(f'/results/{ObjectId()}').status_code == 404
+
+def test_history_rows_are_cached_per_version(client, mock_db, monkeypatch):
+    """Test history reuses a rendered row until its receipt changes."""
+    import app as web_app
+    import page_cache
+    from app import receipt_store
+    monkeypatch.setattr(web_app, 'history_rows', page_cache.PageCache(10))
+    receipt_id = mock_db.receipts.insert_one({
+        "receipt_name": "Harbor Lane Cafe", "names": ["Alice"], "items": [],
+        "search_tokens": receipt_store.search_tokens("Harbor Lane Cafe", "Alice"),
+        **__import__('schema').draft_fields()}).inserted_id
+    assert 'Harbor Lane Cafe' in client.get('/history?search=harbor').data.decode()
+    assert 'Harbor Lane Cafe' in client.get('/history?search=alice').data.decode()
+    assert web_app.history_rows.stats()['hits'] == 1
+    client.post(f'/submit_people/{receipt_id}', data={'count': '2', 'names': 'Alice, Bob'})
+    assert 'Alice, Bob' in client.get('/history?search=harbor').data.decode()
+
+def test_batch_jobs_queue_behind_uploads(client, mock_db):
+    """Test single uploads are queued ahead of batch uploads, and a deferred job says until when."""
+    client.post('/api/upload_batch', data={'images': [(io.BytesIO(b'batch receipt'), 'b.jpg')]},
+                content_type='multipart/form-data')
+    client.post('/upload', data={'image': (io.BytesIO(b'single receipt'), 'a.jpg')},
+                content_type='multipart/form-data')
+    import batch_upload
+    assert sorted(job['priority'] for job in mock_db.ocr_jobs.find()) == \
+        [batch_upload.INTERACTIVE, batch_upload.BATCH]
+    job = mock_db.ocr_jobs.find_one({'priority': batch_upload.BATCH})
+    run_after = datetime(2030, 1, 1)
+    mock_db.ocr_jobs.update_one({'_id': job['_id']},
+                                {'$set': {'stage': 'deferred', 'run_after': run_after}})
+    body = client.get(f'/job_status/{job["receipt_id"]}').get_json()
+    assert body['stage'] == 'deferred'
+    assert body['deferred_until'] == run_after.isoformat()
+
+def test_wizard_sessions_sweep_idle_drafts(mock_db):
+    """Test drafts left idle past the TTL are saved and dropped when another receipt is used."""
+    import wizard_session
+    now = [0.0]
+    sessions = wizard_session.WizardSessions(max_entries=10, ttl_seconds=60, clock=lambda: now[0])
+    idle, active = (str(mock_db.receipts.insert_one({"items": []}).inserted_id) for _ in range(2))
+    sessions.update(mock_db, idle, names=['Alice'], num_of_people='1')
+    now[0] = 30.0
+    sessions.load(mock_db, active)
+    now[0] = 61.0
+    sessions.update(mock_db, active, names=['Bob'], num_of_people='1')
+    assert sessions.stats()['entries'] == 1
+    assert mock_db.receipts.find_one({"_id": ObjectId(idle)})['names'] == ['Alice']
+    assert 'names' not in mock_db.receipts.find_one({"_id": ObjectId(active)})
+
+def test_wizard_sessions_need_a_positive_ttl():
+    """Test a TTL of 0 is refused rather than expiring every draft as soon as it loads."""
+    import wizard_session
+    with pytest.raises(ValueError):
+        wizard_session.WizardSessions(10, ttl_seconds=0)
+
+def test_wizard_sessions_allocate_unknown_receipt(client, monkeypatch):
+    """Test allocating items for a receipt that doesn't exist is a 404 with sessions on."""
+    import app as web_app
+    import wizard_session
+    monkeypatch.setattr(web_app, 'wizard_sessions', wizard_session.WizardSessions(10))
+    response = client.post(f'/allocateitems/{ObjectId()}', data={'item_x': ['Bob']})
+    assert response.status_code == 404
@@ -0,0 +1,176 @@
+import sys
+from pathlib import Path
+
+import pytest
+import requests
+import requests_mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from ml_client import CircuitBreaker, CircuitOpenError, MLServiceClient  # noqa: E402
+
+BASE_URL = "http://ml.test:5002"
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def ml(clock):
+    return MLServiceClient(BASE_URL, max_retries=2, retry_backoff=0,
+                           breaker=CircuitBreaker(failure_threshold=2, reset_timeout=10,
+                                                  clock=clock))
+
+
+def test_retries_transient_failures(ml):
+    """A 503 followed by a success is retried and returns the success."""
+    with requests_mock.Mocker() as m:
+        m.post(f"{BASE_URL}/predict", [{"status_code": 503}, {"json": {"_id": "abc"}}])
+        response = ml.post_json("/predict", {"Object_ID": "abc"})
+    assert response.json() == {"_id": "abc"}
+    assert m.call_count == 2
+    assert ml.breaker.state == "closed"
+
+
+def test_gives_up_after_bounded_retries(ml):
+    with requests_mock.Mocker() as m:
+        m.get(f"{BASE_URL}/test_connection", exc=requests.ConnectTimeout)
+        with pytest.raises(requests.ConnectTimeout):
+            ml.get("/test_connection")
+    assert m.call_count == 3
+    assert ml.breaker.snapshot()["consecutive_failures"] == 1
+
+
+def test_client_errors_are_not_retried(ml):
+    with requests_mock.Mocker() as m:
+        m.post(f"{BASE_URL}/predict", status_code=400, json={"error": "bad"})
+        assert ml.post_json("/predict", {}).status_code == 400
+    assert m.call_count == 1
+
+
+def test_server_errors_open_the_circuit(ml):
+    """A 500 isn't retried, but it is a failure: a service that keeps answering 500 is cut off."""
+    with requests_mock.Mocker() as m:
+        m.post(f"{BASE_URL}/predict", status_code=500)
+        for _ in range(2):
+            assert ml.post_json("/predict", {}).status_code == 500
+        assert m.call_count == 2
+        assert ml.breaker.state == "open"
+        with pytest.raises(CircuitOpenError):
+            ml.post_json("/predict", {})
+
+
+def test_circuit_opens_and_recovers(ml, clock):
+    """The breaker opens after repeated failures, then lets one trial call through."""
+    with requests_mock.Mocker() as m:
+        m.get(f"{BASE_URL}/test_connection", exc=requests.ConnectionError)
+        for _ in range(2):
+            with pytest.raises(requests.ConnectionError):
+                ml.get("/test_connection")
+        assert ml.breaker.state == "open"
+        calls = m.call_count
+        with pytest.raises(CircuitOpenError):
+            ml.get("/test_connection")
+        assert m.call_count == calls  # rejected without touching the network
+
+        clock.now += 10
+        assert ml.status()["circuit"]["state"] == "half_open"
+        m.get(f"{BASE_URL}/test_connection", json={"success": True})
+        assert ml.get("/test_connection").status_code == 200
+    assert ml.breaker.state == "closed"
+
+
+def test_failed_trial_reopens_circuit(ml, clock):
+    with requests_mock.Mocker() as m:
+        m.get(f"{BASE_URL}/test_connection", exc=requests.ConnectionError)
+        for _ in range(2):
+            with pytest.raises(requests.ConnectionError):
+                ml.get("/test_connection")
+        clock.now += 10
+        with pytest.raises(requests.ConnectionError):
+            ml.get("/test_connection")
+    assert ml.breaker.state == "open"
+    assert ml.status()["circuit"]["retry_in_seconds"] == 10
+
+
+def test_async_client_retries_then_succeeds(clock):
+    httpx = pytest.importorskip("httpx")
+    import asyncio
+    from ml_client import AsyncMLServiceClient
+
+    responses = iter([httpx.Response(503), httpx.Response(200, json={"_id": "abc"})])
+    transport = httpx.MockTransport(lambda request: next(responses))
+    ml = AsyncMLServiceClient(BASE_URL, transport=transport, max_retries=2, retry_backoff=0,
+                              breaker=CircuitBreaker(failure_threshold=2, clock=clock))
+
+    async def call():
+        try:
+            return await ml.post_json("/predict", {"Object_ID": "abc"})
+        finally:
+            await ml.aclose()
+
+    assert asyncio.run(call()).json() == {"_id": "abc"}
+    assert ml.breaker.state == "closed"
+
+
+def test_unexpected_errors_settle_the_trial(ml, clock):
+    """Any requests error in a half-open trial re-opens the circuit instead of wedging it."""
+    with requests_mock.Mocker() as m:
+        m.get(f"{BASE_URL}/test_connection", exc=requests.ConnectionError)
+        for _ in range(2):
+            with pytest.raises(requests.ConnectionError):
+                ml.get("/test_connection")
+        clock.now += 10
+        m.get(f"{BASE_URL}/test_connection", exc=requests.exceptions.ChunkedEncodingError)
+        with pytest.raises(requests.exceptions.ChunkedEncodingError):
+            ml.get("/test_connection")
+        assert ml.breaker.state == "open"
+        clock.now += 10
+        m.get(f"{BASE_URL}/test_connection", json={"success": True})
+        assert ml.get("/test_connection").status_code == 200
+    assert ml.breaker.state == "closed"
+
+
+def test_post_read_timeouts_are_not_retried(ml):
+    """A POST that timed out waiting for the answer may have run; it is not sent again."""
+    with requests_mock.Mocker() as m:
+        m.post(f"{BASE_URL}/predict", exc=requests.ReadTimeout)
+        with pytest.raises(requests.ReadTimeout):
+            ml.post_json("/predict", {"Object_ID": "abc"})
+        assert m.call_count == 1
+        m.get(f"{BASE_URL}/test_connection", exc=requests.ReadTimeout)
+        with pytest.raises(requests.ReadTimeout):
+            ml.get("/test_connection")
+        assert m.call_count == 4
+
+
+def test_async_client_counts_decoding_errors(clock):
+    httpx = pytest.importorskip("httpx")
+    import asyncio
+    from ml_client import AsyncMLServiceClient
+
+    def handler(request):
+        raise httpx.DecodingError("bad gzip", request=request)
+    ml = AsyncMLServiceClient(BASE_URL, transport=httpx.MockTransport(handler), max_retries=2,
+                              retry_backoff=0,
+                              breaker=CircuitBreaker(failure_threshold=1, clock=clock))
+
+    async def call():
+        try:
+            return await ml.post_json("/predict", {"Object_ID": "abc"})
+        finally:
+            await ml.aclose()
+
+    with pytest.raises(ml.errors):
+        asyncio.run(call())
+    assert ml.breaker.state == "open"
@@ -0,0 +1,95 @@
+import asyncio
+import json
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+import mongomock
+from bson import ObjectId
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import progress  # noqa: E402
+
+
+class AsyncCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    async def to_list(self, length):
+        return list(self.cursor)
+
+
+class AsyncCollection:
+    """The slice of motor's collection API the async hub uses, over mongomock."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def find_one(self, *args, **kwargs):
+        return self.collection.find_one(*args, **kwargs)
+
+    def find(self, *args, **kwargs):
+        return AsyncCursor(self.collection.find(*args, **kwargs))
+
+
+class AsyncDatabase:
+    def __init__(self, db):
+        self.ocr_jobs = AsyncCollection(db.ocr_jobs)
+
+
+def add_job(db, receipt_id, *stages, status="queued"):
+    now = datetime.now(timezone.utc)
+    db.ocr_jobs.insert_one({"receipt_id": receipt_id, "status": status, "attempts": 0,
+                            "stage": stages[-1], "created_at": now, "updated_at": now,
+                            "stages": [{"stage": stage, "at": now} for stage in stages]})
+
+
+def advance(db, receipt_id, stage, status):
+    now = datetime.now(timezone.utc)
+    db.ocr_jobs.update_one({"receipt_id": receipt_id},
+                           {"$set": {"stage": stage, "status": status, "updated_at": now},
+                            "$push": {"stages": {"stage": stage, "at": now}}})
+
+
+def stages_in(events):
+    return [json.loads(event.split("data: ", 1)[1])["stage"]
+            for event in events if "event: stage" in event]
+
+
+def test_job_without_stages_reports_outcome():
+    """Jobs queued before stages were recorded still finish their streams."""
+    now = datetime.now(timezone.utc)
+    assert progress.job_stages({"status": "done", "updated_at": now}) == \
+        [{"stage": "ready", "at": now}]
+    assert progress.job_stages({"status": "queued", "updated_at": now}) == []
+
+
+def test_async_stream_follows_job():
+    db = mongomock.MongoClient().db
+    receipt_id = ObjectId()
+    add_job(db, receipt_id, "stored", "queued")
+    hub = progress.AsyncProgressHub(AsyncDatabase(db), poll_seconds=0.01)
+
+    async def watch():
+        events = []
+        async for event in hub.stream(str(receipt_id), keepalive=1):
+            events.append(event)
+            if '"stage": "queued"' in event:
+                advance(db, receipt_id, "ocr_running", "running")
+                advance(db, receipt_id, "ready", "done")
+        return events
+
+    events = asyncio.run(asyncio.wait_for(watch(), 5))
+    assert stages_in(events) == ["stored", "queued", "ocr_running", "ready"]
+    assert events[-1] == progress.end_event("done")
+    assert hub.watching() == 0
+
+
+def test_async_wait_times_out_with_current_job():
+    db = mongomock.MongoClient().db
+    receipt_id = ObjectId()
+    add_job(db, receipt_id, "stored", "queued")
+    hub = progress.AsyncProgressHub(AsyncDatabase(db), poll_seconds=0.01)
+    job = asyncio.run(hub.wait(str(receipt_id), after=1, timeout=0.05))
+    assert job["stage"] == "queued"
@@ -0,0 +1,50 @@
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from receipt_model import InvalidReceipt, LineItem, Receipt  # noqa: E402
+
+
+def ocr_result(**fields):
+    return dict({"receipt_name": "Harbor Lane Cafe", "currency": "USD",
+                 "items": [{"description": " Nachos ", "amount": 8.9, "quantity": 1.0},
+                           {"description": "Shrimp Tacos", "amount": "12.345", "quantity": None}],
+                 "total": 23.5, "tax": 2.255, "tip": None, "subtotal": 21.25}, **fields)
+
+
+def test_from_ocr_parses_cents_and_assigns_ids():
+    """Amounts become whole cents, quantities whole numbers and every item gets a uuid4 id."""
+    receipt = Receipt.from_ocr(ocr_result())
+    assert [item.amount_cents for item in receipt.items] == [890, 1235]
+    assert [item.quantity for item in receipt.items] == [1, 1]
+    assert receipt.items[0].description == "Nachos"
+    assert receipt.tax_cents == 226 and receipt.tip_cents is None
+    ids = [item.id for item in receipt.items]
+    assert len(set(ids)) == 2
+    assert all(str(uuid.UUID(item_id, version=4)) == item_id for item_id in ids)
+
+
+def test_bson_round_trip_is_compact():
+    """Stored receipts keep the existing dollar fields and drop empty ones."""
+    doc = Receipt.from_ocr(ocr_result()).to_bson()
+    assert "tip" not in doc
+    assert doc["tax"] == 2.26
+    assert doc["items"][1] == {"_id": doc["items"][1]["_id"], "description": "Shrimp Tacos",
+                               "amount": 12.35, "quantity": 1}
+    again = Receipt.from_bson(doc)
+    assert again.to_bson() == doc
+    assert LineItem.from_bson({"amount": 3, "is_appetizer": True}).to_bson() == \
+        {"description": "", "amount": 3.0, "quantity": 1, "is_appetizer": True}
+
+
+def test_slots_and_bad_amounts():
+    """The model has no per-instance dict and rejects amounts it cannot read."""
+    item = LineItem("Nachos", 890)
+    with pytest.raises(AttributeError):
+        item.price = 1
+    with pytest.raises(InvalidReceipt, match="Invalid amount"):
+        Receipt.from_ocr(ocr_result(total="twelve"))
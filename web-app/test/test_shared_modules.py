@@ -0,0 +1,48 @@
+"""
+The web app and the ML client are built from separate Docker contexts, so a
+few modules are copied into both. These tests fail as soon as a copy drifts.
+"""
+import ast
+import re
+import sys
+from pathlib import Path
+
+WEB_APP = Path(__file__).resolve().parent.parent
+ML_CLIENT = WEB_APP.parent / "machine-learning-client"
+
+sys.path.insert(0, str(WEB_APP))
+
+import receipt_store  # noqa: E402
+
+
+def definitions(path):
+    """Source of each top-level function, class and assignment in path, by name."""
+    source = path.read_text()
+    found = {}
+    for node in ast.parse(source).body:
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            found[node.name] = ast.get_source_segment(source, node)
+        elif isinstance(node, ast.Assign) and isinstance(node.targets[0], ast.Name):
+            found[node.targets[0].id] = ast.get_source_segment(source, node)
+    return found
+
+
+def test_receipt_model_copies_are_identical():
+    assert (WEB_APP / "receipt_model.py").read_text() == \
+        (ML_CLIENT / "receipt_model.py").read_text()
+
+
+def test_metrics_copies_share_their_common_definitions():
+    """Each service adds its own metrics; everything defined in both must match."""
+    web, ml = definitions(WEB_APP / "metrics.py"), definitions(ML_CLIENT / "metrics.py")
+    shared = set(web) & set(ml)
+    assert {"install", "MongoCommandMetrics", "observe_request", "REQUEST_SECONDS"} <= shared
+    assert [name for name in sorted(shared) if web[name] != ml[name]] == []
+
+
+def test_search_tokens_match_the_ml_client():
+    """Tokens the ML client indexes are the ones the history search looks up."""
+    namespace = {"re": re}
+    exec(definitions(ML_CLIENT / "main.py")["search_tokens"], namespace)
+    texts = ["Harbor Lane Café", "Shrimp Tacos x2", None, "ALICE, bob-o'neil", 12.5]
+    assert namespace["search_tokens"](*texts) == receipt_store.search_tokens(*texts)
@@ -0,0 +1,94 @@
+import sys
+from fractions import Fraction
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from split_engine import SplitError, apportion_cents, split_bill  # noqa: E402
+
+
+def make_items(*amounts, appetizers=()):
+    return [{"_id": f"id{i}", "amount": amount, "is_appetizer": i in appetizers}
+            for i, amount in enumerate(amounts)]
+
+
+def test_split_simple_allocation():
+    """Each person pays their own item plus their share of tax and tip."""
+    items = make_items(10.00, 30.00)
+    allocations = {"id0": ["Alice"], "id1": ["Bob"]}
+    cents = split_bill(["Alice", "Bob"], items, allocations, {"id0": 1, "id1": 1},
+                       subtotal=40.00, tax=4.00, tip_percentage="0")
+    assert cents == {"Alice": 1100, "Bob": 3300}
+
+
+def test_split_shared_items_and_appetizers():
+    """Appetizers are split by everyone, shared items by the people who had them."""
+    items = make_items(9.00, 20.00, 10.00, appetizers={0})
+    allocations = {"id1": ["Alice", "Bob"], "id2": ["Carol"]}
+    cents = split_bill(["Alice", "Bob", "Carol"], items, allocations,
+                       {"id1": 2, "id2": 1}, subtotal=39.00, tax=0, tip_percentage="0")
+    assert cents == {"Alice": 1300, "Bob": 1300, "Carol": 1300}
+
+
+def test_split_total_never_drifts():
+    """Shares add up to the receipt total to the cent, with a deterministic remainder."""
+    items = make_items(10.00)
+    allocations = {"id0": ["Alice", "Bob", "Carol"]}
+    cents = split_bill(["Alice", "Bob", "Carol"], items, allocations, {"id0": 3},
+                       subtotal=10.00, tax=0, tip_percentage="0")
+    assert sum(cents.values()) == 1000
+    assert cents == {"Alice": 334, "Bob": 333, "Carol": 333}
+    assert cents == split_bill(["Alice", "Bob", "Carol"], items, allocations, {"id0": 3},
+                               subtotal=10.00, tax=0, tip_percentage="0")
+
+
+def test_split_large_group_matches_total():
+    """A 240 item, 50 person receipt still adds up to subtotal + tax + tip."""
+    names = [f"person{i}" for i in range(50)]
+    amounts = [round(1.37 * (i % 17) + 0.99, 2) for i in range(240)]
+    items = make_items(*amounts, appetizers={0, 1, 2})
+    allocations = {f"id{i}": [names[i % 50], names[(i * 7) % 50]] for i in range(3, 240)}
+    item_counts = {item_id: len(users) for item_id, users in allocations.items()}
+    subtotal = round(sum(amounts), 2)
+    cents = split_bill(names, items, allocations, item_counts,
+                       subtotal=subtotal, tax=31.17, tip_percentage="18")
+    expected = round((Fraction(str(subtotal)) + Fraction("31.17")) * Fraction(118, 100) * 100)
+    assert sum(cents.values()) == expected
+
+
+def test_split_rejects_bad_receipts():
+    items = make_items(10.00)
+    with pytest.raises(SplitError, match="Invalid receipt data"):
+        split_bill(["Alice"], items, {}, {}, subtotal=0, tax=0, tip_percentage="0")
+    with pytest.raises(SplitError, match="Number of people cannot be zero"):
+        split_bill([], items, {}, {}, subtotal=10, tax=0, tip_percentage="0")
+    with pytest.raises(SplitError, match="Unknown person"):
+        split_bill(["Alice"], items, {"id0": ["Mallory"]}, {}, subtotal=10, tax=0,
+                   tip_percentage="0")
+
+
+def test_apportion_cents_gives_remainder_to_largest_fraction():
+    cents = apportion_cents({"a": Fraction(100, 3), "b": Fraction(100, 3), "c": Fraction(100, 3)})
+    assert cents == {"a": 34, "b": 33, "c": 33}
+    cents = apportion_cents({"a": Fraction("10.1"), "b": Fraction("20.9")})
+    assert cents == {"a": 10, "b": 21}
+
+
+def test_payments_from_shares_match_split_bill():
+    """The stored shares give exactly the payments of a split from scratch."""
+    from split_engine import payments_from_shares
+    from split_ledger import build
+    names = [f"person{i}" for i in range(7)]
+    amounts = [round(2.31 * (i % 11) + 0.99, 2) for i in range(60)]
+    items = make_items(*amounts, appetizers={0, 1})
+    allocations = {f"id{i}": names[i % 7:i % 7 + 1 + i % 3] for i in range(2, 60)}
+    item_counts = {item_id: len(users) for item_id, users in allocations.items()}
+    subtotal = round(sum(amounts), 2)
+    receipt = {"names": names, "items": items, "allocations": allocations,
+               "item_counts": item_counts}
+    ledger = build(receipt)
+    assert payments_from_shares(names, ledger["shares"], ledger["appetizer_cents"],
+                                subtotal, 12.34, "18") == \
+        split_bill(names, items, allocations, item_counts, subtotal, 12.34, "18")
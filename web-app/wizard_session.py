@@ -0,0 +1,162 @@
+"""
+Server-side state for the split wizard.
+
+Without it every wizard step reads and writes the receipt in Mongo:
+submit_people, select_appetizers and allocateitems each write, and each
+page re-reads what the last one wrote. With a WizardSessions cache the
+receipt is read once, held in memory while the steps change it, and written
+back in one update when calculate_bill saves the payments: two database
+operations per split instead of about ten.
+
+The cache is per process, so it needs every request for a receipt to reach
+the same process: one gunicorn or uvicorn worker (gevent gives it
+concurrency), which app.py requires WEB_CONCURRENCY=1 for. Drafts pushed
+out by LRU eviction or left idle past ttl_seconds (swept on every load and
+update) are checkpointed to Mongo first, so nothing a user entered is lost,
+and the next step simply reads the receipt again.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from bson import ObjectId
+
+import receipt_store
+import schema
+
+# wizard fields a draft can change; only these are written back
+WIZARD_FIELDS = ("num_of_people", "names", "items", "allocations", "item_counts")
+
+
+class WizardSessions:
+    def __init__(self, max_entries=1000, ttl_seconds=1800, clock=time.monotonic):
+        if ttl_seconds <= 0:
+            raise ValueError(f"ttl_seconds must be positive, got {ttl_seconds}")
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._entries = OrderedDict()  # receipt_id -> (db, draft, dirty fields, last used)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.checkpoints = 0
+
+    def load(self, db, receipt_id):
+        """The in-progress receipt, read from Mongo on first use; None if there is none."""
+        with self._lock:
+            expired = self._expire()
+            entry = self._entries.get(receipt_id)
+            if entry is not None:
+                self._entries.move_to_end(receipt_id)
+                self._entries[receipt_id] = entry[:3] + (self._clock(),)
+                self.hits += 1
+        self._checkpoint_all(expired)
+        if entry is not None:
+            return entry[1]
+
+        draft = receipt_store.get_receipt(db, receipt_id, 'wizard')
+        if draft is None:
+            return None
+        with self._lock:
+            self.misses += 1
+            self._entries[receipt_id] = (db, draft, set(), self._clock())
+            evicted = self._evict()
+        self._checkpoint_all(evicted)
+        return draft
+
+    def items(self, db, receipt_id, draft):
+        """
+        The draft's line items. A draft loaded before OCR finished has none,
+        so those are read again until they arrive.
+        """
+        if not draft.get('items'):
+            scanned = receipt_store.get_receipt(db, receipt_id, 'split_totals') or {}
+            for field in ('items', 'subtotal', 'tax'):
+                if field in scanned:
+                    draft[field] = scanned[field]
+        return draft.get('items', [])
+
+    def update(self, db, receipt_id, **fields):
+        """
+        Change draft fields in memory; they are written at the next
+        checkpoint. Returns False if there is no such receipt.
+        """
+        while True:
+            with self._lock:
+                expired = self._expire()
+                entry = self._entries.get(receipt_id)
+                if entry is not None:
+                    db, draft, dirty, _ = entry
+                    draft.update(fields)
+                    dirty.update(fields)
+                    self._entries.move_to_end(receipt_id)
+                    self._entries[receipt_id] = (db, draft, dirty, self._clock())
+            self._checkpoint_all(expired)
+            if entry is not None:
+                return True
+            if self.load(db, receipt_id) is None:
+                return False
+
+    def finish(self, db, receipt_id, update):
+        """
+        Write the draft's changes together with update (the payments) in one
+        round trip and forget the draft.
+        """
+        with self._lock:
+            entry = self._entries.pop(receipt_id, None)
+        changes = draft_update(entry[1], entry[2]) if entry else {}
+        for operator, fields in update.items():
+            changes.setdefault(operator, {}).update(fields)
+        db.receipts.update_one({"_id": ObjectId(receipt_id)}, changes)
+
+    def _expire(self):
+        """
+        Drop every draft idle past ttl_seconds, not just the one asked for,
+        so abandoned wizards are saved and freed while others are in use.
+        Entries are kept in order of last use, so the idle ones are first.
+        """
+        expired = []
+        cutoff = self._clock() - self.ttl_seconds
+        while self._entries:
+            receipt_id, entry = next(iter(self._entries.items()))
+            if entry[3] >= cutoff:
+                break
+            expired.append((receipt_id, self._entries.pop(receipt_id)))
+        return expired
+
+    def _evict(self):
+        evicted = []
+        while len(self._entries) > self.max_entries:
+            evicted.append(self._entries.popitem(last=False))
+        return evicted
+
+    def _checkpoint_all(self, entries):
+        for receipt_id, (db, draft, dirty, _) in entries:
+            if dirty:
+                # the receipt's stored split shares no longer match it
+                db.receipts.update_one({"_id": ObjectId(receipt_id)},
+                                       {**draft_update(draft, dirty), **schema.split_changed()})
+                with self._lock:
+                    self.checkpoints += 1
+
+    def checkpoint(self):
+        """Write every draft with unsaved changes (e.g. at shutdown) and drop them all."""
+        with self._lock:
+            entries = list(self._entries.items())
+            self._entries.clear()
+        self._checkpoint_all(entries)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "max_entries": self.max_entries,
+                    "hits": self.hits, "misses": self.misses, "checkpoints": self.checkpoints}
+
+
+def draft_update(draft, dirty):
+    """The Mongo update saving a draft's changed wizard fields."""
+    update = {"$set": {field: draft[field] for field in WIZARD_FIELDS if field in dirty},
+              **schema.touch()}
+    if "names" in dirty:
+        update["$addToSet"] = {"search_tokens": {
+            "$each": receipt_store.search_tokens(*draft["names"])}}
+    return update